@@ -19,9 +19,14 @@
 
 __author__ = 'watson@google.com (Tony Watson)'
 
+import csv
+import json
 from optparse import OptionParser
 import sys
+import urllib
+import urllib2
 from lib import aclcheck
+from lib import aclcheckserver
 from lib import policy
 from lib import naming
 
@@ -31,6 +36,9 @@ def main():
   _parser = OptionParser(usage)
   _parser.add_option('--definitions-directory', dest='definitions',
                      help='definitions directory', default='./def')
+  _parser.add_option('--snapshot', dest='snapshot',
+                     help='load the definitions from this snapshot, written '
+                     'when missing or older than the definitions')
   _parser.add_option('-p', '--policy-file', dest='pol',
                      help='policy file', default='./policies/sample.pol')
   _parser.add_option('-d', '--destination', dest='dst',
@@ -43,12 +51,56 @@ def main():
                      help='destination port', default='80')
   _parser.add_option('--sport', '--source-port', dest='sport',
                      help='source port', default='1025')
+  _parser.add_option('--flows', dest='flows',
+                     help='check the flows of this CSV file instead, one '
+                     'src,dst,sport,dport,proto per line')
+  _parser.add_option('-j', '--jobs', dest='jobs', type='int', default=1,
+                     help='worker processes checking the flows of --flows')
+  _parser.add_option('--serve', dest='serve', action='store_true',
+                     help='answer queries over HTTP for every policy under '
+                     '--policy-directory, reloading the files which change')
+  _parser.add_option('--policy-directory', dest='policy_directory',
+                     help='policy directory to --serve', default='./policies')
+  _parser.add_option('--port', dest='port', type='int', default=8080,
+                     help='localhost port to --serve on')
+  _parser.add_option('--server', dest='server',
+                     help='ask the --serve server at this host:port instead '
+                     'of parsing the policy')
   (FLAGS, args) = _parser.parse_args()
   #if FLAGS.help:
   #  print _parser.format_help()
 
-  defs = naming.Naming(FLAGS.definitions)
+  if FLAGS.server:
+    query = {'policy': FLAGS.pol, 'src': FLAGS.src, 'dst': FLAGS.dst,
+             'sport': FLAGS.sport, 'dport': FLAGS.dport, 'proto': FLAGS.proto}
+    try:
+      reply = urllib2.urlopen('http://%s/check?%s' % (
+          FLAGS.server, urllib.urlencode(query)))
+    except urllib2.HTTPError as e:
+      sys.exit(json.load(e)['error'])
+    for _, result in sorted(json.load(reply).items()):
+      print result['text']
+    return
+
+  if FLAGS.serve:
+    store = aclcheckserver.PolicyStore(FLAGS.definitions,
+                                       FLAGS.policy_directory,
+                                       snapshot=FLAGS.snapshot)
+    server = aclcheckserver.Server(store, ('localhost', FLAGS.port))
+    print 'serving %d policies on localhost:%d' % (len(store.policies),
+                                                   FLAGS.port)
+    server.ServeForever()
+    return
+
+  defs = naming.Naming(FLAGS.definitions, snapshot=FLAGS.snapshot)
   policy_obj = policy.ParsePolicy(open(FLAGS.pol).read(), defs)
+  if FLAGS.flows:
+    flows = csv.reader(open(FLAGS.flows))
+    for flow, exact, possibles in aclcheck.AclCheck.EvaluateMany(
+        policy_obj, flows, jobs=FLAGS.jobs):
+      print '%s: %s' % (','.join(flow), '; '.join(
+          str(x) for x in possibles + [exact or 'no match']))
+    return
   check = aclcheck.AclCheck(policy_obj, src=FLAGS.src, dst=FLAGS.dst,
                             sport=FLAGS.sport, dport=FLAGS.dport,
                             proto=FLAGS.proto)
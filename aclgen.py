@@ -22,15 +22,17 @@
 __author__ = 'watson@google.com (Tony Watson)'
 
 # system imports
-import copy
+import cStringIO
 import dircache
 import datetime
 from optparse import OptionParser
+import multiprocessing
 import os
 import logging
 import sys
 
 # compiler imports
+from lib import manifest
 from lib import naming
 from lib import policy
 
@@ -59,6 +61,9 @@ def parse_args(command_line_args):
   _parser = OptionParser()
   _parser.add_option('-d', '--def', dest='definitions',
                      help='definitions directory', default='./def')
+  _parser.add_option('--snapshot', dest='snapshot',
+                     help='load the definitions from this snapshot, written '
+                     'when missing or older than the definitions')
   _parser.add_option('-o', dest='output_directory', help='output directory',
                      default='./filters')
   _parser.add_option('', '--poldir', dest='policy_directory',
@@ -70,25 +75,171 @@ def parse_args(command_line_args):
   _parser.add_option('--debug', help='enable debug-level logging', dest='debug')
   _parser.add_option('-s', '--shade_checking', help='Enable shade checking',
                      action="store_true", dest="shade_check", default=False)
+  _parser.add_option('--merge_terms', action='store_true',
+                     dest='merge_terms', default=False,
+                     help='Drop redundant terms and merge adjacent terms '
+                     'before rendering, logging the terms and rules saved')
   _parser.add_option('-e', '--exp_info', type='int', action='store',
                      dest='exp_info', default=2,
                      help='Weeks in advance to notify that a term will expire')
+  _parser.add_option('-j', '--jobs', type='int', action='store',
+                     dest='jobs', default=1,
+                     help='Number of policy files to render in parallel')
+  _parser.add_option('-i', '--incremental', action='store_true',
+                     dest='incremental', default=False,
+                     help='Only render policies whose policy files, includes '
+                     'or referenced definitions changed since the last run')
+  _parser.add_option('--manifest', dest='manifest',
+                     help='dependency manifest used by --incremental '
+                     '(default: .aclgen_manifest in the output directory)')
 
   flags, unused_args = _parser.parse_args(command_line_args)
   return flags
 
 
-def load_and_render(base_dir, defs, shade_check, exp_info, output_dir):
+def load_and_render(base_dir, defs, shade_check, exp_info, output_dir,
+                    jobs=1, deps=None, merge_terms=False):
+  return render_policies(list(find_policy_files(base_dir)), defs, shade_check,
+                         exp_info, output_dir, jobs, deps, merge_terms)
+
+
+def render_policies(policy_files, defs, shade_check, exp_info, output_dir,
+                    jobs=1, deps=None, merge_terms=False):
+  """Render every policy in policy_files.
+
+  Given a manifest.Manifest in deps, policies whose filters are up to date
+  are skipped, and the filters of every rendered policy are recorded in it.
+
+  Returns:
+    the rendered filter count.
+  """
+  if deps:
+    out_of_date = [x for x in policy_files if not deps.UpToDate(x)]
+    print '%d policies up to date' % (len(policy_files) - len(out_of_date))
+    policy_files = out_of_date
+  if jobs > 1:
+    return render_parallel(policy_files, defs, shade_check, exp_info,
+                           output_dir, jobs, deps, merge_terms)
   rendered = 0
+  for fname in policy_files:
+    #logging.debug('attempting to render_filters on fname %s', fname)
+    filter_files = []
+
+    def output(fw, filter_file):
+      write_filter(fw, filter_file)
+      filter_files.append(filter_file)
+
+    rendered += render_filters(fname, defs, shade_check, exp_info, output_dir,
+                               output=output, merge_terms=merge_terms)
+    if deps:
+      deps.Record(fname, filter_files)
+  return rendered
+
+
+def find_policy_files(base_dir):
+  """Yield the .pol files under base_dir, in the order they are rendered."""
   for dirfile in dircache.listdir(base_dir):
     fname = os.path.join(base_dir, dirfile)
-    #logging.debug('load_and_render working with fname %s', fname)
     if os.path.isdir(fname):
-      rendered += load_and_render(fname, defs, shade_check, exp_info, output_dir)
+      for sub_fname in find_policy_files(fname):
+        yield sub_fname
     elif fname.endswith('.pol'):
-      #logging.debug('attempting to render_filters on fname %s', fname)
-      rendered += render_filters(fname, defs, shade_check, exp_info, output_dir)
-  return rendered
+      yield fname
+
+
+# Arguments shared by every policy rendered in a worker process, and the
+# rendered filters and log records of the policy currently being rendered.
+# See render_parallel().
+_WORKER_ARGS = None
+_WORKER_EVENTS = []
+
+
+class _WorkerLogHandler(logging.Handler):
+  """Keeps a worker's log records so the parent can replay them in order."""
+
+  def emit(self, record):
+    # args and exc_info may not survive pickling back to the parent.
+    record.msg = record.getMessage()
+    record.args = None
+    record.exc_info = None
+    _WORKER_EVENTS.append(record)
+
+
+def _init_worker(*args):
+  globals()['_WORKER_ARGS'] = args
+  root = logging.getLogger()
+  for handler in root.handlers[:]:
+    root.removeHandler(handler)
+  root.addHandler(_WorkerLogHandler())
+
+
+def _render_worker(source_file):
+  """Render source_file in a worker, returning the filters instead of writing.
+
+  Returns:
+    tuple of the list of (filter_text, filter_file) tuples and
+    logging.LogRecord objects, in the order they were produced, and the
+    exception rendering the policy failed with, or None.
+  """
+  definitions_obj, shade_check, exp_info, output_dir, merge_terms = (
+      _WORKER_ARGS)
+  del _WORKER_EVENTS[:]
+  try:
+    render_filters(source_file, definitions_obj, shade_check, exp_info,
+                   output_dir, output=lambda fw, filter_file: (
+                       _WORKER_EVENTS.append((str(fw), filter_file))),
+                   merge_terms=merge_terms)
+  except Exception as e:  # pylint: disable=broad-except
+    # what was rendered before the error is still written, like serially.
+    return list(_WORKER_EVENTS), e
+  return list(_WORKER_EVENTS), None
+
+
+def render_parallel(policy_files, definitions_obj, shade_check, exp_info,
+                    output_dir, jobs, deps=None, merge_terms=False):
+  """Render policy files across a pool of worker processes.
+
+  The workers are forked after the definitions are loaded, so they share the
+  parsed naming.Naming object with the parent rather than loading their own.
+  Rendered filters and log messages are handed back and written by the
+  parent in the same order as a serial run; an error in any policy is raised
+  here once all the policies before it, and the filters and log messages
+  of the policy up to the error, have been written.
+
+  Given a manifest.Manifest in deps, the filters of every rendered policy
+  are recorded in it.
+
+  Returns:
+    the rendered filter count.
+  """
+  # module level logging calls set up the root logger on first use, replayed
+  # records have to be given the same treatment.
+  if not logging.getLogger().handlers:
+    logging.basicConfig()
+  pool = multiprocessing.Pool(jobs, _init_worker,
+                              (definitions_obj, shade_check, exp_info,
+                               output_dir, merge_terms))
+  try:
+    count = 0
+    for index, (events, error) in enumerate(
+        pool.imap(_render_worker, policy_files)):
+      filter_files = []
+      for event in events:
+        if isinstance(event, logging.LogRecord):
+          logging.getLogger(event.name).handle(event)
+        else:
+          do_output_filter(*event)
+          filter_files.append(event[1])
+          count += 1
+      if error:
+        raise error
+      if deps:
+        deps.Record(policy_files[index], filter_files)
+    pool.close()
+    return count
+  finally:
+    pool.terminate()
+    pool.join()
 
 
 def filter_name(source, suffix, output_directory):
@@ -99,27 +250,84 @@ def filter_name(source, suffix, output_directory):
   return os.path.join(o_dir, fname)
 
 
-def do_output_filter(filter_text, filter_file):
+class RevisionTagWriter(object):
+  """File-like object replacing $Id:$ and $Date:$ tags as lines are written.
+
+  Lines are passed on to the underlying file as soon as they are complete,
+  so a filter can be written while it is rendered.
+  """
+
+  def __init__(self, output, fname):
+    self._output = output
+    self._fname = fname
+    self._timestamp = datetime.datetime.now().strftime('%Y/%m/%d')
+    # text written since the last newline.
+    self._partial = ''
+
+  def _Substitute(self, line):
+    # replace $Id:$ and $Date:$ tags with filename and date
+    if '$Id:$' in line:
+      line = line.replace('$Id:$', '$Id: %s $' % self._fname)
+    if '$Date:$' in line:
+      line = line.replace('$Date:$', '$Date: %s $' % self._timestamp)
+    return line
+
+  def write(self, text):
+    lines = text.split('\n')
+    lines[0] = self._partial + lines[0]
+    self._partial = lines.pop()
+    for line in lines:
+      self._output.write(self._Substitute(line))
+      self._output.write('\n')
+
+  def flush(self):
+    """Write out the last line, which has no newline to complete it."""
+    self._output.write(self._Substitute(self._partial))
+    self._partial = ''
+
+
+def open_filter(filter_file):
+  """Open filter_file for writing, creating its directory if needed."""
   if not os.path.isdir(os.path.dirname(filter_file)):
     os.makedirs(os.path.dirname(filter_file))
-  output = open(filter_file, 'w')
-  if output:
-    filter_text = revision_tag_handler(filter_file, filter_text)
-    print 'writing %s' % filter_file
-    output.write(filter_text)
+  return open(filter_file, 'w')
+
+
+def do_output_filter(filter_text, filter_file):
+  with open_filter(filter_file) as output:
+    writer = RevisionTagWriter(output, filter_file)
+    writer.write(filter_text)
+    writer.flush()
+  print 'writing %s' % filter_file
+
+
+def write_filter(fw, filter_file):
+  """Write the filters of a generator to filter_file as they are rendered.
+
+  They are rendered into a temporary file next to filter_file, which only
+  replaces it once the whole filter is rendered, so a generator failing
+  partway through leaves the previous filter in place.
+  """
+  temp_file = '%s.%d.tmp' % (filter_file, os.getpid())
+  try:
+    with open_filter(temp_file) as output:
+      writer = RevisionTagWriter(output, filter_file)
+      fw.Render(writer)
+      writer.flush()
+    os.rename(temp_file, filter_file)
+  finally:
+    # only left behind if rendering failed.
+    if os.path.exists(temp_file):
+      os.remove(temp_file)
+  print 'writing %s' % filter_file
 
 
 def revision_tag_handler(fname, text):
-  # replace $Id:$ and $Date:$ tags with filename and date
-  timestamp = datetime.datetime.now().strftime('%Y/%m/%d')
-  new_text = []
-  for line in text.split('\n'):
-    if '$Id:$' in line:
-      line = line.replace('$Id:$', '$Id: %s $' % fname)
-    if '$Date:$' in line:
-      line = line.replace('$Date:$', '$Date: %s $' % timestamp)
-    new_text.append(line)
-  return '\n'.join(new_text)
+  output = cStringIO.StringIO()
+  writer = RevisionTagWriter(output, fname)
+  writer.write(text)
+  writer.flush()
+  return output.getvalue()
 
 
 def get_policy_obj(source_file, definitions_obj, optimize, shade_check):
@@ -132,7 +340,8 @@ def get_policy_obj(source_file, definitions_obj, optimize, shade_check):
                                shade_check=shade_check)
 
 
-def render_filters(source_file, definitions_obj, shade_check, exp_info, output_dir):
+def render_filters(source_file, definitions_obj, shade_check, exp_info,
+                   output_dir, output=write_filter, merge_terms=False):
   """Render platform specfic filters for each target platform.
 
   For each target specified in each header of the policy, use that
@@ -140,8 +349,10 @@ def render_filters(source_file, definitions_obj, shade_check, exp_info, output_d
   own separate copy of the policy object and with optional, target
   specific attributes such as optimization and expiration attributes.
 
-  Output the rendered filters for each target platform.
-  Return the rendered filter count.
+  Output the filters for each target platform by calling
+  output(generator, filter_file), which renders them from the generator.
+  With merge_terms, redundant and adjacent terms are merged in each copy
+  before it is rendered.  Return the rendered filter count.
   """
 
   supported_targets = {
@@ -177,14 +388,23 @@ def render_filters(source_file, definitions_obj, shade_check, exp_info, output_d
       if not this_platform:
         continue
       optimized = this_platform['optimized']
-      # Copy Policy Obj.
-      pol = copy.deepcopy(get_policy_obj(source_file, definitions_obj,
-                                         optimized, shade_check))
+      # Copy Policy Obj, renderers modify the policy they are given.
+      pol = get_policy_obj(source_file, definitions_obj, optimized,
+                           shade_check).Copy()
+      if merge_terms:
+        for filter_header, terms, merged, rules, merged_rules in (
+            pol.MergeTerms()):
+          if target_platform in filter_header.platforms:
+            logging.info('INFO: merged %d terms into %d and %d rules into %d '
+                         'in filter %s for %s', terms, merged, rules,
+                         merged_rules,
+                         filter_header.FilterName(target_platform),
+                         target_platform)
       renderer = this_platform['renderer']
       # Render.
       fw = renderer(pol, exp_info)
       # Output.
-      do_output_filter(str(fw), filter_name(source_file, fw._SUFFIX, output_dir))
+      output(fw, filter_name(source_file, fw._SUFFIX, output_dir))
       # Count.
       count += 1
 
@@ -207,19 +427,37 @@ def main(args):
 
   if not FLAGS.definitions:
     _parser.error('no definitions supplied')
-  defs = naming.Naming(FLAGS.definitions)
+  defs = naming.Naming(FLAGS.definitions, snapshot=FLAGS.snapshot)
   if not defs:
     print 'problem loading definitions'
     return
 
-  count = 0
-  if FLAGS.policy_directory:
-    count = load_and_render(FLAGS.policy_directory, defs, FLAGS.shade_check,
-                            FLAGS.exp_info, FLAGS.output_directory)
+  deps = None
+  if FLAGS.incremental:
+    manifest_file = FLAGS.manifest or os.path.join(FLAGS.output_directory,
+                                                   '.aclgen_manifest')
+    if not os.path.isdir(os.path.dirname(manifest_file) or '.'):
+      os.makedirs(os.path.dirname(manifest_file))
+    deps = manifest.Manifest(manifest_file, defs,
+                             {'shade_check': FLAGS.shade_check,
+                              'exp_info': FLAGS.exp_info,
+                              'merge_terms': FLAGS.merge_terms})
 
-  elif FLAGS.policy:
-    count = render_filters(FLAGS.policy, defs, FLAGS.shade_check,
-                           FLAGS.exp_info, FLAGS.output_directory)
+  count = 0
+  try:
+    if FLAGS.policy_directory:
+      count = load_and_render(FLAGS.policy_directory, defs, FLAGS.shade_check,
+                              FLAGS.exp_info, FLAGS.output_directory,
+                              FLAGS.jobs, deps, FLAGS.merge_terms)
+
+    elif FLAGS.policy:
+      count = render_policies([FLAGS.policy], defs, FLAGS.shade_check,
+                              FLAGS.exp_info, FLAGS.output_directory,
+                              deps=deps, merge_terms=FLAGS.merge_terms)
+  finally:
+    # keep what was recorded for the policies rendered before any error.
+    if deps:
+      deps.Save()
 
   print '%d filters rendered' % count
 
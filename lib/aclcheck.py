@@ -19,12 +19,21 @@
 
 __author__ = 'watson@google.com (Tony Watson)'
 
+import bisect
+import collections
+import itertools
 import logging
+import multiprocessing
 import sys
 import nacaddr
 import policy
 import port
 
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
 
 class Error(Exception):
   """Base error class."""
@@ -42,6 +51,10 @@ class NoTargetError(Error):
   """Specified target platform not available in specified policy."""
 
 
+class NumpyMissingError(Error):
+  """NumPy was asked for but is not installed."""
+
+
 class AclCheck(object):
   """Check where hosts, ports and protocols match in a NAC policy.
 
@@ -58,6 +71,8 @@ class AclCheck(object):
       string, the destination port.
     proto:
       string, the protocol.
+    index:
+      AclIndex of pol, to look the terms up in rather than check each one.
 
   Returns:
     An AclCheck Object
@@ -76,44 +91,28 @@ class AclCheck(object):
                sport='any',
                dport='any',
                proto='any',
+               index=None,
               ):
 
     self.pol_obj = pol
     self.proto = proto
 
-    # validate source port
-    if sport == 'any':
-      self.sport = sport
-    else:
-      self.sport = port.Port(sport)
-
-    # validate destination port
-    if dport == 'any':
-      self.dport = dport
-    else:
-      self.dport = port.Port(dport)
+    # validate source and destination ports
+    self.sport = _Port(sport)
+    self.dport = _Port(dport)
 
-    # validate source address
-    if src == 'any':
-      self.src = src
-    else:
-      try:
-        self.src = nacaddr.IP(src)
-      except ValueError:
-        raise AddressError('bad source address: %s\n' % src)
-
-    # validate destination address
-    if dst == 'any':
-      self.dst = dst
-    else:
-      try:
-        self.dst = nacaddr.IP(dst)
-      except ValueError:
-        raise AddressError('bad destination address: %s\n' % dst)
+    # validate source and destination addresses
+    self.src = _Address(src, 'source')
+    self.dst = _Address(dst, 'destination')
 
     if type(self.pol_obj) is not policy.Policy:
       raise BadPolicy('Policy object is not valid.')
 
+    if index is not None:
+      self.matches, self.exact_matches = index.Lookup(
+          self.src, self.dst, self.sport, self.dport, self.proto)
+      return
+
     self.matches = []
     self.exact_matches = []
     for header, terms in self.pol_obj.filters:
@@ -169,6 +168,61 @@ class AclCheck(object):
                                           term.action, term.qos))
           break
 
+  @staticmethod
+  def EvaluateMany(pol, flows, index=None, jobs=1, chunk_size=10000):
+    """Check many flows against a policy, such as those of a flow log.
+
+    Flows are checked in chunks.  Each address, port and flow is parsed
+    and looked up once however often it repeats.  With several jobs, the
+    chunks are checked in as many worker processes.
+
+    Args:
+      pol: policy.Policy object
+      flows: iterable of (src, dst, sport, dport, proto) tuples of strings,
+        the arguments AclCheck takes.
+      index: AclIndex of pol, built from pol if not given.
+      jobs: integer, number of worker processes.
+      chunk_size: integer, number of flows in each chunk.
+
+    Yields:
+      (flow, exact match, possibles) tuples, in the order of flows.  The
+      exact match is the first term matching the flow exactly as a Match
+      object, or None, and possibles is the list of Match objects of the
+      terms which may match it.
+
+    Raises:
+      port.BarPortValue: An invalid source port is used
+      port.BadPortRange: A port is outside of the acceptable range 0-65535
+      AddressError: Incorrect ip address or format
+    """
+    if index is None:
+      index = AclIndex(pol)
+    chunks = _Chunks(flows, chunk_size)
+    if jobs <= 1:
+      cache = _FlowCache()
+      for chunk in chunks:
+        for result in _EvaluateChunk(index, chunk, cache):
+          yield result
+      return
+
+    # workers are forked with the index, and at most two chunks per worker
+    # are pending so the flows are read as they are checked.
+    pool = multiprocessing.Pool(jobs, _InitWorker, (index,))
+    try:
+      pending = collections.deque()
+      for chunk in chunks:
+        pending.append(pool.apply_async(_EvaluateWorker, (chunk,)))
+        if len(pending) >= 2 * jobs:
+          for result in pending.popleft().get():
+            yield result
+      while pending:
+        for result in pending.popleft().get():
+          yield result
+      pool.close()
+    finally:
+      pool.terminate()
+      pool.join()
+
   def Matches(self):
     """Return list of matched terms."""
     return self.matches
@@ -217,26 +271,7 @@ class AclCheck(object):
     return '\n'.join(text)
 
   def _PossibleMatch(self, term):
-    """Ignore some options and keywords that are edge cases.
-
-    Args:
-      term: term object to examine for edge-cases
-
-    Returns:
-      ret_str: a list of reasons this term may possible match
-    """
-    ret_str = []
-    if 'first-fragment' in term.option:
-      ret_str.append('first-frag')
-    if term.fragment_offset:
-      ret_str.append('frag-offset')
-    if term.packet_length:
-      ret_str.append('packet-length')
-    if 'established' in term.option:
-      ret_str.append('est')
-    if 'tcp-established' in term.option and 'tcp' in term.protocol:
-      ret_str.append('tcp-est')
-    return ret_str
+    return _PossibleMatch(term)
 
   def _AddrInside(self, addr, addresses):
     """Check if address is matched in another address or group of addresses.
@@ -273,6 +308,613 @@ class AclCheck(object):
     return False
 
 
+def _Port(value):
+  """Return a port given to AclCheck as an integer, or 'any'."""
+  if value == 'any':
+    return value
+  return port.Port(value)
+
+
+def _Address(value, direction):
+  """Return an address given to AclCheck as a nacaddr object, or 'any'."""
+  if value == 'any':
+    return value
+  try:
+    return nacaddr.IP(value)
+  except ValueError:
+    raise AddressError('bad %s address: %s\n' % (direction, value))
+
+
+def _Chunks(flows, chunk_size):
+  """Yield lists of chunk_size flows."""
+  flows = iter(flows)
+  while True:
+    chunk = list(itertools.islice(flows, chunk_size))
+    if not chunk:
+      return
+    yield chunk
+
+
+class _FlowCache(object):
+  """The parsed values and results of the flows checked so far.
+
+  Flow logs repeat the same hosts, ports and flows over and over.  Each
+  cache is emptied when it holds more than _FLOW_CACHE_SIZE entries.
+  """
+
+  def __init__(self):
+    self.addresses = {}
+    self.ports = {}
+    self.results = {}
+
+  def Trim(self):
+    for cache in (self.addresses, self.ports, self.results):
+      if len(cache) > _FLOW_CACHE_SIZE:
+        cache.clear()
+
+
+_FLOW_CACHE_SIZE = 100000
+
+
+def _EvaluateChunk(index, flows, cache):
+  """Check a list of flows with an AclIndex, see AclCheck.EvaluateMany."""
+  cache.Trim()
+  addresses = cache.addresses
+  ports = cache.ports
+  results = cache.results
+  rval = []
+  for flow in flows:
+    flow = tuple(flow)
+    result = results.get(flow)
+    if result is None:
+      src, dst, sport, dport, proto = flow
+      if src not in addresses:
+        addresses[src] = _Address(src, 'source')
+      if dst not in addresses:
+        addresses[dst] = _Address(dst, 'destination')
+      if sport not in ports:
+        ports[sport] = _Port(sport)
+      if dport not in ports:
+        ports[dport] = _Port(dport)
+      matches, exact_matches = index.Lookup(
+          addresses[src], addresses[dst], ports[sport], ports[dport], proto)
+      exact = None
+      if exact_matches:
+        exact = exact_matches[0]
+      result = (exact, [x for x in matches if x.possibles])
+      results[flow] = result
+    rval.append((flow, result[0], result[1]))
+  return rval
+
+
+# The AclIndex of the policy checked by a worker process and its
+# _FlowCache, see AclCheck.EvaluateMany().
+_WORKER_INDEX = None
+_WORKER_CACHE = None
+
+
+def _InitWorker(index):
+  globals()['_WORKER_INDEX'] = index
+  globals()['_WORKER_CACHE'] = _FlowCache()
+
+
+def _EvaluateWorker(flows):
+  return _EvaluateChunk(_WORKER_INDEX, flows, _WORKER_CACHE)
+
+
+def _PossibleMatch(term):
+  """Ignore some options and keywords that are edge cases.
+
+  Args:
+    term: term object to examine for edge-cases
+
+  Returns:
+    ret_str: a list of reasons this term may possible match
+  """
+  ret_str = []
+  if 'first-fragment' in term.option:
+    ret_str.append('first-frag')
+  if term.fragment_offset:
+    ret_str.append('frag-offset')
+  if term.packet_length:
+    ret_str.append('packet-length')
+  if 'established' in term.option:
+    ret_str.append('est')
+  if 'tcp-established' in term.option and 'tcp' in term.protocol:
+    ret_str.append('tcp-est')
+  return ret_str
+
+
+class AclIndex(object):
+  """The terms of a policy, indexed to answer many AclCheck queries.
+
+  Each filter is indexed on every field a query matches on.  A value of a
+  field maps to the set of terms it matches, as an integer with one bit
+  per term.  A query intersects the sets of its values, then visits the
+  terms left in order, as AclCheck visits every term, so it finds the same
+  matches.
+
+  Args:
+    pol: policy.Policy object
+
+  Raises:
+    BadPolicy: pol is not a policy.Policy object
+  """
+
+  def __init__(self, pol):
+    if type(pol) is not policy.Policy:
+      raise BadPolicy('Policy object is not valid.')
+    self.filters = [_FilterIndex(header.target[0].options[0], terms)
+                    for header, terms in pol.filters]
+
+  def Lookup(self, src, dst, sport, dport, proto):
+    """Find the terms matching a query.
+
+    Args:
+      src: nacaddr object or 'any', the source address.
+      dst: nacaddr object or 'any', the destination address.
+      sport: integer or 'any', the source port.
+      dport: integer or 'any', the destination port.
+      proto: string, the protocol.
+
+    Returns:
+      tuple of the list of matched terms and the list of exactly matched
+      terms, as Match objects.
+    """
+    matches = []
+    exact_matches = []
+    for filter_index in self.filters:
+      filter_index.Lookup(src, dst, sport, dport, proto, matches,
+                          exact_matches)
+    return matches, exact_matches
+
+
+class _FilterIndex(object):
+  """The terms of a filter, indexed by the values they match."""
+
+  def __init__(self, filtername, terms):
+    # (match, exact match) of each term, the exact match is None for terms
+    # with possibles or action next.  Terms without an action (verbatim)
+    # never match and are left out.
+    self.terms = []
+    self.src = _AddressIndex()
+    self.dst = _AddressIndex()
+    self.sport = _PortIndex()
+    self.dport = _PortIndex()
+    # protocol -> terms matching it, and terms matching any protocol.
+    self.protocols = {}
+    self.any_protocol = 0
+    # protocol -> terms excepting it.
+    self.protocol_except = {}
+
+    for term in terms:
+      if not term.action:
+        continue
+      bit = 1 << len(self.terms)
+      possible = _PossibleMatch(term)
+      exact = None
+      if not possible and 'next' not in term.action:
+        exact = Match(filtername, term.name, [], term.action, term.qos)
+      self.terms.append((Match(filtername, term.name, possible, term.action,
+                               term.qos), exact))
+      self.src.Add(term.source_address, bit)
+      self.dst.Add(term.destination_address, bit)
+      self.sport.Add(term.source_port, bit)
+      self.dport.Add(term.destination_port, bit)
+      if not term.protocol:
+        self.any_protocol |= bit
+      for proto in term.protocol:
+        self.protocols[proto] = self.protocols.get(proto, 0) | bit
+      for proto in term.protocol_except:
+        self.protocol_except[proto] = self.protocol_except.get(proto, 0) | bit
+
+    self.all = (1 << len(self.terms)) - 1
+    for index in (self.src, self.dst, self.sport, self.dport):
+      index.Build()
+
+  def Lookup(self, src, dst, sport, dport, proto, matches, exact_matches):
+    """Append the matches of a query to matches and exact_matches."""
+    candidates = self.all
+    if proto != 'any':
+      candidates &= self.any_protocol | self.protocols.get(proto, 0)
+    candidates &= ~self.protocol_except.get(proto, 0)
+    candidates &= self.sport.Lookup(sport) & self.dport.Lookup(dport)
+    if candidates:
+      candidates &= self.src.Lookup(src) & self.dst.Lookup(dst)
+    while candidates:
+      lowest = candidates & -candidates
+      candidates ^= lowest
+      match, exact = self.terms[lowest.bit_length() - 1]
+      matches.append(match)
+      if exact:
+        # later terms are never reached.
+        exact_matches.append(exact)
+        break
+
+
+class _AddressIndex(object):
+  """The terms matching each address, by prefix trie."""
+
+  def __init__(self):
+    # terms matching any address.
+    self.any = 0
+    # address -> terms matching it.
+    self._terms = {}
+    self._trie = None
+
+  def Add(self, addresses, bit):
+    if not addresses:
+      self.any |= bit
+    for addr in addresses:
+      self._terms[addr] = self._terms.get(addr, 0) | bit
+
+  def Build(self):
+    self._trie = nacaddr.PrefixTrie()
+    for addr, terms in self._terms.iteritems():
+      self._trie.Insert(addr, terms)
+
+  def Lookup(self, addr):
+    if isinstance(addr, basestring):
+      return -1
+    terms = self.any
+    for next in self._trie.Containing(addr):
+      terms |= next
+    return terms
+
+
+class _PortIndex(object):
+  """The terms matching each port, by the port ranges they start at."""
+
+  def __init__(self):
+    # terms matching any port.
+    self.any = 0
+    self._ranges = []
+    # first port of each range of ports matched by the same terms, and the
+    # terms matching it.
+    self._starts = []
+    self._terms = []
+
+  def Add(self, ports, bit):
+    if not ports:
+      self.any |= bit
+    for low, high in ports:
+      self._ranges.append((low, high, bit))
+
+  def Build(self):
+    # the terms matching each port change where a range starts or ends.
+    changes = {}
+    for low, high, bit in self._ranges:
+      changes.setdefault(low, []).append((bit, 1))
+      changes.setdefault(high + 1, []).append((bit, -1))
+    # a term can match overlapping ranges, count them.
+    counts = {}
+    terms = 0
+    for start in sorted(changes):
+      for bit, change in changes[start]:
+        counts[bit] = counts.get(bit, 0) + change
+        if counts[bit]:
+          terms |= bit
+        else:
+          terms &= ~bit
+      self._starts.append(start)
+      self._terms.append(terms)
+
+  def Lookup(self, port):
+    if isinstance(port, basestring):
+      return -1
+    index = bisect.bisect_right(self._starts, port) - 1
+    if index < 0:
+      return self.any
+    return self.any | self._terms[index]
+
+
+class FlowClassifier(object):
+  """Find the term of each filter that flows hit, for many flows at once.
+
+  A flow hits the first term of a filter that matches its addresses, ports
+  and protocol and has an action other than next.  Terms with action next
+  that match are passed through on the way.  Addresses are matched less
+  their excludes.  Unlike AclCheck, which reports the terms with options
+  as possible matches, options, icmp types and the other fields a flow
+  says nothing about are not checked.
+
+  With NumPy, the ranges of addresses and ports each filter matches are
+  encoded as arrays, and batches of flows are compared with all of them at
+  once.  Without it, flows are checked one term at a time, with the same
+  results.
+
+  Args:
+    pol: policy.Policy object
+    use_numpy: bool, whether to use NumPy.  By default it is used if it is
+      installed.
+
+  Raises:
+    BadPolicy: pol is not a policy.Policy object
+    NumpyMissingError: use_numpy is True but NumPy is not installed.
+  """
+
+  # flows compared with the arrays of a filter at once.
+  _BATCH_SIZE = 1024
+
+  def __init__(self, pol, use_numpy=None):
+    if type(pol) is not policy.Policy:
+      raise BadPolicy('Policy object is not valid.')
+    if use_numpy is None:
+      use_numpy = numpy is not None
+    if use_numpy and numpy is None:
+      raise NumpyMissingError('NumPy is not installed.')
+    self.use_numpy = use_numpy
+    self.filters = [_FilterRanges(header.target[0].options[0], terms)
+                    for header, terms in pol.filters]
+    if use_numpy:
+      for filter_ranges in self.filters:
+        filter_ranges.BuildArrays()
+
+  def Classify(self, flows):
+    """Find the term of each filter each flow hits.
+
+    Args:
+      flows: iterable of (src, dst, sport, dport, proto) tuples of strings.
+        Addresses are of hosts and ports are numbers.
+
+    Returns:
+      list with a list for each filter, of the index of the term each flow
+      hits in the terms of the filter, or -1 for none.
+
+    Raises:
+      port.BarPortValue: An invalid source port is used
+      port.BadPortRange: A port is outside of the acceptable range 0-65535
+      AddressError: Incorrect ip address or format
+    """
+    return [x[0] for x in self._Evaluate(flows)]
+
+  def HitCounts(self, flows):
+    """Count the flows matching each term, terms with no hits are dead.
+
+    The flows passing through a term with action next count as its hits.
+
+    Args:
+      flows: iterable of (src, dst, sport, dport, proto) tuples of strings.
+
+    Returns:
+      list of (filter name, term name, hit count) tuples, for every term
+      of every filter in order.
+    """
+    rval = []
+    for filter_ranges, (_, counts) in zip(self.filters,
+                                          self._Evaluate(flows)):
+      for name, count in zip(filter_ranges.names, counts):
+        rval.append((filter_ranges.filtername, name, count))
+    return rval
+
+  def _Evaluate(self, flows):
+    """Return (hit term indexes, term hit counts) lists for each filter."""
+    cache = _FlowCache()
+    rval = [([], [0] * len(x.names)) for x in self.filters]
+    for batch in _Chunks(flows, self._BATCH_SIZE):
+      cache.Trim()
+      encoded = [_EncodeFlow(x, cache) for x in batch]
+      for filter_ranges, (hits, counts) in zip(self.filters, rval):
+        if self.use_numpy:
+          batch_hits, batch_counts = filter_ranges.EvaluateArrays(encoded)
+        else:
+          batch_hits, batch_counts = filter_ranges.Evaluate(encoded)
+        hits.extend(batch_hits)
+        for index, count in enumerate(batch_counts):
+          counts[index] += count
+    return rval
+
+
+def _EncodeFlow(flow, cache):
+  """Return the (src, dst, sport, dport, proto) of a flow as integers.
+
+  Addresses are offset like the address ranges of policy.Term, IPv6 ones
+  by 2**128, the protocol stays a string.
+  """
+  src, dst, sport, dport, proto = flow
+  addresses = cache.addresses
+  ports = cache.ports
+  for addr, direction in ((src, 'source'), (dst, 'destination')):
+    if addr not in addresses:
+      parsed = _Address(addr, direction)
+      if isinstance(parsed, basestring):
+        raise AddressError('bad %s address: %s\n' % (direction, addr))
+      addresses[addr] = parsed._ip + (parsed._version == 6 and
+                                      policy._IPV6_OFFSET)
+  for value in (sport, dport):
+    if value not in ports:
+      ports[value] = port.Port(value)
+  return (addresses[src], addresses[dst], ports[sport], ports[dport], proto)
+
+
+class _FilterRanges(object):
+  """The ranges of addresses, ports and protocols each term of a filter
+  matches, see FlowClassifier."""
+
+  # match conditions, the attribute of policy.Term constraining it and that
+  # of its ranges.
+  _CONDITIONS = (('src', 'source_address', 'source_address_ranges'),
+                 ('dst', 'destination_address', 'destination_address_ranges'),
+                 ('addr', 'address', 'address_ranges'),
+                 ('sport', 'source_port', 'source_port_ranges'),
+                 ('dport', 'destination_port', 'destination_port_ranges'),
+                 ('port', 'port', 'port_ranges'))
+
+  def __init__(self, filtername, terms):
+    self.filtername = filtername
+    self.names = [x.name for x in terms]
+    # terms without an action (verbatim) never match.
+    self.active = [bool(x.action) for x in terms]
+    self.passed = ['next' in x.action for x in terms]
+    # condition -> ranges of each term, None for a term matching anything.
+    self.ranges = {}
+    for condition, attribute, ranges in self._CONDITIONS:
+      self.ranges[condition] = [
+          getattr(x, ranges) if getattr(x, attribute) else None
+          for x in terms]
+    self.protocols = [set(x.protocol) for x in terms]
+    self.protocol_except = [set(x.protocol_except) for x in terms]
+    self.arrays = None
+
+  @staticmethod
+  def _InRanges(ranges, value):
+    if ranges is None:
+      return True
+    index = bisect.bisect_right(ranges, (value, _MAX_RANGE_END)) - 1
+    return index >= 0 and ranges[index][1] >= value
+
+  def _Matches(self, index, flow):
+    """Whether the term at index of the filter matches an encoded flow."""
+    src, dst, sport, dport, proto = flow
+    ranges = self.ranges
+    if not self.active[index]:
+      return False
+    if self.protocols[index] and proto not in self.protocols[index]:
+      return False
+    if proto in self.protocol_except[index]:
+      return False
+    address = ranges['addr'][index]
+    any_port = ranges['port'][index]
+    return (self._InRanges(ranges['src'][index], src) and
+            self._InRanges(ranges['dst'][index], dst) and
+            (self._InRanges(address, src) or self._InRanges(address, dst)) and
+            self._InRanges(ranges['sport'][index], sport) and
+            self._InRanges(ranges['dport'][index], dport) and
+            (self._InRanges(any_port, sport) or
+             self._InRanges(any_port, dport)))
+
+  def Evaluate(self, flows):
+    """Return the hit term indexes and term hit counts of encoded flows."""
+    hits = []
+    counts = [0] * len(self.names)
+    for flow in flows:
+      hit = -1
+      for index in xrange(len(self.names)):
+        if self._Matches(index, flow):
+          counts[index] += 1
+          if not self.passed[index]:
+            hit = index
+            break
+      hits.append(hit)
+    return hits, counts
+
+  def BuildArrays(self):
+    """Encode the ranges of the terms as arrays for EvaluateArrays."""
+    self.arrays = {}
+    for condition, _, _ in self._CONDITIONS:
+      self.arrays[condition] = _RangeArrays(self.ranges[condition])
+    # the protocols of the filter, any other protocol gets the last column.
+    protocols = sorted(set().union(*(self.protocols + self.protocol_except)))
+    self.protocol_ids = dict((x, i) for i, x in enumerate(protocols))
+    protocol_matches = numpy.zeros((len(protocols) + 1, len(self.names)),
+                                   dtype=bool)
+    for index in xrange(len(self.names)):
+      if not self.protocols[index]:
+        protocol_matches[:, index] = True
+      for proto in self.protocols[index]:
+        protocol_matches[self.protocol_ids[proto], index] = True
+      for proto in self.protocol_except[index]:
+        protocol_matches[self.protocol_ids[proto], index] = False
+    self.protocol_matches = protocol_matches
+    self.active_array = numpy.array(self.active, dtype=bool)
+    self.passed_array = numpy.array(self.passed, dtype=bool)
+
+  def EvaluateArrays(self, flows):
+    """Evaluate with NumPy, giving the same results as Evaluate."""
+    num_terms = len(self.names)
+    if not num_terms:
+      return [-1] * len(flows), []
+    src, dst, sport, dport, proto = zip(*flows)
+    arrays = self.arrays
+    other_protocol = len(self.protocol_ids)
+    protocol_ids = numpy.array([self.protocol_ids.get(x, other_protocol)
+                                for x in proto])
+
+    # flows by terms.
+    matches = self.protocol_matches[protocol_ids] & self.active_array
+    matches &= arrays['src'].Contain(src)
+    matches &= arrays['dst'].Contain(dst)
+    matches &= arrays['addr'].Contain(src) | arrays['addr'].Contain(dst)
+    matches &= arrays['sport'].Contain(sport)
+    matches &= arrays['dport'].Contain(dport)
+    matches &= arrays['port'].Contain(sport) | arrays['port'].Contain(dport)
+
+    # the first match which is not passed through.
+    hit_matches = matches & ~self.passed_array
+    has_hit = hit_matches.any(axis=1)
+    first = hit_matches.argmax(axis=1)
+    hits = numpy.where(has_hit, first, -1)
+    counts = numpy.bincount(first[has_hit], minlength=num_terms)
+    if self.passed_array.any():
+      # the passed through terms matched before it.
+      before = (numpy.arange(num_terms) <
+                numpy.where(has_hit, first, num_terms)[:, numpy.newaxis])
+      counts += (matches & self.passed_array & before).sum(axis=0)
+    return hits.tolist(), counts.tolist()
+
+
+# larger than the last address or port of any range.
+_MAX_RANGE_END = 1 << 130
+
+
+class _RangeArrays(object):
+  """The ranges of one match condition of the terms of a filter as arrays.
+
+  Addresses don't fit in 64 bit integers, so values are replaced by their
+  rank among the bounds of the ranges: a range contains a value when the
+  value ranks between its first and the one after its last.  Ranges are
+  the columns, in the order of the terms.  Every term has at least one, so
+  that the columns of a term start where the previous term's end: terms
+  matching anything, or nothing at all, get a range matching nothing.
+  """
+
+  def __init__(self, term_ranges):
+    self.any = numpy.array([x is None for x in term_ranges], dtype=bool)
+    self.all_any = bool(self.any.all())
+    bounds = set()
+    for ranges in term_ranges:
+      for first, last in ranges or ():
+        bounds.update((first, last + 1))
+    self.bounds = sorted(bounds)
+    self.starts = []
+    firsts = []
+    ends = []
+    for ranges in term_ranges:
+      self.starts.append(len(firsts))
+      if not ranges:
+        # matches nothing, no rank is at least 1 and below 0.
+        firsts.append(1)
+        ends.append(0)
+        continue
+      for first, last in ranges:
+        firsts.append(self.Rank(first))
+        ends.append(self.Rank(last + 1))
+    self.one_each = len(firsts) == len(term_ranges)
+    self.firsts = numpy.array(firsts, dtype=numpy.int32)
+    self.ends = numpy.array(ends, dtype=numpy.int32)
+
+  def Rank(self, value):
+    return bisect.bisect_right(self.bounds, value)
+
+  def Contain(self, values):
+    """Return a flows by terms array of whether each term matches each value.
+
+    Args:
+      values: list of integer addresses or ports of the flows.
+
+    Returns:
+      bool array, or True when every term matches anything.
+    """
+    if self.all_any:
+      return True
+    ranks = numpy.array([self.Rank(x) for x in values],
+                        dtype=numpy.int32)[:, numpy.newaxis]
+    inside = (ranks >= self.firsts) & (ranks < self.ends)
+    if not self.one_each:
+      inside = numpy.logical_or.reduceat(inside, self.starts, axis=1)
+    return inside | self.any
+
+
 class Match(object):
   """A matching term and its associate values."""
 
@@ -0,0 +1,375 @@
+#!/usr/bin/python
+#
+# Copyright 2011 Google Inc. All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Answer aclcheck queries over local HTTP from policies parsed only once.
+
+A PolicyStore keeps the definitions and every policy under a directory
+parsed, along with the aclcheck.AclIndex of each policy, and reloads only
+what changed when the mtimes of their files do.  A Server answers queries
+from it, each request in a thread of its own:
+
+    GET /check?src=10.1.1.1&dst=200.1.1.1&dport=80&proto=tcp
+    GET /check?dst=200.1.1.1&policy=sample.pol
+    GET /status
+
+Replies are JSON.  /check maps each policy file queried, relative to the
+policy directory, to its matches and to the text aclcheck_cmdline.py
+prints for them.
+
+Sample usage:
+    store = PolicyStore('./def', './policies')
+    Server(store, ('localhost', 8080)).ServeForever()
+"""
+
+import BaseHTTPServer
+import glob
+import json
+import logging
+import os
+import SocketServer
+import threading
+import urlparse
+
+import aclcheck
+import manifest
+import naming
+import policy
+import port
+
+
+class Error(Exception):
+  """Base error class."""
+
+
+class UnknownPolicyError(Error):
+  """No policy loaded matches the policy queried."""
+
+
+# errors of a policy or of the definitions which keep the previous version
+# of them loaded.
+_LOAD_ERRORS = (policy.Error, naming.Error, IOError, ValueError)
+
+# query parameters passed on to aclcheck.AclCheck.
+_CHECK_PARAMETERS = ('src', 'dst', 'sport', 'dport', 'proto')
+
+
+def _Mtimes(filenames):
+  """Return a dict of the mtime of each file, None for missing files."""
+  rval = {}
+  for filename in filenames:
+    try:
+      rval[filename] = os.stat(filename).st_mtime
+    except OSError:
+      rval[filename] = None
+  return rval
+
+
+def _PolicyFiles(policy_dir):
+  """Yield the .pol files under policy_dir."""
+  for dirpath, dirnames, filenames in os.walk(policy_dir):
+    dirnames.sort()
+    for filename in sorted(filenames):
+      if filename.endswith('.pol'):
+        yield os.path.join(dirpath, filename)
+
+
+class _Sources(object):
+  """The files and tokens a policy is loaded from, at its last load.
+
+  Kept for the policies which failed to load too, so that they are only
+  loaded again once one of them changes.
+
+  Attributes:
+    mtimes: dict of the mtimes of the policy file and its includes.
+    networks: dict of the digest of each network token it references.
+    services: dict of the digest of each service token it references.
+    error: string, the error of loading the policy, if it failed.
+  """
+
+  def __init__(self, filename, tokens):
+    self.error = None
+    self.networks = {}
+    self.services = {}
+    includes = []
+    try:
+      deps = policy.Dependencies(open(filename).read(), includes=includes)
+    except _LOAD_ERRORS as e:
+      # the tokens are unknown until the files read so far change.
+      self.error = str(e)
+    else:
+      self.networks = dict((x, tokens.NetworkDigest(x))
+                           for x in deps.networks)
+      self.services = dict((x, tokens.ServiceDigest(x))
+                           for x in deps.services)
+    # taken before parsing, a file changing meanwhile is loaded again.
+    self.mtimes = _Mtimes([filename] + includes)
+
+  def Changed(self, tokens):
+    """Check if a file or token the policy was parsed from changed.
+
+    Args:
+      tokens: manifest.TokenDigests of the current definitions, or None if
+        the definitions are the ones the policy was parsed with.
+    """
+    if _Mtimes(self.mtimes) != self.mtimes:
+      return True
+    if tokens is None:
+      return False
+    for token, digest in self.networks.iteritems():
+      if tokens.NetworkDigest(token) != digest:
+        return True
+    for token, digest in self.services.iteritems():
+      if tokens.ServiceDigest(token) != digest:
+        return True
+    return False
+
+
+class _LoadedPolicy(object):
+  """A parsed policy and its index.
+
+  Attributes:
+    policy: policy.Policy object.
+    index: aclcheck.AclIndex of policy.
+  """
+
+  def __init__(self, filename, definitions):
+    self.policy = policy.ParseFile(filename, definitions)
+    self.index = aclcheck.AclIndex(self.policy)
+
+
+class PolicyStore(object):
+  """The definitions and policies under a directory, kept up to date.
+
+  Refresh() reloads the definitions when the mtime of one of their files
+  changed, and the policies whose files or includes changed, or which
+  reference a network or service whose value changed with the definitions.
+  Policies and definitions which fail to load keep their previous version,
+  the error is kept in errors, and they are only loaded again once what
+  they are loaded from changes.
+
+  The loaded policies are replaced as a whole, never modified, so queries
+  can be answered from any thread while Refresh() runs in another.
+
+  Args:
+    definitions_dir: directory of the .net and .svc definitions.
+    policy_dir: directory the .pol files are found under.
+    snapshot: file to load the definitions from, see naming.Naming.
+
+  Raises:
+    naming.Error: the definitions can't be loaded.
+  """
+
+  def __init__(self, definitions_dir, policy_dir, snapshot=None):
+    self.definitions_dir = definitions_dir
+    self.policy_dir = policy_dir
+    self.snapshot = snapshot
+    self.definitions = None
+    self._definition_mtimes = None
+    # error of the last load of the definitions, if it failed.
+    self._definitions_error = None
+    # policy file, relative to policy_dir -> _LoadedPolicy
+    self.policies = {}
+    # policy file, relative to policy_dir -> _Sources of its last load.
+    self._sources = {}
+    # policy file or definitions directory -> error of its last load.
+    self.errors = {}
+    self._lock = threading.Lock()
+    self.Refresh()
+
+  def _DefinitionFiles(self):
+    return sorted(glob.glob(os.path.join(self.definitions_dir, '*.net')) +
+                  glob.glob(os.path.join(self.definitions_dir, '*.svc')))
+
+  def Refresh(self):
+    """Reload the definitions and the policies which changed.
+
+    Returns:
+      sorted list of the policy files loaded, relative to policy_dir.
+    """
+    with self._lock:
+      errors = {}
+      definitions = self.definitions
+      definition_mtimes = _Mtimes(self._DefinitionFiles())
+      if definition_mtimes != self._definition_mtimes:
+        self._definitions_error = None
+        try:
+          definitions = naming.Naming(self.definitions_dir,
+                                      snapshot=self.snapshot)
+        except naming.Error as e:
+          if self.definitions is None:
+            raise
+          logging.warn('unable to reload definitions %s: %s',
+                       self.definitions_dir, e)
+          self._definitions_error = str(e)
+      if self._definitions_error:
+        errors[self.definitions_dir] = self._definitions_error
+      tokens = manifest.TokenDigests(definitions)
+      changed_tokens = None
+      if definitions is not self.definitions:
+        changed_tokens = tokens
+
+      policies = {}
+      all_sources = {}
+      loaded = []
+      for filename in _PolicyFiles(self.policy_dir):
+        name = os.path.relpath(filename, self.policy_dir)
+        previous = self.policies.get(name)
+        if previous:
+          policies[name] = previous
+        sources = self._sources.get(name)
+        if sources is None or sources.Changed(changed_tokens):
+          sources = _Sources(filename, tokens)
+          if not sources.error:
+            try:
+              policies[name] = _LoadedPolicy(filename, definitions)
+              loaded.append(name)
+            except _LOAD_ERRORS as e:
+              sources.error = str(e)
+          if sources.error:
+            logging.warn('unable to load policy %s: %s', filename,
+                         sources.error)
+        all_sources[name] = sources
+        if sources.error:
+          errors[name] = sources.error
+
+      self.definitions = definitions
+      self._definition_mtimes = definition_mtimes
+      self._sources = all_sources
+      self.policies = policies
+      self.errors = errors
+      return loaded
+
+  def Check(self, policy_name=None, **kwargs):
+    """Check where a packet matches in the policies.
+
+    Args:
+      policy_name: policy file to check, relative to policy_dir or ending
+        with that, or None for every policy.
+      **kwargs: src, dst, sport, dport and proto, see aclcheck.AclCheck.
+
+    Returns:
+      dict of the aclcheck.AclCheck of each policy file checked.
+
+    Raises:
+      UnknownPolicyError: no policy is named policy_name.
+      aclcheck.AddressError, port.BadPortValue, port.BadPortRange: bad
+        addresses or ports.
+    """
+    policies = self.policies
+    if policy_name is not None:
+      wanted = os.path.normpath(policy_name)
+      policies = dict((name, x) for name, x in policies.iteritems()
+                      if wanted == name or
+                      wanted.endswith(os.sep + name))
+      if not policies:
+        raise UnknownPolicyError('no policy %s loaded' % policy_name)
+    return dict((name, aclcheck.AclCheck(x.policy, index=x.index, **kwargs))
+                for name, x in policies.iteritems())
+
+
+def CheckReply(checks):
+  """Return the JSON reply to a query from the results of PolicyStore.Check."""
+  reply = {}
+  for name, check in checks.iteritems():
+    # the exact matches are Match objects of their own.
+    exact = set((x.filter, x.term) for x in check.ExactMatches())
+    reply[name] = {
+        'matches': [{'filter': x.filter, 'term': x.term, 'action': x.action,
+                     'possibles': x.possibles, 'qos': x.qos,
+                     'exact': (x.filter, x.term) in exact}
+                    for x in check.Matches()],
+        'text': str(check),
+    }
+  return reply
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Answers the queries of one connection."""
+
+  def do_GET(self):
+    url = urlparse.urlparse(self.path)
+    params = dict((k, v[-1]) for k, v in urlparse.parse_qs(url.query).items())
+    store = self.server.store
+    if url.path == '/check':
+      kwargs = dict((x, params[x]) for x in _CHECK_PARAMETERS if x in params)
+      try:
+        checks = store.Check(params.get('policy'), **kwargs)
+      except UnknownPolicyError as e:
+        return self._Reply(404, {'error': str(e)})
+      except (aclcheck.Error, port.Error) as e:
+        return self._Reply(400, {'error': str(e).strip()})
+      return self._Reply(200, CheckReply(checks))
+    if url.path == '/status':
+      return self._Reply(200, {'policies': sorted(store.policies),
+                               'errors': store.errors})
+    self._Reply(404, {'error': 'unknown path %s' % url.path})
+
+  def _Reply(self, code, body):
+    text = json.dumps(body, sort_keys=True)
+    self.send_response(code)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(text)))
+    self.end_headers()
+    self.wfile.write(text)
+
+  def log_message(self, fmt, *args):
+    logging.debug('%s %s', self.address_string(), fmt % args)
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  """HTTP server answering the queries of a PolicyStore.
+
+  Each request is answered in a thread of its own.  ServeForever() also
+  refreshes the store every interval seconds from another thread.
+
+  Args:
+    store: PolicyStore object.
+    address: (host, port) tuple to listen on, port 0 picks a free port.
+    interval: seconds between the checks for changed files.
+  """
+
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def __init__(self, store, address=('localhost', 8080), interval=1.0):
+    BaseHTTPServer.HTTPServer.__init__(self, address, _Handler)
+    self.store = store
+    self.interval = interval
+    self._stopped = threading.Event()
+
+  def _Watch(self):
+    while not self._stopped.wait(self.interval):
+      try:
+        loaded = self.store.Refresh()
+      except Exception as e:  # pylint: disable=broad-except
+        # keep answering from what is loaded.
+        logging.exception('refreshing policies failed: %s', e)
+        continue
+      if loaded:
+        logging.info('reloaded %s', ', '.join(loaded))
+
+  def ServeForever(self):
+    """Answer queries, and reload changed files, until Shutdown()."""
+    watcher = threading.Thread(target=self._Watch)
+    watcher.daemon = True
+    watcher.start()
+    self.serve_forever()
+
+  def Shutdown(self):
+    self._stopped.set()
+    self.shutdown()
+    self.server_close()
@@ -17,7 +17,8 @@
 
 """ACL Generator base class."""
 
-import copy
+import cStringIO
+import hashlib
 import re
 from string import Template
 
@@ -294,7 +295,9 @@ class ACLGenerator(object):
           for el, val in term.__dict__.items():
             # Private attributes do not need to be valid keywords.
             if (val and el not in self._valid_keywords
-                and not el.startswith('flatten')):
+                and not el.startswith('flatten')
+                and not el.endswith('_ranges')
+                and not el.endswith('_tokens')):
               err.append(el)
           if err:
             raise UnsupportedFilterError(
@@ -311,6 +314,26 @@ class ACLGenerator(object):
     """Translate policy contents to platform specific data structures."""
     raise Error('%s does not implement _TranslatePolicies()' % self._PLATFORM)
 
+  def __str__(self):
+    stream = cStringIO.StringIO()
+    self.Render(stream)
+    return stream.getvalue()
+
+  def Render(self, stream):
+    """Write the rendered filters to a file-like object.
+
+    Generators which override Render write their output as it is rendered,
+    rather than building all of it in memory first, and get __str__ from
+    here.  Generators which still override __str__ write it all at once.
+
+    Args:
+      stream: file-like object to write to.
+    """
+    # unbound methods are new objects on each access, their functions aren't.
+    if type(self).__str__.im_func is ACLGenerator.__str__.im_func:
+      raise Error('%s does not implement Render()' % self._PLATFORM)
+    stream.write(str(self))
+
   def FixHighPorts(self, term, af='inet', all_protocols_stateful=False):
     """Evaluate protocol and ports of term, return sane version of term."""
     mod = term
@@ -339,7 +362,7 @@ class ACLGenerator(object):
         unstateful_protocols = protocols.difference(set(('tcp', 'udp')))
         if not unstateful_protocols:
           # TCP/UDP: add in high ports then collapse to eliminate overlaps.
-          mod = copy.deepcopy(term)
+          mod = term.Copy()
           mod.destination_port.append((1024, 65535))
           mod.destination_port = mod.CollapsePortList(mod.destination_port)
         elif not all_protocols_stateful:
@@ -388,6 +411,47 @@ class ACLGenerator(object):
                                 len(new_term)))
 
 
+class AddressTable(object):
+  """The address lists of a policy, interned by a digest of their contents.
+
+  For generators which define a list of addresses once and refer to it by
+  name, such as ipset sets or juniper prefix lists.  Terms with the same
+  addresses in the same address family share one list, named after the
+  first term to use it.
+  """
+
+  def __init__(self):
+    # list name -> (address family, address list), in order of creation.
+    self.names = []
+    self.lists = {}
+    # digest of address family and addresses -> list name.
+    self._digests = {}
+
+  def Intern(self, name, af, addr_list, rename):
+    """Returns the name of the list holding addr_list.
+
+    Args:
+      name: name for the list if there is none holding addr_list yet, or
+        None to name it with rename.
+      af: address family of the list.
+      addr_list: collapsed address list.
+      rename: function returning another name for the list from a digest
+        of its contents, for when name is None or taken by a different list.
+
+    Returns:
+      name of the list.
+    """
+    digest = hashlib.sha1('%s %s' % (af, ' '.join(
+        str(x) for x in addr_list))).hexdigest()
+    if digest not in self._digests:
+      if name is None or name in self.lists:
+        name = rename(digest[:8])
+      self._digests[digest] = name
+      self.names.append(name)
+      self.lists[name] = (af, addr_list)
+    return self._digests[digest]
+
+
 def AddRepositoryTags(prefix='', rid=True, date=True, revision=True):
   """Add repository tagging into the output.
 
@@ -415,6 +479,21 @@ def AddRepositoryTags(prefix='', rid=True, date=True, revision=True):
   return tags
 
 
+def WriteLines(stream, lines):
+  """Write lines to a file-like object as they are produced.
+
+  Args:
+    stream: file-like object to write to.
+    lines: iterable of strings, written separated by newlines like
+      '\n'.join(lines).
+  """
+  separator = ''
+  for line in lines:
+    stream.write(separator)
+    stream.write(line)
+    separator = '\n'
+
+
 def WrapWords(textlist, size, joiner='\n'):
   """Insert breaks into the listed strings at specified width.
 
@@ -870,13 +870,22 @@ class Cisco(aclgenerator.ACLGenerator):
               filter_type, self._PLATFORM))
     return target
 
-  def __str__(self):
-    target_header = []
-    target = []
+  def Render(self, stream):
+    aclgenerator.WriteLines(stream, self._Lines())
+
+  def _Lines(self):
+    """Yields the lines of the rendered filters, in order."""
+    # the object groups of each filter go before everything ahead of it, so
+    # they all come first, those of later filters first.
+    for (_, _, _, _, obj_target) in reversed(self.cisco_policies):
+      if obj_target.valid:
+        yield str(obj_target)
+
     for (header, filter_name, filter_list, terms, obj_target
         ) in self.cisco_policies:
       for filter_type in filter_list:
-        target.extend(self._AppendTargetByFilterType(filter_name, filter_type))
+        for line in self._AppendTargetByFilterType(filter_name, filter_type):
+          yield line
         if filter_type == 'object-group':
           obj_target.AddName(filter_name)
 
@@ -884,30 +893,27 @@ class Cisco(aclgenerator.ACLGenerator):
         # remove/re-create of the filter, otherwise config mode doesn't
         # know where to place these remarks in the configuration.
         if filter_type == 'standard' and filter_name.isdigit():
-          target.extend(
-              aclgenerator.AddRepositoryTags(
-                  'access-list %s remark ' % filter_name,
-                  date=False, revision=False))
+          tags = aclgenerator.AddRepositoryTags(
+              'access-list %s remark ' % filter_name,
+              date=False, revision=False)
         else:
-          target.extend(aclgenerator.AddRepositoryTags(
-              'remark ', date=False, revision=False))
+          tags = aclgenerator.AddRepositoryTags(
+              'remark ', date=False, revision=False)
+        for line in tags:
+          yield line
 
         # add a header comment if one exists
         for comment in header.comment:
           for line in comment.split('\n'):
-            target.append(' remark %s' % line)
-        target.append(' remark Filter type is %s' % (filter_type))
+            yield ' remark %s' % line
+        yield ' remark Filter type is %s' % (filter_type)
 
         # now add the terms
         for term in terms:
           term_str = str(term)
           if term_str:
-            target.append(term_str)
+            yield term_str
 
-      if obj_target.valid:
-        target = [str(obj_target)] + target
-      
-     # ensure that the header is always first
-      target = target_header + target
-      target += ['', 'exit', '']
-    return '\n'.join(target)
+      yield ''
+      yield 'exit'
+      yield ''
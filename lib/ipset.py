@@ -25,7 +25,9 @@ performace of iptables firewall.
 
 __author__ = 'vklimovs@google.com (Vjaceslavs Klimovs)'
 
+import cStringIO
 import string
+import aclgenerator
 import iptables
 import nacaddr
 
@@ -53,6 +55,8 @@ class Term(iptables.Term):
     # { 'src': ('set_name', [ipaddr object, ipaddr object]),
     #   'dst': ('set_name', [ipaddr object, ipaddr object]) }
     self.addr_sets = {}
+    # sets shared with the other terms of the policy.
+    self.set_table = aclgenerator.AddressTable()
 
   def _CalculateAddresses(self, src_addr_list, src_addr_exclude_list,
                           dst_addr_list, dst_addr_exclude_list):
@@ -116,7 +120,11 @@ class Term(iptables.Term):
                            addr_exclude.version == target_af]
       addr_list = nacaddr.ExcludeAddrs(addr_list, addr_exclude_list)
     if len(addr_list) > 1:
-      set_name = self._GenerateSetName(self.term.name, direction)
+      addr_list = nacaddr.CollapseAddrList(addr_list)
+      set_name = self.set_table.Intern(
+          self._GenerateSetName(self.term.name, direction), self.af, addr_list,
+          lambda digest: self._GenerateSetName(
+              self.term.name, '%s-%s' % (direction, digest)))
       self.addr_sets[direction] = (set_name, addr_list)
       addr_list = [self._all_ips]
     return addr_list
@@ -178,43 +186,96 @@ class Ipset(iptables.Iptables):
   _TERM = Term
   _MARKER_BEGIN = '# begin:ipset-rules'
   _MARKER_END = '# end:ipset-rules'
-
-  # TODO(vklimovs): some not trivial processing is happening inside this
-  # __str__, replace with explicit method
-  def __str__(self):
-    # Actual rendering happens in __str__, so it has to be called
-    # before we do set specific part.
-    iptables_output = super(Ipset, self).__str__()
-    output = []
-    output.append(self._MARKER_BEGIN)
+  # no restore, set commands can't be part of an iptables-restore payload.
+  _GOOD_OPTIONS = ['nostate', 'abbreviateterms', 'truncateterms', 'swap']
+  # the smallest hashsize the kernel uses, and the maxelem ipset defaults to.
+  _MIN_HASHSIZE = 64
+  _MIN_MAXELEM = 65536
+  _SWAP_SUFFIX = '.tmp'
+
+  def _TranslatePolicy(self, pol, exp_info):
+    super(Ipset, self)._TranslatePolicy(pol, exp_info)
+    # all terms intern their sets in one table, so that each set is only
+    # configured once.
+    self.set_table = aclgenerator.AddressTable()
     for (_, _, _, _, terms) in self.iptables_policies:
       for term in terms:
-        output.extend(self._GenerateSetConfig(term))
+        term.set_table = self.set_table
+
+  def Render(self, stream):
+    # The sets are filled in as the terms are rendered, but have to be
+    # configured ahead of the rules matching them.
+    iptables_output = cStringIO.StringIO()
+    super(Ipset, self).Render(iptables_output)
+    swapped = set()
+    for (header, _, _, _, terms) in self.iptables_policies:
+      if 'swap' in header.FilterOptions(self._PLATFORM)[1:]:
+        for term in terms:
+          swapped.update(x[0] for x in term.addr_sets.values())
+    output = []
+    output.append(self._MARKER_BEGIN)
+    for set_name in self.set_table.names:
+      af, addr_list = self.set_table.lists[set_name]
+      output.extend(self._GenerateSetConfig(set_name, af, addr_list,
+                                            set_name in swapped))
     output.append(self._MARKER_END)
-    output.append(iptables_output)
-    return '\n'.join(output)
+    output.append(iptables_output.getvalue())
+    aclgenerator.WriteLines(stream, output)
+
+  def _SetSize(self, count):
+    """Returns the hashsize and maxelem of a set of count addresses.
+
+    The hashsize is the power of two the addresses fit in.  The kernel
+    ignores hashsize when it checks whether a set already exists with the
+    same parameters, since it grows the hash as needed, but not maxelem.
+    So that 'create -exist' keeps working as a set grows or shrinks,
+    maxelem stays at the ipset default unless the set outgrows it.
+
+    Args:
+      count: number of addresses in the set.
+
+    Returns:
+      tuple of hashsize and maxelem.
+    """
+    hashsize = max(self._MIN_HASHSIZE, 1 << (count - 1).bit_length())
+    return hashsize, max(self._MIN_MAXELEM, hashsize)
+
+  def _GenerateSetConfig(self, set_name, af, addr_list, swap=False):
+    """Generates configuration for supplied set.
 
-  def _GenerateSetConfig(self, term):
-    """Generates set configuration for supplied term.
+    The configuration is a batch for 'ipset restore'.  Sets are created
+    unless they already exist, flushed so that addresses no longer in the
+    policy go away, and filled.  With swap, the addresses go into a
+    temporary set instead, which then replaces the set in one operation,
+    so that the set is never seen empty or half filled.
 
     Args:
-      term: input term.
+      set_name: name of the set.
+      af: address family of the set.
+      addr_list: addresses in the set.
+      swap: whether to replace the set by swapping in a temporary set.
 
     Returns:
-      string that is configuration of supplied term.
+      list of lines configuring the set.
 
     """
     output = []
-    for direction in sorted(term.addr_sets, reverse=True):
-      set_name, addr_list = term.addr_sets[direction]
-      set_hashsize = 1 << len(addr_list).bit_length()
-      set_maxelem = set_hashsize
-      output.append('create %s %s family %s hashsize %i maxelem %i' %
-                    (set_name,
-                     self._SET_TYPE,
-                     term.af,
-                     set_hashsize,
-                     set_maxelem))
-      for address in addr_list:
-        output.append('add %s %s' % (set_name, address))
+    set_hashsize, set_maxelem = self._SetSize(len(addr_list))
+    create = ('create %%s %s family %s hashsize %i maxelem %i -exist' %
+              (self._SET_TYPE, af, set_hashsize, set_maxelem))
+    output.append(create % set_name)
+    fill_name = set_name
+    if not swap:
+      output.append('flush %s' % set_name)
+    else:
+      fill_name = '%s%s' % (set_name[:self._TERM._SET_MAX_LENGTH -
+                                      len(self._SWAP_SUFFIX)],
+                            self._SWAP_SUFFIX)
+      output.append(create % fill_name)
+      output.append('flush %s' % fill_name)
+    for address in addr_list:
+      output.append('add %s %s -exist' % (fill_name, address))
+    if swap:
+      output.append('swap %s %s' % (fill_name, set_name))
+      output.append('destroy %s' % fill_name)
     return output
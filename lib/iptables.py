@@ -286,6 +286,19 @@ class Term(aclgenerator.Term):
       self.options.append('-m u32 --u32 4&0x1FFF=%s' %
                           self.term.fragment_offset.replace('-', ':'))
 
+    # every pair of addresses takes one rule for each combination of the
+    # remaining matches.
+    rules_per_pair = (len(icmp_types) * len(protocol) *
+                      (len(tcp_track_options) or 1) *
+                      (len(self._GeneratePortStatement(
+                          source_port, source=True)) or 1) *
+                      (len(self._GeneratePortStatement(
+                          destination_port, dest=True)) or 1) *
+                      (2 if log_hits else 1))
+    (encoding, term_saddr, exclude_saddr,
+     term_daddr, exclude_daddr) = self._ChooseEncoding(
+         term_saddr, exclude_saddr, term_daddr, exclude_daddr, rules_per_pair)
+
     for saddr in exclude_saddr:
       ret_str.extend(self._FormatPart(
           '', saddr, '', '', '', '', '', '', '', '', '', '',
@@ -295,6 +308,19 @@ class Term(aclgenerator.Term):
           '', '', '', daddr, '', '', '', '', '', '', '', '',
           self._ACTION_TABLE.get('next')))
 
+    chain = self.term_name
+    if encoding == 'subchain':
+      # jump on the sources to a chain of its own matching the destinations.
+      chain = self._SubchainName()
+      ret_str.append(self._TERM_FORMAT.substitute(term=chain))
+      for saddr in term_saddr:
+        src, _ = self._GenerateAddressStatement(saddr, None)
+        ret_str.append('%s %s -j %s' % (
+            self._FILTER_TOP_FORMAT.substitute(filter=self.filter,
+                                               term=self.term_name),
+            src, chain))
+      term_saddr = [self._all_ips]
+
     for saddr in term_saddr:
       for daddr in term_daddr:
         for icmp in icmp_types:
@@ -313,7 +339,8 @@ class Term(aclgenerator.Term):
                   source_interface,
                   destination_interface,
                   log_hits,
-                  self._ACTION_TABLE.get(str(self.term.action[0]))
+                  self._ACTION_TABLE.get(str(self.term.action[0])),
+                  chain=chain
                   ))
 
     if self._POSTJUMP_FORMAT:
@@ -372,27 +399,6 @@ class Term(aclgenerator.Term):
       if term_daddr_excluded:
         term_daddr = term_daddr_excluded
 
-    # With many sources and destinations, iptables needs to generate the
-    # cartesian product of sources and destinations.  If there are no
-    # exclude rules, this can instead be written as exclude [0/0 -
-    # srcs], exclude [0/0 - dsts].
-    v4_src_count = len([x for x in term_saddr if x.version == 4])
-    v4_dst_count = len([x for x in term_daddr if x.version == 4])
-    v6_src_count = len([x for x in term_saddr if x.version == 6])
-    v6_dst_count = len([x for x in term_daddr if x.version == 6])
-    num_pairs = v4_src_count * v4_dst_count + v6_src_count * v6_dst_count
-    if num_pairs > 100:
-      new_exclude_source = nacaddr.ExcludeAddrs([self._all_ips], term_saddr)
-      new_exclude_dest = nacaddr.ExcludeAddrs([self._all_ips], term_daddr)
-      # Invert the shortest list that does not already have exclude addresses
-      if len(new_exclude_source) < len(new_exclude_dest) and not exclude_saddr:
-        if len(new_exclude_source) + len(term_daddr) < num_pairs:
-          exclude_saddr = new_exclude_source
-          term_saddr = [self._all_ips]
-      elif not exclude_daddr:
-        if len(new_exclude_dest) + len(term_saddr) < num_pairs:
-          exclude_daddr = new_exclude_dest
-          term_daddr = [self._all_ips]
     term_saddr = [x for x in term_saddr
                   if x.version == self.AF_MAP[self.af]]
     exclude_saddr = [x for x in exclude_saddr
@@ -403,9 +409,106 @@ class Term(aclgenerator.Term):
                      if x.version == self.AF_MAP[self.af]]
     return (term_saddr, exclude_saddr, term_daddr, exclude_daddr)
 
+  def _EncodingCosts(self, term_saddr, exclude_saddr, term_daddr,
+                     exclude_daddr, rules_per_pair):
+    """Calculate the number of rules each encoding of the term takes.
+
+    cartesian: a rule for every pair of source and destination address.
+    invert-source, invert-destination: bailout jumps for everything but
+      the sources (or destinations), and a rule for every address of the
+      other direction.
+    subchain: a jump for every source to a chain of the term's own, which
+      has a rule for every destination.
+    ipset: a rule matching a set of sources and a set of destinations;
+      only the ipset generator can render it.
+
+    Inverting a direction or jumping to a chain needs the term to have a
+    chain of its own to return from, and a term with action next returns
+    from the sub-chain rather than from the term.
+
+    Args:
+      term_saddr: source address list of the term
+      exclude_saddr: source address exclude list of the term
+      term_daddr: destination address list of the term
+      exclude_daddr: destination address exclude list of the term
+      rules_per_pair: number of rules for each pair of addresses.
+
+    Returns:
+      tuple of (name, rule count, source address list, source exclude
+      address list, destination address list, destination exclude address
+      list) tuples, one for each encoding available to the term.
+    """
+    bailouts = len(exclude_saddr) + len(exclude_daddr)
+    encodings = [('cartesian',
+                  bailouts + len(term_saddr) * len(term_daddr) * rules_per_pair,
+                  term_saddr, exclude_saddr, term_daddr, exclude_daddr)]
+    if not self._TERM_FORMAT:
+      return tuple(encodings)
+
+    if len(term_saddr) > 1 and not exclude_saddr:
+      inverted = [x for x in nacaddr.ExcludeAddrs([self._all_ips], term_saddr)
+                  if x.version == self.AF_MAP[self.af]]
+      encodings.append(('invert-source',
+                        bailouts + len(inverted) +
+                        len(term_daddr) * rules_per_pair,
+                        [self._all_ips], inverted, term_daddr, exclude_daddr))
+    if len(term_daddr) > 1 and not exclude_daddr:
+      inverted = [x for x in nacaddr.ExcludeAddrs([self._all_ips], term_daddr)
+                  if x.version == self.AF_MAP[self.af]]
+      encodings.append(('invert-destination',
+                        bailouts + len(inverted) +
+                        len(term_saddr) * rules_per_pair,
+                        term_saddr, exclude_saddr, [self._all_ips], inverted))
+    if (len(term_saddr) > 1 and len(term_daddr) > 1 and
+        'next' not in self.term.action):
+      encodings.append(('subchain',
+                        bailouts + len(term_saddr) +
+                        len(term_daddr) * rules_per_pair,
+                        term_saddr, exclude_saddr, term_daddr, exclude_daddr))
+    return tuple(encodings)
+
+  def _ChooseEncoding(self, term_saddr, exclude_saddr, term_daddr,
+                      exclude_daddr, rules_per_pair):
+    """Choose the encoding of the term which takes the fewest rules.
+
+    The rule count of every encoding, including the one an ipset filter
+    would take, is logged at debug level.  Ties go to the plainer encoding.
+
+    Args:
+      term_saddr: source address list of the term
+      exclude_saddr: source address exclude list of the term
+      term_daddr: destination address list of the term
+      exclude_daddr: destination address exclude list of the term
+      rules_per_pair: number of rules for each pair of addresses.
+
+    Returns:
+      tuple containing the name of the encoding, source address list,
+      source exclude address list, destination address list, destination
+      exclude address list in that order
+    """
+    encodings = self._EncodingCosts(term_saddr, exclude_saddr, term_daddr,
+                                    exclude_daddr, rules_per_pair)
+    best = encodings[0]
+    for encoding in encodings[1:]:
+      if encoding[1] < best[1]:
+        best = encoding
+    logging.debug('Term %s (%s) rule counts: %s, ipset %d; using %s.',
+                  self.term.name, self.af,
+                  ', '.join('%s %d' % x[:2] for x in encodings),
+                  rules_per_pair, best[0])
+    return (best[0],) + tuple(best[2:])
+
+  def _SubchainName(self):
+    """Return the name of the chain the subchain encoding jumps to.
+
+    Term chains are named <filter initial>_<term>; the 'd' between the two
+    keeps sub-chains from clashing with any of them.
+    """
+    return '%sd_%s' % (self.filter[:1], self.term.name)
+
   def _FormatPart(self, protocol, saddr, sport, daddr, dport, options,
                   tcp_flags, icmp_type, track_flags, sint, dint, log_hits,
-                  action):
+                  action, chain=None):
     """Compose one iteration of the term parts into a string.
 
     Args:
@@ -422,13 +525,15 @@ class Term(aclgenerator.Term):
       dint: Optional destination interface
       log_hits: Boolean, to log matches or not
       action: What should happen if this rule matches
+      chain: Chain to append the rule to, if not the term's own
     Returns:
       rval:  A single iptables argument line
     """
     src, dst = self._GenerateAddressStatement(saddr, daddr)
 
     filter_top = self._FILTER_TOP_FORMAT.substitute(filter=self.filter,
-                                                    term=self.term_name)
+                                                    term=chain or
+                                                    self.term_name)
 
     source_int = ''
     if sint:
@@ -631,6 +736,10 @@ class Iptables(aclgenerator.ACLGenerator):
   _RENDER_SUFFIX = None
   _DEFAULTACTION_FORMAT = '-P %s %s'
   _DEFAULTACTION_FORMAT_CUSTOM_CHAIN = '-N %s'
+  _RESTORE_PREFIX = '*filter'
+  _RESTORE_SUFFIX = 'COMMIT'
+  # chain name and policy, '-' for chains other than the built-in ones.
+  _RESTORE_CHAIN_FORMAT = ':%s %s [0:0]'
   _DEFAULT_ACTION = 'DROP'
   _TERM = Term
   _TERM_MAX_LENGTH = 24
@@ -649,6 +758,7 @@ class Iptables(aclgenerator.ACLGenerator):
                                       'source_prefix',       # skips these terms
                                      ])
   _GOOD_FILTERS = ['INPUT', 'OUTPUT', 'FORWARD']
+  _GOOD_OPTIONS = ['nostate', 'abbreviateterms', 'truncateterms', 'restore']
 
   def _WarnIfCustomTarget(self, target):
     """Emit a warning if a policy's default target is not a built-in chain."""
@@ -660,13 +770,13 @@ class Iptables(aclgenerator.ACLGenerator):
   def _TranslatePolicy(self, pol, exp_info):
     """Translate a policy from objects into strings."""
     self.iptables_policies = []
+    self.restore = None
     current_date = datetime.date.today()
     exp_info_date = current_date + datetime.timedelta(weeks=exp_info)
 
     default_action = None
     good_default_actions = ['ACCEPT', 'DROP']
     good_afs = ['inet', 'inet6']
-    good_options = ['nostate', 'abbreviateterms', 'truncateterms']
     all_protocols_stateful = True
 
     for header, terms in pol.filters:
@@ -681,7 +791,7 @@ class Iptables(aclgenerator.ACLGenerator):
 
       # ensure all options after the filter name are expected
       for opt in filter_options:
-        if opt not in good_default_actions + good_afs + good_options:
+        if opt not in good_default_actions + good_afs + self._GOOD_OPTIONS:
           raise UnsupportedTargetOption('%s %s %s %s' % (
               '\nUnsupported option found in', self._PLATFORM,
               'target definition:', opt))
@@ -702,6 +812,21 @@ class Iptables(aclgenerator.ACLGenerator):
       if filter_type is None:
         filter_type = 'inet'
 
+      # a restore payload is loaded by one of iptables-restore or
+      # ip6tables-restore as a whole, every filter has to be part of it.
+      restore = 'restore' in filter_options
+      if self.restore is None:
+        self.restore = restore
+      elif restore != self.restore:
+        raise UnsupportedFilterError('%s %s %s' % (
+            '\nOption restore must be given on every', self._PLATFORM,
+            'filter of a policy or none.'))
+      if restore and self.iptables_policies:
+        if filter_type != self.iptables_policies[0][2]:
+          raise UnsupportedFilterError('%s %s' % (
+              '\nA restore payload may only hold filters of one address '
+              'family, found', filter_type))
+
       if self._PLATFORM == 'iptables' and filter_name == 'FORWARD':
         default_action = 'DROP'
 
@@ -764,53 +889,116 @@ class Iptables(aclgenerator.ACLGenerator):
       pol[3] = action
     self.iptables_policies[0] = tuple(pol)
 
-  def __str__(self):
-    target = []
+  def _FilterComments(self, header, filter_type):
+    """Return the comment lines heading a filter."""
     pretty_platform = '%s%s' % (self._PLATFORM[0].upper(), self._PLATFORM[1:])
+    target = ['# %s %s Policy' % (pretty_platform,
+                                  header.FilterName(self._PLATFORM))]
+
+    # reformat long text comments, if needed
+    comments = aclgenerator.WrapWords(header.comment, 70)
+    if comments and comments[0]:
+      for line in comments:
+        target.append('# %s' % line)
+      target.append('#')
+    # add the p4 tags
+    target.extend(aclgenerator.AddRepositoryTags('# '))
+    target.append('# ' + filter_type)
+    return target
+
+  def _ChainPolicy(self, filter_name, default_action):
+    """Return the policy to set on a filter chain, if any."""
+    if filter_name not in self._GOOD_FILTERS:
+      return None
+    if default_action:
+      return default_action
+    # always specify the default filter states for speedway,
+    # if default action policy not specified for iptables, do nothing.
+    if self._PLATFORM == 'speedway':
+      return self._DEFAULT_ACTION
+    return None
+
+  def _RenderRestore(self):
+    """Render the filters as a single iptables-restore payload.
+
+    Every chain is declared at the top of the *filter table, with the
+    policy of the built-in ones, followed by the rules of all filters and
+    one COMMIT, so that the kernel replaces the whole table in one
+    transaction.
 
+    Returns:
+      string, the payload for iptables-restore or ip6tables-restore.
+    """
+    # chain name -> policy, in order of declaration.
+    chains = {}
+    declarations = []
+    target = []
+
+    def Declare(chain, chain_policy):
+      if chain not in chains:
+        declarations.append(chain)
+      if chain_policy or chain not in chains:
+        chains[chain] = chain_policy or '-'
+
+    for (header, filter_name, filter_type, default_action, terms
+        ) in self.iptables_policies:
+      target.extend(self._FilterComments(header, filter_type))
+      Declare(filter_name, self._ChainPolicy(filter_name, default_action))
+      for term in terms:
+        term_str = str(term)
+        if not term_str:
+          continue
+        for line in term_str.split('\n'):
+          if line.startswith('-N '):
+            Declare(line[3:], None)
+          else:
+            target.append(line)
+
+    output = [self._RESTORE_PREFIX]
+    output.extend(self._RESTORE_CHAIN_FORMAT % (x, chains[x])
+                  for x in declarations
+                  if x not in self._GOOD_FILTERS or chains[x] != '-')
+    output.extend(target)
+    output.append(self._RESTORE_SUFFIX)
+    output.append('')
+    return '\n'.join(output)
+
+  def Render(self, stream):
+    if self.restore:
+      # the chains are declared ahead of all the rules, so the payload can
+      # only be written once every term is rendered.
+      stream.write(self._RenderRestore())
+      return
+    aclgenerator.WriteLines(stream, self._Lines())
+
+  def _Lines(self):
+    """Yields the lines of the rendered filters, in order."""
     if self._RENDER_PREFIX:
-      target.append(self._RENDER_PREFIX)
+      yield self._RENDER_PREFIX
 
     for (header, filter_name, filter_type, default_action, terms
         ) in self.iptables_policies:
       # Add comments for this filter
-      target.append('# %s %s Policy' % (pretty_platform,
-                                        header.FilterName(self._PLATFORM)))
-
-      # reformat long text comments, if needed
-      comments = aclgenerator.WrapWords(header.comment, 70)
-      if comments and comments[0]:
-        for line in comments:
-          target.append('# %s' % line)
-        target.append('#')
-      # add the p4 tags
-      target.extend(aclgenerator.AddRepositoryTags('# '))
-      target.append('# ' + filter_type)
+      for line in self._FilterComments(header, filter_type):
+        yield line
 
       if filter_name in self._GOOD_FILTERS:
-        if default_action:
-          target.append(self._DEFAULTACTION_FORMAT % (filter_name,
-                                                      default_action))
-        elif self._PLATFORM == 'speedway':
-          # always specify the default filter states for speedway,
-          # if default action policy not specified for iptables, do nothing.
-          target.append(
-              self._DEFAULTACTION_FORMAT % (filter_name, self._DEFAULT_ACTION))
+        chain_policy = self._ChainPolicy(filter_name, default_action)
+        if chain_policy:
+          yield self._DEFAULTACTION_FORMAT % (filter_name, chain_policy)
       else:
         # Custom chains have no concept of default policy.
-        target.append(self._DEFAULTACTION_FORMAT_CUSTOM_CHAIN % filter_name)
+        yield self._DEFAULTACTION_FORMAT_CUSTOM_CHAIN % filter_name
       # add the terms
       for term in terms:
         term_str = str(term)
         if term_str:
-          target.append(term_str)
+          yield term_str
 
     if self._RENDER_SUFFIX:
-      target.append(self._RENDER_SUFFIX)
-
-    target.append('')
-    return '\n'.join(target)
+      yield self._RENDER_SUFFIX
 
+    yield ''
 
 class Error(Exception):
   """Base error class."""
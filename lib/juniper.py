@@ -78,6 +78,19 @@ class Config(object):
           'Expected indent %d but got %d' % (self._initial_indent, self.indent))
     return '\n'.join(self.lines)
 
+  def Pop(self):
+    """Remove and return the lines appended so far.
+
+    This lets a large configuration be written out as it is assembled.
+    The indentation carries on from the removed lines.
+
+    Returns:
+      list of strings.
+    """
+    lines = self.lines
+    self.lines = []
+    return lines
+
   def Append(self, line, verbatim=False):
     """Append one line to the configuration.
 
@@ -113,6 +126,9 @@ class Term(aclgenerator.Term):
       or "bridge"
   """
   _DEFAULT_INDENT = 12
+  # indentation of a prefix list in policy-options, and of its addresses.
+  _PREFIX_LIST_INDENT = 4
+  _PREFIX_LIST_ADDRESS_INDENT = 8
   _ACTIONS = {'accept': 'accept',
               'deny': 'discard',
               'reject': 'reject',
@@ -147,9 +163,21 @@ class Term(aclgenerator.Term):
                            'protocol-except': 'ip-protocol-except',
                            'tcp-est': 'tcp-flags "(ack|rst)"'}}
 
-  def __init__(self, term, term_type):
+  # match conditions referring to prefix lists, the suffix of the names of
+  # the prefix lists made for them, and the term attribute of their addresses.
+  _PREFIX_LISTS = {'addr': ('prefix-list', 'addr', 'address'),
+                   'saddr': ('source-prefix-list', 'src', 'source_address'),
+                   'daddr': ('destination-prefix-list', 'dst',
+                             'destination_address')}
+
+  def __init__(self, term, term_type, prefix_lists=None):
     self.term = term
     self.term_type = term_type
+    # aclgenerator.AddressTable shared by the terms of a policy, if their
+    # addresses go into prefix lists.
+    self.prefix_lists = prefix_lists
+    # names of the prefix lists the term refers to.
+    self.prefix_list_names = []
 
     if term_type not in self._TERM_TYPE:
       raise ValueError('Unknown Filter Type: %s' % term_type)
@@ -270,10 +298,7 @@ class Term(aclgenerator.Term):
       # address
       address = self.term.GetAddressOfVersion('address', term_af)
       if address:
-        config.Append('%s {' % family_keywords['addr'])
-        for addr in address:
-          config.Append('%s;%s' % (addr, self._Comment(addr)))
-        config.Append('}')
+        self._AppendAddresses(config, 'addr', address, [], [])
       elif self.term.address:
         logging.warn(self.NO_AF_LOG_ADDR.substitute(term=self.term.name,
                                                       af=self.term_type))
@@ -285,13 +310,8 @@ class Term(aclgenerator.Term):
           self.term.GetAddressOfVersion('source_address_exclude', term_af))
 
       if source_address:
-        config.Append('%s {' % family_keywords['saddr'])
-        for addr in source_address:
-          config.Append('%s;%s' % (addr, self._Comment(addr)))
-        for addr in source_address_exclude:
-          config.Append('%s except;%s' % (
-              addr, self._Comment(addr, exclude=True)))
-        config.Append('}')
+        self._AppendAddresses(config, 'saddr', source_address,
+                              source_address_exclude, self.term.source_prefix)
       elif self.term.source_address:
         logging.warn(self.NO_AF_LOG_ADDR.substitute(term=self.term.name,
                                                       direction='source',
@@ -304,13 +324,9 @@ class Term(aclgenerator.Term):
           self.term.GetAddressOfVersion('destination_address_exclude', term_af))
 
       if destination_address:
-        config.Append('%s {' % family_keywords['daddr'])
-        for addr in destination_address:
-          config.Append('%s;%s' % (addr, self._Comment(addr)))
-        for addr in destination_address_exclude:
-          config.Append('%s except;%s' % (
-              addr, self._Comment(addr, exclude=True)))
-        config.Append('}')
+        self._AppendAddresses(config, 'daddr', destination_address,
+                              destination_address_exclude,
+                              self.term.destination_prefix)
       elif self.term.destination_address:
         logging.warn(self.NO_AF_LOG_ADDR.substitute(term=self.term.name,
                                                       direction='destination',
@@ -436,6 +452,94 @@ class Term(aclgenerator.Term):
 
     return str(config)
 
+  def _AppendAddresses(self, config, keyword, include, exclude, prefixes):
+    """Appends an address match condition to config.
+
+    With prefix lists, the addresses of a match condition go into shared
+    prefix lists, unless it is a single address, or the term also matches
+    prefix lists of its own.  Those are matched in addition to addresses
+    rather than instead of them, so the addresses have to stay inline.
+
+    Args:
+      config: Config the term is rendered into.
+      keyword: key of the match condition in _TERM_TYPE.
+      include: list of nacaddr objects to match.
+      exclude: list of nacaddr objects to match as exceptions.
+      prefixes: names of the prefix lists the term matches in the same
+        direction.
+    """
+    if (self.prefix_lists is not None and not prefixes and
+        len(include) + len(exclude) > 1):
+      list_keyword, suffix, attribute = self._PREFIX_LISTS[keyword]
+      config.Append('%s {' % list_keyword)
+      config.Append('%s;' % self._InternPrefixList(include, attribute,
+                                                   suffix))
+      if exclude:
+        config.Append('%s except;' % self._InternPrefixList(
+            exclude, attribute + '_exclude', suffix + '-except'))
+      config.Append('}')
+      return
+
+    config.Append('%s {' % self._TERM_TYPE[self.term_type][keyword])
+    for addr in include:
+      config.Append('%s;%s' % (addr, self._Comment(addr)))
+    for addr in exclude:
+      config.Append('%s except;%s' % (
+          addr, self._Comment(addr, exclude=True)))
+    config.Append('}')
+
+  def _InternPrefixList(self, addresses, attribute, suffix):
+    """Returns the name of the prefix list holding addresses.
+
+    Prefix lists are global to the router, and each policy replaces the
+    lists it configures.  A list is only named after a token when it holds
+    all of the addresses of the token in its address family, so that every
+    policy configures the same list under that name.  Other lists, such as
+    part of a token left after excludes, are named after the term with a
+    digest of their addresses.
+
+    Args:
+      addresses: list of nacaddr objects.
+      attribute: term attribute the addresses come from.
+      suffix: suffix of the name of a list named after the term.
+
+    Returns:
+      name of the prefix list.
+    """
+    tokens = set(self.term.address_tokens.get(attribute, []))
+    whole_token = len(tokens) == 1 and addresses == (
+        self.term.GetAddressOfVersion(attribute,
+                                      self.AF_MAP.get(self.term_type)))
+    if whole_token:
+      name = tokens.pop()
+    else:
+      name = '%s-%s' % (self.term.name, suffix)
+    if self.term_type == 'inet6':
+      name += '-v6'
+    list_name = self.prefix_lists.Intern(
+        whole_token and name or None, self.term_type, addresses,
+        lambda digest: '%s-%s' % (name, digest))
+    self.prefix_list_names.append(list_name)
+    return list_name
+
+  def PrefixListConfig(self, list_name):
+    """Returns the configuration of a prefix list the term refers to.
+
+    Args:
+      list_name: name of the prefix list.
+
+    Returns:
+      string
+    """
+    config = Config(indent=self._PREFIX_LIST_INDENT)
+    config.Append('replace:')
+    config.Append('prefix-list %s {' % list_name)
+    for addr in self.prefix_lists.lists[list_name][1]:
+      config.Append('%s;%s' % (addr, self._Comment(
+          addr, column=self._PREFIX_LIST_ADDRESS_INDENT)))
+    config.Append('}')
+    return str(config)
+
   def _MinimizePrefixes(self, include, exclude):
     """Calculate a minimal set of prefixes for Juniper match conditions.
 
@@ -459,18 +563,18 @@ class Term(aclgenerator.Term):
     # in the included set, we can elide it.  In other words, if the
     # next-less-specific prefix is the implicit "default except",
     # there is no need to configure the more specific "except".
-    #
-    # TODO(kbrint): this could be made more efficient with a Patricia trie.
+    # A trie of the included prefixes finds those containing an
+    # exclude in one walk down the bits of the exclude.
     exclude_result = []
-    for exclude_prefix in exclude:
+    if exclude and include_result:
+      included = nacaddr.PrefixTrie()
       for include_prefix in include_result:
-        if exclude_prefix in include_prefix:
-          exclude_result.append(exclude_prefix)
-          break
+        included.Insert(include_prefix, True)
+      exclude_result = [x for x in exclude if included.Containing(x)]
 
     return include_result, exclude_result
 
-  def _Comment(self, addr, exclude=False, line_length=132):
+  def _Comment(self, addr, exclude=False, line_length=132, column=None):
     """Returns address comment field if it exists.
 
     Args:
@@ -480,6 +584,8 @@ class Term(aclgenerator.Term):
         truncated, no matter what.  ie, a 1000 character comment will be
         truncated to line_length, and then split.  if 0, the whole comment
         is kept. the current default of 132 is somewhat arbitrary.
+      column: integer - column the address starts at, if it is not one of
+        the addresses of a term.
 
     Returns:
       string
@@ -508,7 +614,10 @@ class Term(aclgenerator.Term):
     # indentation, for multi-line comments, ensures that subsquent lines
     # are correctly alligned with the first line of the comment.
     indentation = 0
-    if exclude:
+    if column is not None:
+      # the comment follows '1.1.1.1/32; ' or '1.1.1.1/32 except; '
+      indentation = column + len(str(addr)) + (9 if exclude else 2)
+    elif exclude:
       # len('1.1.1.1/32 except;') == 21
       indentation = 21 + self._DEFAULT_INDENT + len(str(addr))
     else:
@@ -634,8 +743,13 @@ class Juniper(aclgenerator.ACLGenerator):
                                       'traffic_type',
                                      ])
 
+  # filter types whose addresses can go into prefix lists.
+  _PREFIX_LIST_AF = set(('inet', 'inet6'))
+
   def _TranslatePolicy(self, pol, exp_info):
     self.juniper_policies = []
+    # prefix lists shared by the filters with the prefix-lists option.
+    self.prefix_lists = aclgenerator.AddressTable()
     current_date = datetime.date.today()
     exp_info_date = current_date + datetime.timedelta(weeks=exp_info)
 
@@ -655,11 +769,24 @@ class Juniper(aclgenerator.ACLGenerator):
       if not interface_specific:
         filter_options.remove('not-interface-specific')
 
+      # Checks if the addresses of the terms should go into prefix lists.
+      use_prefix_lists = 'prefix-lists' in filter_options[1:]
+      if use_prefix_lists:
+        filter_options.remove('prefix-lists')
+
       # default to inet4 filters
       filter_type = 'inet'
       if len(filter_options) > 1:
         filter_type = filter_options[1]
 
+      prefix_lists = None
+      if use_prefix_lists:
+        if filter_type not in self._PREFIX_LIST_AF:
+          raise UnsupportedFilterError(
+              'prefix-lists is not supported for %s filter %s' % (
+                  filter_type, filter_name))
+        prefix_lists = self.prefix_lists
+
       term_names = set()
       new_terms = []
       for term in terms:
@@ -682,12 +809,40 @@ class Juniper(aclgenerator.ACLGenerator):
                          'will not be rendered.', term.name, filter_name)
             continue
 
-        new_terms.append(Term(term, filter_type))
+        new_terms.append(Term(term, filter_type, prefix_lists))
 
       self.juniper_policies.append((header, filter_name, filter_type,
                                     interface_specific, new_terms))
 
-  def __str__(self):
+  def Render(self, stream):
+    if not any(x.prefix_lists is not None
+               for (_, _, _, _, terms) in self.juniper_policies
+               for x in terms):
+      aclgenerator.WriteLines(stream, self._Lines())
+      stream.write('\n')
+      return
+
+    # prefix lists are only known once the terms are rendered, but have to
+    # be configured before the filters referring to them.
+    filter_lines = list(self._Lines())
+    prefix_list_terms = {}
+    for (_, _, _, _, terms) in self.juniper_policies:
+      for term in terms:
+        for list_name in term.prefix_list_names:
+          prefix_list_terms.setdefault(list_name, term)
+    if prefix_list_terms:
+      config = Config()
+      config.Append('policy-options {')
+      for list_name in self.prefix_lists.names:
+        config.Append(prefix_list_terms[list_name].PrefixListConfig(list_name),
+                      verbatim=True)
+      config.Append('}')  # policy-options { ... }
+      stream.write(str(config) + '\n')
+    aclgenerator.WriteLines(stream, filter_lines)
+    stream.write('\n')
+
+  def _Lines(self):
+    """Yields the lines of the rendered filters, in order."""
     config = Config()
 
     for (header, filter_name, filter_type, interface_specific, terms
@@ -719,9 +874,14 @@ class Juniper(aclgenerator.ACLGenerator):
         term_str = str(term)
         if term_str:
           config.Append(term_str, verbatim=True)
+        for line in config.Pop():
+          yield line
 
       config.Append('}')  # filter { ... }
       config.Append('}')  # family inet { ... }
       config.Append('}')  # firewall { ... }
 
-    return str(config) + '\n'
+    # checks the indentation of the whole configuration.
+    str(config)
+    for line in config.Pop():
+      yield line
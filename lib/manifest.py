@@ -0,0 +1,213 @@
+#!/usr/bin/python
+#
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Dependency manifest for incremental filter generation.
+
+For every rendered filter the manifest records what it was rendered from:
+content hashes of the policy file and its includes, the resolved values of
+each network and service token the policy references, and the options and
+code used to render it.  A policy only needs to be rendered again when one
+of those inputs changed, when one of its terms has expired since, or when
+one of its filters is missing.  A policy that renders no filters at all is
+recorded under its own file name, so that it is tracked all the same.
+
+Sample usage:
+    m = Manifest('filters/.manifest', defs, {'exp_info': 2})
+    if not m.UpToDate('policies/foo.pol'):
+      ... render policies/foo.pol to filters/foo.jcl ...
+      m.Record('policies/foo.pol', ['filters/foo.jcl'])
+    m.Save()
+"""
+
+import datetime
+import glob
+import hashlib
+import json
+import os
+
+import naming
+import policy
+
+
+class Error(Exception):
+  """Base error class."""
+
+
+class ManifestReadError(Error):
+  """Raised when an existing manifest can't be read."""
+
+
+def FileDigest(filename):
+  """Return the hex digest of a file's contents, or None if it can't be read."""
+  try:
+    return hashlib.sha1(open(filename, 'rb').read()).hexdigest()
+  except IOError:
+    return None
+
+
+def CompilerDigest():
+  """Return a digest of the policy compiler and generator sources."""
+  digest = hashlib.sha1()
+  lib_dir = os.path.dirname(os.path.abspath(__file__))
+  for filename in sorted(glob.glob(os.path.join(lib_dir, '*.py'))):
+    digest.update(open(filename, 'rb').read())
+  return digest.hexdigest()
+
+
+def _Digest(value):
+  return hashlib.sha1(repr(value)).hexdigest()
+
+
+class TokenDigests(object):
+  """Digests of the resolved values of network and service tokens.
+
+  Each token is only expanded once.
+
+  Args:
+    definitions: naming.Naming object the tokens are resolved with.
+  """
+
+  def __init__(self, definitions):
+    self.definitions = definitions
+    self._networks = {}
+    self._services = {}
+
+  def NetworkDigest(self, token):
+    """Return a digest of the addresses, comments and tokens of a network."""
+    if token not in self._networks:
+      try:
+        value = [(str(x), x.text, x.token)
+                 for x in self.definitions.GetNet(token)]
+      except naming.UndefinedAddressError:
+        value = None
+      self._networks[token] = _Digest(value)
+    return self._networks[token]
+
+  def ServiceDigest(self, token):
+    """Return a digest of the ports and protocols of a service."""
+    if token not in self._services:
+      try:
+        value = self.definitions.GetService(token)
+      except naming.UndefinedServiceError:
+        value = None
+      self._services[token] = _Digest(value)
+    return self._services[token]
+
+
+class Manifest(object):
+  """Dependencies of every filter rendered into an output directory.
+
+  Args:
+    path: file the manifest is loaded from and saved to.
+    definitions: naming.Naming object the policies are rendered with.
+    options: dict of rendering options which affect the output.
+
+  Raises:
+    ManifestReadError: if an existing manifest is corrupt.
+  """
+
+  def __init__(self, path, definitions, options):
+    self.path = path
+    self.definitions = definitions
+    self.options = dict(options, compiler=CompilerDigest())
+    # rendered filter name -> {'source': policy file, 'inputs': {...}}
+    self.outputs = {}
+    self.tokens = TokenDigests(definitions)
+    if os.path.exists(path):
+      try:
+        self.outputs = json.load(open(path))
+      except (IOError, ValueError) as e:
+        raise ManifestReadError('Unable to read manifest %s: %s' % (path, e))
+
+  def _Inputs(self, source_file, includes, networks, services):
+    # names read back from the json manifest are unicode, the resolved
+    # values they are digested from must not be.
+    networks = [str(x) for x in networks]
+    services = [str(x) for x in services]
+    return {
+        'files': dict((x, FileDigest(x)) for x in [source_file] + includes),
+        'networks': dict((x, self.tokens.NetworkDigest(x)) for x in networks),
+        'services': dict((x, self.tokens.ServiceDigest(x)) for x in services),
+        'options': self.options,
+    }
+
+  def Sources(self):
+    """Return the set of policy files recorded in the manifest."""
+    return set(x['source'] for x in self.outputs.values())
+
+  def UpToDate(self, source_file):
+    """Check whether the filters rendered from a policy file are current.
+
+    Args:
+      source_file: name of the policy file.
+
+    Returns:
+      bool: True if none of the inputs of the policy changed since its
+      filters were recorded, and all of the filters still exist.  Policies
+      recorded without any filters only need their inputs unchanged.
+    """
+    entries = [(filter_file, x['inputs'])
+               for filter_file, x in self.outputs.items()
+               if x['source'] == source_file]
+    if not entries:
+      return False
+    for filter_file, _ in entries:
+      if filter_file != source_file and not os.path.exists(filter_file):
+        return False
+
+    recorded = entries[0][1]
+    expires = recorded.get('expires')
+    if expires and expires <= datetime.date.today().isoformat():
+      return False
+    current = self._Inputs(source_file,
+                           [x for x in recorded['files'] if x != source_file],
+                           recorded['networks'], recorded['services'])
+    for key, value in current.items():
+      if recorded.get(key) != value:
+        return False
+    return True
+
+  def Record(self, source_file, filter_files):
+    """Record the current inputs of the filters rendered from a policy.
+
+    Args:
+      source_file: name of the policy file.
+      filter_files: list of filter file names rendered from source_file.
+    """
+    deps = policy.Dependencies(open(source_file).read())
+    inputs = self._Inputs(source_file, deps.includes, deps.networks,
+                          deps.services)
+    # the output changes again on the day the next term expires.
+    today = datetime.date.today()
+    future = [x for x in deps.expirations if x > today]
+    inputs['expires'] = min(future).isoformat() if future else None
+
+    for filter_file, entry in self.outputs.items():
+      if entry['source'] == source_file:
+        del self.outputs[filter_file]
+    # a policy rendering no filters is recorded under its own name instead,
+    # otherwise it would be rendered again on every run.
+    for filter_file in filter_files or [source_file]:
+      self.outputs[filter_file] = {'source': source_file, 'inputs': inputs}
+
+  def Save(self):
+    """Write the manifest, replacing the previous one atomically."""
+    tmp_path = '%s.tmp' % self.path
+    output = open(tmp_path, 'w')
+    json.dump(self.outputs, output, indent=1, sort_keys=True)
+    output.close()
+    os.rename(tmp_path, self.path)
@@ -126,52 +126,58 @@ class IPv6(ipaddr.IPv6Network):
       self.text = comment
 
 
-def CollapseAddrListRecursive(addresses):
-  """Recursively loops through the addresses, collapsing concurent netblocks.
+def _Range(addr):
+  """Return the first and last address of a network as integers."""
+  netmask = int(addr.netmask)
+  first = addr._ip & netmask
+  return first, first | (addr._ALL_ONES ^ netmask)
 
-   Example:
 
-   ip1 = ipaddr.IPv4Network('1.1.0.0/24')
-   ip2 = ipaddr.IPv4Network('1.1.1.0/24')
-   ip3 = ipaddr.IPv4Network('1.1.2.0/24')
-   ip4 = ipaddr.IPv4Network('1.1.3.0/24')
-   ip5 = ipaddr.IPv4Network('1.1.4.0/24')
-   ip6 = ipaddr.IPv4Network('1.1.0.1/22')
+def _RangeToPrefixes(first, last, bits):
+  """Yield (network, prefixlen) of the fewest CIDR blocks covering a range.
 
-   CollapseAddrRecursive([ip1, ip2, ip3, ip4, ip5, ip6]) ->
-   [IPv4Network('1.1.0.0/22'), IPv4Network('1.1.4.0/24')]
+  Args:
+    first: int, first address of the range.
+    last: int, last address of the range.
+    bits: int, address length, 32 or 128.
+  """
+  while first <= last:
+    # the largest block starting at first which doesn't go past last.
+    size = first & -first or 1 << bits
+    while size > last - first + 1:
+      size >>= 1
+    yield first, bits - size.bit_length() + 1
+    first += size
 
-   Note, this shouldn't be called directly, but is called via
-   CollapseAddr([])
+
+def _MergeAddresses(addresses, network, prefixlen):
+  """Return the address for a block collapsed from a list of addresses.
 
   Args:
-    addresses: List of IPv4 or IPv6 objects
+    addresses: sorted list of nacaddr objects contained in the block, the
+      first one starts at network.
+    network: int, first address of the block.
+    prefixlen: int, prefix length of the block.
 
   Returns:
-    List of IPv4 or IPv6 objects (depending on what we were passed)
+    the first of addresses if it is the whole block and it doesn't need any
+    other comment, else a new nacaddr object with the token of the first
+    address and the comments of all of them.
   """
-  ret_array = []
-  optimized = False
-
-  for cur_addr in addresses:
-    if not ret_array:
-      ret_array.append(cur_addr)
-      continue
-    if ret_array[-1].Contains(cur_addr):
-      # save the comment from the subsumed address
-      ret_array[-1].AddComment(cur_addr.text)
-      optimized = True
-    elif cur_addr == ret_array[-1].Supernet().Subnet()[1]:
-      ret_array.append(ret_array.pop().Supernet())
-      # save the text from the subsumed address
-      ret_array[-1].AddComment(cur_addr.text)
-      optimized = True
-    else:
-      ret_array.append(cur_addr)
-
-  if optimized:
-    return CollapseAddrListRecursive(ret_array)
-  return ret_array
+  first = addresses[0]
+  if len(addresses) == 1 and first._prefixlen == prefixlen:
+    return first
+  if first._prefixlen == prefixlen:
+    merged = IP(str(first), first.text, first.token)
+    merged.parent_token = first.parent_token
+  else:
+    merged = IP('%s/%d' % (ipaddr.IPAddress(network, first._version),
+                           prefixlen), first.text, first.token)
+  for addr in addresses[1:]:
+    merged.AddComment(addr.text)
+  if first._prefixlen == prefixlen and merged.text == first.text:
+    return first
+  return merged
 
 
 def CollapseAddrList(addresses):
@@ -181,14 +187,46 @@ def CollapseAddrList(addresses):
     [IPv4('1.1.0.0/24'), IPv4('1.1.1.0/24')]) -> [IPv4('1.1.0.0/23')]
     Note: this works just as well with IPv6 addresses too.
 
+  Overlapping and adjacent addresses are merged into integer ranges in one
+  pass over the sorted addresses, then each range is split into the fewest
+  CIDR blocks.  A block keeps the token of its first address and the
+  comments of all of the addresses it contains, merged with AddComment().
+  The addresses passed in are never modified.
+
   Args:
      addresses: list of ipaddr.IPNetwork objects
 
   Returns:
     list of ipaddr.IPNetwork objects
   """
-  return CollapseAddrListRecursive(
-      sorted(addresses, key=ipaddr._BaseNet._get_networks_key))
+  # (version, first, prefixlen) sorts like ipaddr._BaseNet._get_networks_key,
+  # the index keeps the sort stable.
+  entries = []
+  for index, addr in enumerate(addresses):
+    first, last = _Range(addr)
+    entries.append((addr._version, first, addr._prefixlen, index, last))
+  entries.sort()
+
+  ret_array = []
+  start = 0
+  while start < len(entries):
+    version, first, _, index, last = entries[start]
+    bits = addresses[index]._max_prefixlen
+    end = start + 1
+    while (end < len(entries) and entries[end][0] == version and
+           entries[end][1] <= last + 1):
+      last = max(last, entries[end][4])
+      end += 1
+
+    # every address is contained in exactly one of the blocks of the range.
+    for network, prefixlen in _RangeToPrefixes(first, last, bits):
+      block_last = network + (1 << (bits - prefixlen)) - 1
+      contained = []
+      while start < end and entries[start][1] <= block_last:
+        contained.append(addresses[entries[start][3]])
+        start += 1
+      ret_array.append(_MergeAddresses(contained, network, prefixlen))
+  return ret_array
 
 
 def SortAddrList(addresses):
@@ -222,6 +260,12 @@ def RemoveAddressFromList(superset, exclude):
 def AddressListExclude(superset, excludes):
   """Remove a list of addresses from another list of addresses.
 
+  Both lists are collapsed, then swept together in address order so that
+  every exclude is subtracted from every superset address it overlaps in a
+  single pass.  Superset addresses which don't overlap any exclude are
+  kept as they are, the remaining parts of the others are new addresses
+  without comment or token.
+
   Args:
     superset: a List of nacaddr IPv4 or IPv6 addresses
     excludes: a List nacaddr IPv4 or IPv6 addresses
@@ -230,18 +274,130 @@ def AddressListExclude(superset, excludes):
     a List of nacaddr IPv4 or IPv6 addresses
   """
   superset = CollapseAddrList(superset)
-  excludes = CollapseAddrList(excludes)
+  excludes = [(x._version,) + _Range(x) for x in CollapseAddrList(excludes)]
 
   ret_array = []
+  index = 0
+  for addr in superset:
+    version = addr._version
+    first, last = _Range(addr)
+    # excludes ending before addr can't overlap any of the addresses left.
+    while (index < len(excludes) and
+           (excludes[index][0], excludes[index][2]) < (version, first)):
+      index += 1
+
+    remaining = []
+    start = first
+    overlap = index
+    while (overlap < len(excludes) and excludes[overlap][0] == version and
+           excludes[overlap][1] <= last):
+      _, ex_first, ex_last = excludes[overlap]
+      if ex_first > start:
+        remaining.append((start, ex_first - 1))
+      start = max(start, ex_last + 1)
+      overlap += 1
+    if overlap == index:
+      ret_array.append(addr)
+      continue
+    if start <= last:
+      remaining.append((start, last))
 
-  for ex in excludes:
-    superset = RemoveAddressFromList(superset, ex)
-  return CollapseAddrList(superset)
+    for range_first, range_last in remaining:
+      for network, prefixlen in _RangeToPrefixes(range_first, range_last,
+                                                 addr._max_prefixlen):
+        ret_array.append(IP('%s/%d' % (ipaddr.IPAddress(network, version),
+                                       prefixlen)))
+  return CollapseAddrList(ret_array)
 
 
 ExcludeAddrs = AddressListExclude
 
 
+class _TrieNode(object):
+  """A prefix of a PrefixTrie, with the values stored under it."""
+
+  __slots__ = ('network', 'prefixlen', 'values', 'children')
+
+  def __init__(self, network, prefixlen):
+    self.network = network
+    self.prefixlen = prefixlen
+    self.values = []
+    self.children = [None, None]
+
+
+class PrefixTrie(object):
+  """A path compressed binary trie of IPv4 and IPv6 prefixes.
+
+  Each prefix holds a list of values.  Only prefixes which were inserted
+  and the points where they branch off get a node, so a lookup walks at
+  most one node per bit of the address whatever the number of prefixes.
+
+  Example:
+    trie = PrefixTrie()
+    trie.Insert(IP('10.0.0.0/8'), 'INTERNAL')
+    trie.Insert(IP('10.1.0.0/16'), 'LAB')
+    trie.Containing(IP('10.1.1.1')) -> ['INTERNAL', 'LAB']
+  """
+
+  def __init__(self):
+    self._roots = {4: _TrieNode(0, 0), 6: _TrieNode(0, 0)}
+
+  def Insert(self, addr, value):
+    """Add value to the values of the prefix of addr.
+
+    Args:
+      addr: nacaddr IPv4 or IPv6 object.
+      value: any object.
+    """
+    bits = addr._max_prefixlen
+    network = _Range(addr)[0]
+    prefixlen = addr._prefixlen
+    node = self._roots[addr._version]
+    while node.prefixlen != prefixlen:
+      bit = network >> (bits - node.prefixlen - 1) & 1
+      child = node.children[bit]
+      if child is None:
+        child = _TrieNode(network, prefixlen)
+        node.children[bit] = child
+        node = child
+        break
+      # length of the prefix shared by the child and addr.
+      common = min(child.prefixlen, prefixlen,
+                   bits - (child.network ^ network).bit_length())
+      if common < child.prefixlen:
+        # branch off the child, or insert addr above it.
+        branch = _TrieNode(network >> (bits - common) << (bits - common),
+                           common)
+        branch.children[child.network >> (bits - common - 1) & 1] = child
+        node.children[bit] = branch
+        child = branch
+      node = child
+    node.values.append(value)
+
+  def Containing(self, addr):
+    """Return the values of every prefix which contains addr.
+
+    Args:
+      addr: nacaddr IPv4 or IPv6 object.
+
+    Returns:
+      list of values, of the shortest prefixes first.
+    """
+    bits = addr._max_prefixlen
+    network = _Range(addr)[0]
+    prefixlen = addr._prefixlen
+    rval = []
+    node = self._roots[addr._version]
+    while (node is not None and node.prefixlen <= prefixlen and
+           network >> (bits - node.prefixlen) ==
+           node.network >> (bits - node.prefixlen)):
+      rval.extend(node.values)
+      if node.prefixlen == prefixlen:
+        break
+      node = node.children[network >> (bits - node.prefixlen - 1) & 1]
+    return rval
+
+
 class PrefixlenDiffInvalidError(ipaddr.NetmaskValueError):
   """Holdover from ipaddr v1."""
 
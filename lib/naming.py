@@ -30,6 +30,10 @@ Sample usage with definition files contained in ./acl/defs:
     networks = defs.GetNet('INTERNAL')
       returns a list of nacaddr.IPv4 object
 
+Parsed definitions can be saved to a snapshot, which later runs load in
+a single read for as long as the definition files don't change:
+    defs = Naming('acl/defs/', snapshot='acl/defs.snapshot')
+
 The definition files are contained in a single directory and
 may consist of multiple files ending in .net or .svc extensions,
 indicating network or service definitions respectively.  The
@@ -49,8 +53,16 @@ DNS = 53/tcp
 __author__ = 'watson@google.com (Tony Watson)'
 
 import glob
+import hashlib
+import logging
+import marshal
+import os
 
 import nacaddr
+from third_party import ipaddr
+
+# bumped whenever the snapshot format changes.
+_SNAPSHOT_VERSION = 1
 
 
 class Error(Exception):
@@ -85,6 +97,50 @@ class UnexpectedDefinitionType(Error):
   """An unexpected/unknown definition type was used."""
 
 
+class DefinitionCycleError(Error):
+  """Raised if a token includes itself, directly or through other tokens."""
+
+
+def _FileDigest(filename):
+  return hashlib.sha1(open(filename, 'rb').read()).hexdigest()
+
+
+def _CopyAddress(addr):
+  """Return a shallow copy of a nacaddr object, much cheaper than IP()."""
+  rval = object.__new__(addr.__class__)
+  rval.__dict__.update(addr.__dict__)
+  return rval
+
+
+def _AddressFromInts(templates, version, network, prefixlen, text, token):
+  """Return a nacaddr object for a network stored in a snapshot.
+
+  Instead of parsing the address again, a template of the same version and
+  prefix length is copied and given the network.
+
+  Args:
+    templates: dict of (version, prefixlen) -> template, filled as needed.
+    version: 4 or 6.
+    network: integer value of the network address.
+    prefixlen: prefix length.
+    text: comment of the address.
+    token: token the address is defined in.
+
+  Returns:
+    nacaddr.IPv4 or nacaddr.IPv6 object.
+  """
+  if (version, prefixlen) not in templates:
+    templates[version, prefixlen] = nacaddr.IP(
+        '%s/%d' % (ipaddr.IPAddress(0, version), prefixlen))
+  rval = _CopyAddress(templates[version, prefixlen])
+  rval._ip = network
+  rval.ip = ipaddr.IPAddress(network, version)
+  rval._cache = {}
+  rval.text = text
+  rval.token = rval.parent_token = token
+  return rval
+
+
 class _ItemUnit(object):
   """This class is a container for an index key and a list of associated values.
 
@@ -110,23 +166,134 @@ class Naming(object):
      networks: A collection of all the current network item tokens.
   """
 
-  def __init__(self, naming_dir=None, naming_file=None, naming_type=None):
-    """Set the default values for a new Naming object."""
+  def __init__(self, naming_dir=None, naming_file=None, naming_type=None,
+               snapshot=None):
+    """Set the default values for a new Naming object.
+
+    Args:
+      naming_dir: directory of the .net and .svc definition files.
+      naming_file: single definition file in naming_dir to parse instead.
+      naming_type: 'networks' or 'services', the type of naming_file.
+      snapshot: file to load the definitions of naming_dir from, and to save
+        them to when it is missing or out of date.
+    """
     self.current_symbol = None
     self.services = {}
     self.networks = {}
     self.unseen_services = {}
     self.unseen_networks = {}
+    # built when first needed by _NetworkIndex().
+    self._network_index = None
+    # token -> expansion, filled by GetNet() and GetService().
+    self._resolved_networks = {}
+    self._resolved_services = {}
+    # token -> expanded addresses as integer tuples, from a snapshot.
+    self._snapshot_networks = {}
+    self._address_templates = {}
+    # definition files parsed, in order.
+    self._source_files = []
     if naming_file and naming_type:
       filename = os.path.sep.join([naming_dir, naming_file])
       file_handle = gfile.GFile(filename, 'r')
       self._ParseFile(file_handle, naming_type)
     elif naming_dir:
+      if snapshot and self.LoadSnapshot(snapshot, naming_dir):
+        return
       self._Parse(naming_dir, 'services')
       self._CheckUnseen('services')
 
       self._Parse(naming_dir, 'networks')
       self._CheckUnseen('networks')
+      if snapshot:
+        try:
+          self.Compile(snapshot)
+        except (IOError, OSError) as e:
+          logging.warn('unable to write definitions snapshot %s: %s',
+                       snapshot, e)
+
+  def Compile(self, filename):
+    """Save the parsed definitions to a snapshot for LoadSnapshot().
+
+    Along with the definitions, the snapshot holds every token expanded,
+    networks as (version, network, prefixlen, comment, token) tuples of
+    integers and strings, and the mtime and hash of every definition file.
+
+    Args:
+      filename: file to write the snapshot to.
+    """
+    networks = {}
+    for token in self.networks:
+      try:
+        networks[token] = [
+            (x.version, int(x.network), x.prefixlen, x.text, x.token)
+            for x in self._ResolveNet(token, ())]
+      except Error:
+        # raised again when the token is used.
+        pass
+    services = {}
+    for token in self.services:
+      try:
+        services[token] = self._ResolveService(token, ())
+      except Error:
+        pass
+
+    data = {
+        'version': _SNAPSHOT_VERSION,
+        'sources': [(x, os.path.getmtime(x), _FileDigest(x))
+                    for x in self._source_files],
+        'networks': dict((x, y.items) for x, y in self.networks.iteritems()),
+        'services': dict((x, y.items) for x, y in self.services.iteritems()),
+        'resolved_networks': networks,
+        'resolved_services': services,
+    }
+    tmp_filename = '%s.tmp' % filename
+    output = open(tmp_filename, 'wb')
+    marshal.dump(data, output)
+    output.close()
+    os.rename(tmp_filename, filename)
+
+  def LoadSnapshot(self, filename, naming_dir):
+    """Load the definitions of naming_dir from a snapshot written by Compile().
+
+    A definition file whose mtime changed since is hashed, the snapshot is
+    only used if it still has the same contents.
+
+    Args:
+      filename: snapshot file.
+      naming_dir: directory of the .net and .svc definition files.
+
+    Returns:
+      True if the definitions were loaded, False if the snapshot is missing,
+      unreadable, or the definition files in naming_dir changed.
+    """
+    try:
+      data = marshal.loads(open(filename, 'rb').read())
+    except (IOError, EOFError, ValueError, TypeError):
+      return False
+    if not isinstance(data, dict) or data.get('version') != _SNAPSHOT_VERSION:
+      return False
+
+    source_files = (glob.glob(naming_dir + '/*.svc') +
+                    glob.glob(naming_dir + '/*.net'))
+    if sorted(source_files) != sorted(x[0] for x in data['sources']):
+      return False
+    try:
+      for source_file, mtime, digest in data['sources']:
+        if (os.path.getmtime(source_file) != mtime and
+            _FileDigest(source_file) != digest):
+          return False
+    except (IOError, OSError):
+      return False
+
+    for def_type in ('networks', 'services'):
+      units = getattr(self, def_type)
+      for token, items in data[def_type].iteritems():
+        units[token] = _ItemUnit(token)
+        units[token].items = items
+    self._snapshot_networks = data['resolved_networks']
+    self._resolved_services = data['resolved_services']
+    self._source_files = [x[0] for x in data['sources']]
+    return True
 
   def _CheckUnseen(self, def_type):
     if def_type == 'services':
@@ -140,48 +307,55 @@ class Naming(object):
             'The following tokens were nested as a values, but not defined',
             self.unseen_networks))
 
+  def _NetworkIndex(self):
+    """Return a (trie, parents) index of the network definitions.
+
+    trie is a nacaddr.PrefixTrie of every address in the definitions, to
+    the tokens they are defined in, and parents maps every token to the set
+    of tokens which include it.  The index is built the first time it is
+    needed, and again once definitions were added.
+    """
+    if self._network_index is None:
+      trie = nacaddr.PrefixTrie()
+      parents = {}
+      for token, unit in self.networks.iteritems():
+        for item in unit.items:
+          value = item.split('#')[0].strip()
+          try:
+            trie.Insert(nacaddr.IP(value), token)
+          except ValueError:
+            parents.setdefault(value, set()).add(token)
+      self._network_index = (trie, parents)
+    return self._network_index
+
   def GetIpParents(self, query):
     """Return network tokens that contain IP in query.
 
     Args:
-      query: an ip string ('10.1.1.1') or nacaddr.IP object
+      query: an ip string ('10.1.1.1'), a nacaddr.IP object or a token name.
+
+    Returns:
+      sorted list of the tokens which contain query, directly or through
+      the tokens they include.
     """
-    base_parents = []
-    recursive_parents = []
-    # convert string to nacaddr, if arg is ipaddr then convert str() to nacaddr
-    if type(query) != nacaddr.IPv4 and type(query) != nacaddr.IPv6:
-      if query[:1].isdigit():
+    trie, parents = self._NetworkIndex()
+    if not isinstance(query, (nacaddr.IPv4, nacaddr.IPv6)):
+      try:
         query = nacaddr.IP(query)
-    # Get parent token for an IP
-    if type(query) == nacaddr.IPv4 or type(query) == nacaddr.IPv6:
-      for token in self.networks:
-        for item in self.networks[token].items:
-          item = item.split('#')[0].strip()
-          if item[:1].isdigit() and nacaddr.IP(item).Contains(query):
-            base_parents.append(token)
-    # Get parent token for another token
+      except ValueError:
+        pass
+    if isinstance(query, (nacaddr.IPv4, nacaddr.IPv6)):
+      pending = trie.Containing(query)
     else:
-      for token in self.networks:
-        for item in self.networks[token].items:
-          item = item.split('#')[0].strip()
-          if item[:1].isalpha() and item == query:
-            base_parents.append(token)
-    # look for nested tokens
-    for bp in base_parents:
-      done = False
-      for token in self.networks:
-        if bp in self.networks[token].items:
-          # ignore IPs, only look at token values
-          if bp[:1].isalpha():
-            if bp not in recursive_parents:
-              recursive_parents.append(bp)
-              recursive_parents.extend(self.GetIpParents(bp))
-            done = True
-      # if no nested tokens, just append value
-      if not done:
-        if bp[:1].isalpha() and bp not in recursive_parents:
-          recursive_parents.append(bp)
-    return sorted(list(set(recursive_parents)))
+      pending = list(parents.get(query, ()))
+
+    rval = set()
+    while pending:
+      token = pending.pop()
+      if token not in rval:
+        rval.add(token)
+        pending.extend(parents.get(token, ()))
+    return sorted(rval)
 
   def GetServiceParents(self, query):
     """Given a query token, return list of services definitions with that token.
@@ -235,34 +409,50 @@ class Naming(object):
 
     Raises:
       UndefinedServiceError: If the service name isn't defined.
+      DefinitionCycleError: If the service includes itself.
     """
-    expandset = set()
-    already_done = set()
-    data = []
-    service_name = ''
-    data = query.split('#')     # Get the token keyword and remove any comment
-    service_name = data[0].split()[0]  # strip and cast from list to string
+    return list(self._ResolveService(query, ()))
+
+  def _ResolveService(self, query, parents):
+    """Return the sorted values of a service, expanding nested services once.
+
+    Args:
+      query: Service name symbol or token.
+      parents: tuple of the services being expanded which include query.
+
+    Returns:
+      The cached list of service values, which must not be modified.
+
+    Raises:
+      UndefinedServiceError: If the service name isn't defined.
+      DefinitionCycleError: If the service includes itself.
+    """
+    service_name = query.split('#')[0].split()[0]
+    resolved = self._resolved_services
+    if service_name in resolved:
+      return resolved[service_name]
     if service_name not in self.services:
       raise UndefinedServiceError('\nNo such service: %s' % query)
+    if service_name in parents:
+      raise DefinitionCycleError('Service %s includes itself: %s' % (
+          service_name, ' -> '.join(parents + (service_name,))))
 
-    already_done.add(service_name)
-
+    expandset = set()
     for next_item in self.services[service_name].items:
       # Remove any trailing comment.
       service = next_item.split('#')[0].strip()
       # Recognized token, not a value.
       if not '/' in service:
-        # Make sure we are not descending into recursion hell.
-        if service not in already_done:
-          already_done.add(service)
-          try:
-            expandset.update(self.GetService(service))
-          except UndefinedServiceError as e:
-            # One of the services in query is undefined, refine the error msg.
-            raise UndefinedServiceError('%s (in %s)' % (e, query))
+        try:
+          expandset.update(self._ResolveService(
+              service, parents + (service_name,)))
+        except UndefinedServiceError as e:
+          # One of the services in query is undefined, refine the error msg.
+          raise UndefinedServiceError('%s (in %s)' % (e, query))
       else:
         expandset.add(service)
-    return sorted(expandset)
+    resolved[service_name] = sorted(expandset)
+    return resolved[service_name]
 
   def GetServiceByProto(self, query, proto):
     """Given a service name, return list of ports in the service by protocol.
@@ -322,15 +512,45 @@ class Naming(object):
 
     Raises:
       UndefinedAddressError: for an undefined token value
+      DefinitionCycleError: If the network includes itself.
     """
+    token = query.split('#')[0].split()[0]
     returnlist = []
-    data = []
-    token = ''
-    data = query.split('#')     # Get the token keyword and remove any comment
-    token = data[0].split()[0]  # Remove whitespace and cast from list to string
+    # the cached objects are shared, hand out copies.
+    for addr in self._ResolveNet(token, ()):
+      addr = _CopyAddress(addr)
+      addr.parent_token = token
+      returnlist.append(addr)
+    return returnlist
+
+  def _ResolveNet(self, token, parents):
+    """Return the addresses of a network, expanding nested networks once.
+
+    Args:
+      token: Network definition token.
+      parents: tuple of the networks being expanded which include token.
+
+    Returns:
+      The cached list of nacaddr objects, which must not be modified.
+
+    Raises:
+      UndefinedAddressError: for an undefined token value
+      DefinitionCycleError: If the network includes itself.
+    """
+    resolved = self._resolved_networks
+    if token in resolved:
+      return resolved[token]
+    if token in self._snapshot_networks:
+      resolved[token] = [_AddressFromInts(self._address_templates, *x)
+                         for x in self._snapshot_networks[token]]
+      return resolved[token]
     if token not in self.networks:
       raise UndefinedAddressError('%s %s' % ('\nUNDEFINED:', str(token)))
+    if token in parents:
+      raise DefinitionCycleError('Network %s includes itself: %s' % (
+          token, ' -> '.join(parents + (token,))))
 
+    returnlist = []
     for next in self.networks[token].items:
       comment = ''
       if next.find('#') > -1:
@@ -351,9 +571,8 @@ class Naming(object):
       except ValueError:
         # if net was something like 'FOO', or the name of another token which
         # needs to be dereferenced, nacaddr.IP() will return a ValueError
-        returnlist.extend(self.GetNet(net))
-    for next in returnlist:
-      next.parent_token = token
+        returnlist.extend(self._ResolveNet(net, parents + (token,)))
+    resolved[token] = returnlist
     return returnlist
 
   def _Parse(self, defdirectory, def_type):
@@ -383,6 +602,7 @@ class Naming(object):
                                (def_type, defdirectory))
 
     for current_file in file_names:
+      self._source_files.append(current_file)
       try:
         file_handle = open(current_file, 'r').readlines()
         for line in file_handle:
@@ -438,6 +658,13 @@ class Naming(object):
     if definition_type not in ['services', 'networks']:
       raise UnexpectedDefinitionType('%s %s' % (
           'Received an unexpected defintion type:', definition_type))
+    # definitions are being added, drop what was built from the old ones.
+    if definition_type == 'networks':
+      self._network_index = None
+      self._resolved_networks = {}
+      self._snapshot_networks = {}
+    else:
+      self._resolved_services = {}
     line = line.strip()
     if not line or line.startswith('#'):  # Skip comments and blanks.
       return
@@ -158,8 +158,11 @@ class Term(aclgenerator.Term):
     unsupported_keywords = []
     for key  in term_keywords:
       if term_keywords[key]:
-        # translated is obj attribute not keyword
-        if ('translated' not in key) and (key not in _NSXV_SUPPORTED_KEYWORDS):
+        # translated, the ranges and the tokens are obj attributes not
+        # keywords
+        if ('translated' not in key) and (not key.endswith('_ranges')) and (
+            not key.endswith('_tokens')) and (
+                key not in _NSXV_SUPPORTED_KEYWORDS):
           unsupported_keywords.append(key)
     if unsupported_keywords:
       logging.warn('WARNING: The keywords %s in Term %s are not supported in Nsxv '
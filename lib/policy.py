@@ -18,6 +18,7 @@
 """Parses the generic policy files and return a policy object for acl rendering.
 """
 
+import copy
 import datetime
 from functools import wraps
 import os
@@ -31,12 +32,12 @@ from third_party.ply import lex
 from third_party.ply import yacc
 
 
-DEFINITIONS = None
 DEFAULT_DEFINITIONS = './def'
 _ACTIONS = set(('accept', 'deny', 'reject', 'next', 'reject-with-tcp-rst'))
 _LOGGING = set(('true', 'True', 'syslog', 'local', 'disable'))
-_OPTIMIZE = True
-_SHADE_CHECK = False
+# Location of the cached LALR parser tables, see _BuildParser().
+_PARSETAB = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'parsetab.pickle')
 
 
 class Error(Exception):
@@ -103,13 +104,14 @@ class ShadingError(Error):
   """Error when a term is shaded by a prior term."""
 
 
-def TranslatePorts(ports, protocols, term_name):
+def TranslatePorts(ports, protocols, term_name, definitions):
   """Return all ports of all protocols requested.
 
   Args:
     ports: list of ports, eg ['SMTP', 'DNS', 'HIGH_PORTS']
     protocols: list of protocols, eg ['tcp', 'udp']
     term_name: name of current term, used for warning messages
+    definitions: naming.Naming object used to expand service tokens
 
   Returns:
     ret_array: list of ports tuples such as [(25,25), (53,53), (1024,65535)]
@@ -120,7 +122,7 @@ def TranslatePorts(ports, protocols, term_name):
   ret_array = []
   for proto in protocols:
     for port in ports:
-      service_by_proto = DEFINITIONS.GetServiceByProto(port, proto)
+      service_by_proto = definitions.GetServiceByProto(port, proto)
       if not service_by_proto:
         logging.warn('%s %s %s %s %s %s%s %s', 'Term', term_name,
                      'has service', port, 'which is not defined with protocol',
@@ -136,11 +138,335 @@ def TranslatePorts(ports, protocols, term_name):
   return ret_array
 
 
+def _MergeRanges(ranges):
+  """Return a sorted tuple of non overlapping, non adjacent integer ranges.
+
+  Args:
+    ranges: iterable of (first, last) tuples.
+
+  Returns:
+    tuple of (first, last) tuples covering the same integers as ranges.
+  """
+  merged = []
+  for first, last in sorted(ranges):
+    if merged and first <= merged[-1][1] + 1:
+      if last > merged[-1][1]:
+        merged[-1] = (merged[-1][0], last)
+    else:
+      merged.append((first, last))
+  return tuple(merged)
+
+
+def _SubtractRanges(ranges, excludes):
+  """Return the parts of merged ranges not covered by merged excludes."""
+  if not excludes:
+    return ranges
+  remaining = []
+  index = 0
+  for first, last in ranges:
+    # excludes ending before this range can't overlap any range left.
+    while index < len(excludes) and excludes[index][1] < first:
+      index += 1
+    overlap = index
+    while overlap < len(excludes) and excludes[overlap][0] <= last:
+      if excludes[overlap][0] > first:
+        remaining.append((first, excludes[overlap][0] - 1))
+      first = max(first, excludes[overlap][1] + 1)
+      overlap += 1
+    if first <= last:
+      remaining.append((first, last))
+  return tuple(remaining)
+
+
+def _RangesContained(superset, subset):
+  """Check if every integer of subset is in superset, both merged ranges.
+
+  Like Term.CheckAddressIsContained, an empty superset contains anything
+  and an empty subset is contained by nothing else.
+
+  Returns:
+    bool: True if subset is contained in superset.
+  """
+  if not superset:
+    return True
+  if not subset:
+    return False
+  index = 0
+  for first, last in subset:
+    # the only range of superset which may contain first.
+    while index < len(superset) and superset[index][1] < first:
+      index += 1
+    if (index == len(superset) or superset[index][0] > first or
+        superset[index][1] < last):
+      return False
+  return True
+
+
+# IPv6 address ranges are offset by this, so that the ranges of both address
+# families sort and compare as one space without ever overlapping.
+_IPV6_OFFSET = 1 << 128
+
+
+def _AddressRanges(addresses, excludes=()):
+  """Return the merged integer ranges of addresses, less excludes."""
+  ranges = []
+  for addr_list in (addresses, excludes):
+    addr_ranges = []
+    for addr in addr_list:
+      first, last = nacaddr._Range(addr)
+      if addr._version == 6:
+        first += _IPV6_OFFSET
+        last += _IPV6_OFFSET
+      addr_ranges.append((first, last))
+    ranges.append(_MergeRanges(addr_ranges))
+  return _SubtractRanges(*ranges)
+
+
+def _PortRanges(ports):
+  """Return the merged integer ranges of a list of port tuples."""
+  return _MergeRanges((int(first), int(last)) for first, last in ports)
+
+
+class _RangeIndex(object):
+  """Values indexed by integer ranges, found by an integer they contain.
+
+  Each range is split into aligned power of two blocks, like a network into
+  CIDR blocks, a lookup checks the block of each size used.
+  """
+
+  def __init__(self, bits):
+    self._bits = bits
+    self._blocks = {}
+    self._prefixlens = set()
+
+  def Add(self, ranges, value):
+    for first, last in ranges:
+      for network, prefixlen in nacaddr._RangeToPrefixes(first, last,
+                                                         self._bits):
+        self._prefixlens.add(prefixlen)
+        self._blocks.setdefault(
+            (prefixlen, network >> (self._bits - prefixlen)), set()).add(value)
+
+  def Containing(self, point):
+    """Return the set of values of every range which contains point."""
+    rval = set()
+    for prefixlen in self._prefixlens:
+      rval.update(self._blocks.get((prefixlen,
+                                    point >> (self._bits - prefixlen)), ()))
+    return rval
+
+
+class _ShadingIndex(object):
+  """Index of the terms of a filter which may shade the terms after them.
+
+  Term.__contains__ is exact but slow, comparing a term against every term
+  before it is quadratic in the size of the filter.  A term can only shade
+  another one if it has the same verbatim text, compatible protocols, and
+  contains the first of its source address, destination address and
+  destination port ranges.  The terms are indexed by each of those so that
+  only the terms which pass all of them have to be compared.
+  """
+
+  # Term range attribute -> bits of the integers in the ranges.
+  _RANGES = (('source_address_ranges', 129),
+             ('destination_address_ranges', 129),
+             ('destination_port_ranges', 16))
+
+  def __init__(self):
+    # terms without a value for a field, which match any value of it.
+    self._unconstrained = dict((x, set()) for x in
+                               ['protocol'] + [x for x, _ in self._RANGES])
+    self._verbatim = {}
+    self._protocols = {}
+    self._ranges = dict((x, _RangeIndex(bits)) for x, bits in self._RANGES)
+
+  @staticmethod
+  def _VerbatimKey(term):
+    """Return the verbatim text of a term as a hashable value."""
+    # VarType objects compare by value, but hash by identity.
+    return tuple(sorted(tuple(x.value) for x in term.verbatim))
+
+  def Add(self, index, term):
+    """Index a term which can shade the terms after it.
+
+    Args:
+      index: position of the term in its filter.
+      term: translated Term object.
+    """
+    self._verbatim.setdefault(self._VerbatimKey(term), set()).add(index)
+    if term.protocol:
+      self._protocols.setdefault(frozenset(term.protocol), set()).add(index)
+    else:
+      self._unconstrained['protocol'].add(index)
+    for name, _ in self._RANGES:
+      ranges = getattr(term, name)
+      if not ranges:
+        self._unconstrained[name].add(index)
+      self._ranges[name].Add(ranges, index)
+
+  def Candidates(self, term, covering=False):
+    """Return the indexed terms which may contain a term.
+
+    Args:
+      term: translated Term object.
+      covering: bool - find the terms which match all of the protocols of
+        term, rather than the terms Term.__contains__ may find.
+
+    Returns:
+      set of the indexes of the terms.
+    """
+    candidates = [self._verbatim.get(self._VerbatimKey(term), set())]
+
+    # Term.__contains__ compares protocols the other way around from the
+    # other fields, a term with protocols can only shade a term which has
+    # all of them.
+    protocol = set(self._unconstrained['protocol'])
+    if term.protocol:
+      for protocols, indexes in self._protocols.iteritems():
+        if covering:
+          if protocols.issuperset(term.protocol):
+            protocol.update(indexes)
+        elif protocols.issubset(term.protocol):
+          protocol.update(indexes)
+    candidates.append(protocol)
+
+    for name, _ in self._RANGES:
+      ranges = getattr(term, name)
+      matches = set(self._unconstrained[name])
+      if ranges:
+        matches.update(self._ranges[name].Containing(ranges[0][0]))
+      candidates.append(matches)
+
+    candidates.sort(key=len)
+    return candidates[0].intersection(*candidates[1:])
+
+
+# Term attributes which are derived from the others, or don't affect which
+# packets a term matches.
+_DERIVED_ATTRIBUTES = frozenset(['name', 'comment', 'translated', 'flattened',
+                                 'flattened_addr', 'flattened_saddr',
+                                 'flattened_daddr', 'address_ranges',
+                                 'source_address_ranges',
+                                 'destination_address_ranges', 'port_ranges',
+                                 'source_port_ranges',
+                                 'destination_port_ranges', 'address_tokens'])
+
+# Term attributes two otherwise identical adjacent terms may be merged by.
+_MERGE_FIELDS = ('source_address', 'destination_address', 'source_port',
+                 'destination_port', 'protocol')
+
+
+def _TermAttributes(term, ignore=()):
+  """Return a dict of the attributes of a term, less the derived ones."""
+  return dict((k, v) for k, v in term.__dict__.iteritems()
+              if k not in _DERIVED_ATTRIBUTES and k not in ignore)
+
+
+def _RuleCount(term):
+  """Return the rules a term renders to on targets with one rule per match.
+
+  iptables, packetfilter and the cisco style acls render a rule for every
+  combination of protocol, addresses and ports of a term.
+  """
+  count = 1
+  for field in _MERGE_FIELDS:
+    count *= len(getattr(term, field)) or 1
+  return count
+
+
+def _Covers(prior, term):
+  """Check if every packet term matches is matched by prior first.
+
+  Unlike Term.__contains__ this only finds a term redundant when prior has
+  the same action, logging, counter and options, so that dropping the term
+  makes no difference whatsoever.
+
+  Args:
+    prior: translated Term object, before term.
+    term: translated Term object.
+
+  Returns:
+    bool: True if term can be dropped.
+  """
+  if 'next' in prior.action or prior.verbatim or term.verbatim:
+    return False
+  ignore = _MERGE_FIELDS + ('source_address_exclude',
+                            'destination_address_exclude', 'expiration')
+  if _TermAttributes(prior, ignore) != _TermAttributes(term, ignore):
+    return False
+  # the term becomes reachable when prior expires.
+  if prior.expiration and not (term.expiration and
+                               term.expiration <= prior.expiration):
+    return False
+  if prior.protocol and not (
+      term.protocol and set(term.protocol).issubset(prior.protocol)):
+    return False
+  for field in ('source_address', 'destination_address'):
+    # addresses which are all excluded match nothing rather than anything.
+    if getattr(prior, field) and not getattr(prior, field + '_ranges'):
+      return False
+  for field in ('source_address', 'destination_address', 'source_port',
+                'destination_port'):
+    if not _RangesContained(getattr(prior, field + '_ranges'),
+                            getattr(term, field + '_ranges')):
+      return False
+  return True
+
+
+def _MergeTerm(first, second):
+  """Return a term matching the packets of two adjacent terms, or None.
+
+  Terms can only be merged if they don't have a next action and only differ
+  in one of the _MERGE_FIELDS, both having a value for it.  The merged term
+  keeps the name of the first term and the comments of both.
+
+  Args:
+    first: translated Term object.
+    second: translated Term object, right after first.
+
+  Returns:
+    Term object or None.
+  """
+  if 'next' in first.action or first.verbatim:
+    return None
+  first_attributes = _TermAttributes(first)
+  second_attributes = _TermAttributes(second)
+  fields = [x for x in first_attributes
+            if first_attributes[x] != second_attributes[x]]
+  if len(fields) != 1 or fields[0] not in _MERGE_FIELDS:
+    return None
+  field = fields[0]
+  if not (getattr(first, field) and getattr(second, field)):
+    return None
+  # icmp types are only valid with the icmp protocols.
+  if field == 'protocol' and first.icmp_type:
+    return None
+
+  values = getattr(first, field) + getattr(second, field)
+  if field in ('source_address', 'destination_address'):
+    values = nacaddr.CollapseAddrList(values)
+  elif field == 'protocol':
+    values = [x for i, x in enumerate(values) if x not in values[:i]]
+  else:
+    values = first.CollapsePortList(values)
+  merged = first.Copy()
+  setattr(merged, field, values)
+  if field in ('source_address', 'destination_address'):
+    merged.address_tokens = dict(first.address_tokens)
+    merged.address_tokens[field] = (first.address_tokens.get(field, []) +
+                                    second.address_tokens.get(field, []))
+  merged.comment.extend(x for x in second.comment if x not in first.comment)
+  merged.flattened = False
+  merged.BuildRanges()
+  return merged
+
+
 # classes for storing the object types in the policy files.
 class Policy(object):
   """The policy object contains everything found in a given policy file."""
 
-  def __init__(self, header, terms):
+  def __init__(self, header, terms, definitions, optimize=True,
+               shade_check=False):
     """Initiator for the Policy object.
 
     Args:
@@ -151,20 +477,27 @@ class Policy(object):
       terms: list __main__.Term. an array of Term objects which must be rendered
         in each of the rendered acls.
 
+      definitions: naming.Naming object used to expand service tokens.
+
+      optimize: bool - whether to summarize networks and services.
+
+      shade_check: bool - whether to raise an exception when a term is shaded.
+
     Attributes:
       filters: list of tuples containing (header, terms).
     """
     self.filters = []
-    self.AddFilter(header, terms)
+    self.AddFilter(header, terms, definitions, optimize, shade_check)
 
-  def AddFilter(self, header, terms):
+  def AddFilter(self, header, terms, definitions, optimize=True,
+                shade_check=False):
     """Add another header & filter."""
     self.filters.append((header, terms))
-    self._TranslateTerms(terms)
-    if _SHADE_CHECK:
+    self._TranslateTerms(terms, definitions, optimize)
+    if shade_check:
       self._DetectShading(terms)
 
-  def _TranslateTerms(self, terms):
+  def _TranslateTerms(self, terms, definitions, optimize):
     """."""
     if not terms:
       raise NoTermsError('no terms found')
@@ -174,33 +507,49 @@ class Policy(object):
       if term.translated:
         continue
       if term.port:
-        term.port = TranslatePorts(term.port, term.protocol, term.name)
+        term.port = TranslatePorts(term.port, term.protocol, term.name,
+                                   definitions)
         if not term.port:
           raise TermPortProtocolError(
               'no ports of the correct protocol for term %s' % (
                   term.name))
       if term.source_port:
         term.source_port = TranslatePorts(term.source_port, term.protocol,
-                                          term.name)
+                                          term.name, definitions)
         if not term.source_port:
           raise TermPortProtocolError(
               'no source ports of the correct protocol for term %s' % (
                   term.name))
       if term.destination_port:
         term.destination_port = TranslatePorts(term.destination_port,
-                                               term.protocol, term.name)
+                                               term.protocol, term.name,
+                                               definitions)
         if not term.destination_port:
           raise TermPortProtocolError(
               'no destination ports of the correct protocol for term %s' % (
                   term.name))
 
       # If argument is true, we optimize, otherwise just sort addresses
-      term.AddressCleanup(_OPTIMIZE)
-      # Reset _OPTIMIZE global to default value
-      globals()['_OPTIMIZE'] = True
+      term.AddressCleanup(optimize)
       term.SanityCheck()
+      term.BuildRanges()
       term.translated = True
 
+  def Copy(self):
+    """Return a copy of the policy for a generator to render.
+
+    Generators modify the headers and terms they render, each one renders
+    its own copy so the parsed policy can be shared between them.  See
+    Term.Copy() for what is shared with the copy.
+
+    Returns:
+      Policy
+    """
+    pol = copy.copy(self)
+    pol.filters = [(header.Copy(), [term.Copy() for term in terms])
+                   for header, terms in self.filters]
+    return pol
+
   @property
   def headers(self):
     """Returns the headers from each of the configured filters.
@@ -215,7 +564,8 @@ class Policy(object):
 
     Iterate through each term, looking at each prior term. If a prior term
     contains every component of the current term then the current term would
-    never be hit and is thus shaded. This can be a mistake.
+    never be hit and is thus shaded. This can be a mistake.  Only the prior
+    terms found by a _ShadingIndex are compared.
 
     Args:
       terms: list of Term objects.
@@ -223,27 +573,68 @@ class Policy(object):
     Raises:
       ShadingError: When a term is impossible to reach.
     """
-    # Reset _OPTIMIZE global to default value
-    globals()['_SHADE_CHECK'] = False
     shading_errors = []
-    for index, term in enumerate(terms):
-      for prior_index in xrange(index):
-        # Check each term that came before for shading. Terms with next as an
-        # action do not terminate evaluation, so cannot shade.
-        if (term in terms[prior_index]
-            and 'next' not in terms[prior_index].action):
+    index = _ShadingIndex()
+    for term_index, term in enumerate(terms):
+      for prior_index in sorted(index.Candidates(term)):
+        if term in terms[prior_index]:
           shading_errors.append(
               '  %s is shaded by %s.' % (
                   term.name, terms[prior_index].name))
+      # Terms with next as an action do not terminate evaluation, so cannot
+      # shade.
+      if 'next' not in term.action:
+        index.Add(term_index, term)
     if shading_errors:
       raise ShadingError('\n'.join(shading_errors))
 
+  def MergeTerms(self):
+    """Drop redundant terms and merge adjacent terms of every filter.
+
+    A term is dropped when a term before it with the same action, logging,
+    counter and options matches every packet it does.  Then adjacent terms
+    which only differ in their sources, destinations, ports or protocols
+    are merged into one.  Terms with a next action are never merged and
+    never drop others, and no term is renamed.
+
+    Returns:
+      list of (header, terms before, terms after, rules before, rules after)
+      tuples for each filter, where rules are the rules rendered by targets
+      with one rule per combination of protocol, addresses and ports.
+    """
+    savings = []
+    for filter_index, (header, terms) in enumerate(self.filters):
+      kept = []
+      index = _ShadingIndex()
+      for term in terms:
+        if any(_Covers(kept[x], term)
+               for x in sorted(index.Candidates(term, covering=True))):
+          continue
+        if 'next' not in term.action:
+          index.Add(len(kept), term)
+        kept.append(term)
+
+      merged_terms = []
+      for term in kept:
+        merged = merged_terms and _MergeTerm(merged_terms[-1], term)
+        if merged:
+          merged_terms[-1] = merged
+        else:
+          merged_terms.append(term)
+
+      self.filters[filter_index] = (header, merged_terms)
+      savings.append((header, len(terms), len(merged_terms),
+                      sum(_RuleCount(x) for x in terms),
+                      sum(_RuleCount(x) for x in merged_terms)))
+    return savings
+
 
 class Term(object):
   """The Term object is used to store each of the terms.
 
   Args:
     obj: an object of type VarType or a list of objects of type VarType
+    definitions: naming.Naming object used to expand address tokens
 
   members:
     address/source_address/destination_address/: list of
@@ -313,7 +704,14 @@ class Term(object):
                   },
               }
 
-  def __init__(self, obj):
+  # copies of a term share these lists, see Copy().
+  _SHARED_ATTRIBUTES = frozenset([
+      'address', 'address_exclude', 'destination_address',
+      'destination_address_exclude', 'source_address',
+      'source_address_exclude', 'flattened_addr', 'flattened_daddr',
+      'flattened_saddr'])
+
+  def __init__(self, obj, definitions=None):
     self.name = None
 
     self.action = []
@@ -363,10 +761,20 @@ class Term(object):
     self.flattened_addr = None
     self.flattened_saddr = None
     self.flattened_daddr = None
+    # address attribute -> names of the tokens it was expanded from.
+    self.address_tokens = {}
+    # integer ranges of the addresses less excludes and of the ports, see
+    # BuildRanges().
+    self.address_ranges = None
+    self.source_address_ranges = None
+    self.destination_address_ranges = None
+    self.port_ranges = None
+    self.source_port_ranges = None
+    self.destination_port_ranges = None
 
     # AddObject touches variables which might not have been initialized
     # further up so this has to be at the end.
-    self.AddObject(obj)
+    self.AddObject(obj, definitions)
 
   def __contains__(self, other):
     """Determine if other term is contained in this term."""
@@ -400,21 +808,20 @@ class Term(object):
       else:
         return False
 
-    # combine addresses with exclusions for proper contains comparisons.
-    if not self.flattened:
-      self.FlattenAll()
-    if not other.flattened:
-      other.FlattenAll()
+    # addresses and ports are compared as integer ranges, with the excludes
+    # removed from the addresses.
+    if self.source_address_ranges is None:
+      self.BuildRanges()
+    if other.source_address_ranges is None:
+      other.BuildRanges()
 
     # flat 'address' is compared against other flat (saddr|daddr).
     # if NONE of these evaluate to True other is not contained.
     if not (
-        self.CheckAddressIsContained(
-            self.flattened_addr, other.flattened_addr)
-        or self.CheckAddressIsContained(
-            self.flattened_addr, other.flattened_saddr)
-        or self.CheckAddressIsContained(
-            self.flattened_addr, other.flattened_daddr)):
+        _RangesContained(self.address_ranges, other.address_ranges)
+        or _RangesContained(self.address_ranges, other.source_address_ranges)
+        or _RangesContained(self.address_ranges,
+                            other.destination_address_ranges)):
       return False
 
     # compare flat address from other to flattened self (saddr|daddr).
@@ -422,20 +829,17 @@ class Term(object):
         # other's flat address needs both self saddr & daddr to contain in order
         # for the term to be contained. We already compared the flattened_addr
         # attributes of both above, which was not contained.
-        self.CheckAddressIsContained(
-            other.flattened_addr, self.flattened_saddr)
-        and self.CheckAddressIsContained(
-            other.flattened_addr, self.flattened_daddr)):
+        _RangesContained(other.address_ranges, self.source_address_ranges)
+        and _RangesContained(other.address_ranges,
+                             self.destination_address_ranges)):
       return False
 
     # basic saddr/daddr check.
-    if not (
-        self.CheckAddressIsContained(
-            self.flattened_saddr, other.flattened_saddr)):
+    if not _RangesContained(self.source_address_ranges,
+                            other.source_address_ranges):
       return False
-    if not (
-        self.CheckAddressIsContained(
-            self.flattened_daddr, other.flattened_daddr)):
+    if not _RangesContained(self.destination_address_ranges,
+                            other.destination_address_ranges):
       return False
 
     if not (
@@ -446,15 +850,16 @@ class Term(object):
     # check ports
     # like the address directive, the port directive is special in that it can
     # be either source or destination.
-    if self.port:
-      if not (self.CheckPortIsContained(self.port, other.port) or
-              self.CheckPortIsContained(self.port, other.sport) or
-              self.CheckPortIsContained(self.port, other.dport)):
+    if self.port_ranges:
+      if not (_RangesContained(self.port_ranges, other.port_ranges) or
+              _RangesContained(self.port_ranges, other.source_port_ranges) or
+              _RangesContained(self.port_ranges,
+                               other.destination_port_ranges)):
         return False
-    if not self.CheckPortIsContained(self.source_port, other.source_port):
+    if not _RangesContained(self.source_port_ranges, other.source_port_ranges):
       return False
-    if not self.CheckPortIsContained(self.destination_port,
-                                     other.destination_port):
+    if not _RangesContained(self.destination_port_ranges,
+                            other.destination_port_ranges):
       return False
 
     # prefix lists
@@ -671,6 +1076,42 @@ class Term(object):
   def __ne__(self, other):
     return not self.__eq__(other)
 
+  def Copy(self):
+    """Return a copy of the term which can be modified independently.
+
+    Address lists can hold thousands of nacaddr objects, rather than being
+    copied they are shared with the copy, so they must be replaced instead
+    of modified in place, eg:
+      term.source_address = nacaddr.RemoveAddressFromList(...)
+    Every other list attribute is copied.
+
+    Returns:
+      Term
+    """
+    term = copy.copy(self)
+    for name, value in self.__dict__.iteritems():
+      if isinstance(value, list) and name not in self._SHARED_ATTRIBUTES:
+        setattr(term, name, list(value))
+    return term
+
+  def BuildRanges(self):
+    """Build the integer ranges __contains__ compares terms by.
+
+    Populates self.address_ranges, self.source_address_ranges and
+    self.destination_address_ranges with the addresses less their excludes,
+    and self.port_ranges, self.source_port_ranges and
+    self.destination_port_ranges.  Each is a sorted tuple of merged
+    (first, last) tuples, IPv6 addresses are offset by 2**128.
+    """
+    self.address_ranges = _AddressRanges(self.address, self.address_exclude)
+    self.source_address_ranges = _AddressRanges(self.source_address,
+                                                self.source_address_exclude)
+    self.destination_address_ranges = _AddressRanges(
+        self.destination_address, self.destination_address_exclude)
+    self.port_ranges = _PortRanges(self.port)
+    self.source_port_ranges = _PortRanges(self.source_port)
+    self.destination_port_ranges = _PortRanges(self.destination_port)
+
   def FlattenAll(self):
     """Reduce source, dest, and address fields to their post-exclude state.
 
@@ -739,12 +1180,14 @@ class Term(object):
 
     return filter(lambda x: x.version == af, eval('self.' + addr_type))
 
-  def AddObject(self, obj):
+  def AddObject(self, obj, definitions=None):
     """Add an object of unknown type to this term.
 
     Args:
       obj: single or list of either
         [Address, Port, Option, Protocol, Counter, Action, Comment, Expiration]
+      definitions: naming.Naming object used to expand address tokens, only
+        required when obj contains addresses.
 
     Raises:
       InvalidTermActionError: if the action defined isn't an accepted action.
@@ -758,24 +1201,27 @@ class Term(object):
         # do we have a list of addresses?
         # expanded address fields consolidate naked address fields with
         # saddr/daddr.
+        if x.var_type in _ADDRESS_ATTRIBUTES:
+          self.address_tokens.setdefault(
+              _ADDRESS_ATTRIBUTES[x.var_type], []).append(x.value)
         if x.var_type is VarType.SADDRESS:
-          saddr = DEFINITIONS.GetNetAddr(x.value)
+          saddr = definitions.GetNetAddr(x.value)
           self.source_address.extend(saddr)
         elif x.var_type is VarType.DADDRESS:
-          daddr = DEFINITIONS.GetNetAddr(x.value)
+          daddr = definitions.GetNetAddr(x.value)
           self.destination_address.extend(daddr)
         elif x.var_type is VarType.ADDRESS:
-          addr = DEFINITIONS.GetNetAddr(x.value)
+          addr = definitions.GetNetAddr(x.value)
           self.address.extend(addr)
         # do we have address excludes?
         elif x.var_type is VarType.SADDREXCLUDE:
-          saddr_exclude = DEFINITIONS.GetNetAddr(x.value)
+          saddr_exclude = definitions.GetNetAddr(x.value)
           self.source_address_exclude.extend(saddr_exclude)
         elif x.var_type is VarType.DADDREXCLUDE:
-          daddr_exclude = DEFINITIONS.GetNetAddr(x.value)
+          daddr_exclude = definitions.GetNetAddr(x.value)
           self.destination_address_exclude.extend(daddr_exclude)
         elif x.var_type is VarType.ADDREXCLUDE:
-          addr_exclude = DEFINITIONS.GetNetAddr(x.value)
+          addr_exclude = definitions.GetNetAddr(x.value)
           self.address_exclude.extend(addr_exclude)
         # do we have a list of ports?
         elif x.var_type is VarType.PORT:
@@ -1158,7 +1604,23 @@ class VarType(object):
     return self.value
 
   def __eq__(self, other):
-    return self.var_type == other.var_type and self.value == other.value
+    return (isinstance(other, VarType) and self.var_type == other.var_type and
+            self.value == other.value)
+
+  def __ne__(self, other):
+    return not self == other
+
+
+
+# address VarTypes -> the Term attribute holding their addresses.
+_ADDRESS_ATTRIBUTES = {
+    VarType.ADDRESS: 'address',
+    VarType.ADDREXCLUDE: 'address_exclude',
+    VarType.SADDRESS: 'source_address',
+    VarType.SADDREXCLUDE: 'source_address_exclude',
+    VarType.DADDRESS: 'destination_address',
+    VarType.DADDREXCLUDE: 'destination_address_exclude',
+}
 
 
 class Header(object):
@@ -1179,6 +1641,16 @@ class Header(object):
     elif obj.var_type == VarType.COMMENT:
       self.comment.append(str(obj))
 
+  def Copy(self):
+    """Return a copy of the header whose target options can be modified."""
+    header = copy.copy(self)
+    header.comment = list(self.comment)
+    header.target = [copy.copy(x) for x in self.target]
+    for target in header.target:
+      if target.options:
+        target.options = list(target.options)
+    return header
+
   @property
   def platforms(self):
     """The platform targets of this particular header."""
@@ -1383,11 +1855,14 @@ def p_target(p):
   """ target : target header terms
              | """
   if len(p) > 1:
+    context = p.parser.policy_parser
     if type(p[1]) is Policy:
-      p[1].AddFilter(p[2], p[3])
+      p[1].AddFilter(p[2], p[3], context.definitions, context.optimize,
+                     context.shade_check)
       p[0] = p[1]
     else:
-      p[0] = Policy(p[2], p[3])
+      p[0] = Policy(p[2], p[3], context.definitions, context.optimize,
+                    context.shade_check)
 
 
 def p_header(p):
@@ -1458,11 +1933,12 @@ def p_term_spec(p):
                 | term_spec verbatim_spec
                 | """
   if len(p) > 1:
+    definitions = p.parser.policy_parser.definitions
     if type(p[1]) == Term:
-      p[1].AddObject(p[2])
+      p[1].AddObject(p[2], definitions)
       p[0] = p[1]
     else:
-      p[0] = Term(p[2])
+      p[0] = Term(p[2], definitions)
 
 
 def p_routinginstance_spec(p):
@@ -1716,13 +2192,12 @@ def p_strings_or_ints(p):
 
 def p_error(p):
   """."""
-  next_token = yacc.token()
-  if next_token is None:
-    use_token = 'EOF'
-  else:
-    use_token = repr(next_token.value)
-
   if p:
+    next_token = p.lexer.token()
+    if next_token is None:
+      use_token = 'EOF'
+    else:
+      use_token = repr(next_token.value)
     raise ParseError(' ERROR on "%s" (type %s, line %d, Next %s)'
                      % (p.value, p.type, p.lineno, use_token))
   else:
@@ -1771,7 +2246,7 @@ def _ReadFile(filename):
     raise FileNotFoundError('Unable to open policy file %s' % filename)
 
 
-def _Preprocess(data, max_depth=5, base_dir=''):
+def _Preprocess(data, max_depth=5, base_dir='', includes=None):
   """Search input for include statements and import specified include file.
 
   Search input for include statements and if found, import specified file
@@ -1781,6 +2256,7 @@ def _Preprocess(data, max_depth=5, base_dir=''):
     data: A string of Policy file data.
     max_depth: Maximum depth of included files
     base_dir: Base path string where to look for policy or include files
+    includes: optional list, the path of every included file is appended
 
   Returns:
     A string containing result of the processed input data
@@ -1797,16 +2273,74 @@ def _Preprocess(data, max_depth=5, base_dir=''):
     words = line.split()
     if len(words) > 1 and words[0] == '#include':
       # remove any quotes around included filename
-      include_file = words[1].strip('\'"')
-      data = _ReadFile(os.path.join(base_dir, include_file))
+      include_file = os.path.join(base_dir, words[1].strip('\'"'))
+      if includes is not None:
+        includes.append(include_file)
+      data = _ReadFile(include_file)
       # recursively handle includes in included data
-      inc_data = _Preprocess(data, max_depth - 1, base_dir=base_dir)
+      inc_data = _Preprocess(data, max_depth - 1, base_dir=base_dir,
+                             includes=includes)
       rval.extend(inc_data)
     else:
       rval.append(line)
   return rval
 
 
+class Dependencies(object):
+  """Everything a policy file refers to which may change its rendered output.
+
+  Attributes:
+    includes: list of included file names, in the order they are included.
+    networks: set of network tokens referenced by the terms.
+    services: set of service tokens referenced by the terms.
+    expirations: list of datetime.date term expiration dates.
+  """
+
+  # token types whose values are network or service tokens.
+  _NETWORK_KEYWORDS = set(('ADDR', 'ADDREXCLUDE', 'DADDR', 'DADDREXCLUDE',
+                           'SADDR', 'SADDREXCLUDE'))
+  _SERVICE_KEYWORDS = set(('DPORT', 'PORT', 'SPORT'))
+
+  def __init__(self, data, base_dir='', includes=None):
+    """Collect the dependencies of a policy without parsing it.
+
+    Tokenizing the policy is enough to tell which values follow which
+    keywords, and doesn't need any definitions.
+
+    Args:
+      data: a string blob of policy data.
+      base_dir: base path string to look for include files.
+      includes: optional list the included file names are appended to,
+        which keeps those found before an include failed to be read.
+    """
+    if includes is None:
+      includes = []
+    self.includes = includes
+    self.networks = set()
+    self.services = set()
+    self.expirations = []
+
+    lexer = _LEXER.clone()
+    lexer.input('\n'.join(_Preprocess(data, base_dir=base_dir,
+                                      includes=self.includes)))
+    keyword = None
+    date = []
+    for tok in iter(lexer.token, None):
+      if tok.type == 'STRING':
+        if keyword in self._NETWORK_KEYWORDS:
+          self.networks.add(tok.value)
+        elif keyword in self._SERVICE_KEYWORDS:
+          self.services.add(tok.value)
+      elif tok.type == 'INTEGER':
+        if keyword == 'EXPIRATION':
+          date.append(int(tok.value))
+          if len(date) == 3:
+            self.expirations.append(datetime.date(*date))
+      elif tok.type not in literals:
+        keyword = tok.type
+        date = []
+
+
 def ParseFile(filename, definitions=None, optimize=True, base_dir='',
               shade_check=False):
   """Parse the policy contained in file, optionally provide a naming object.
@@ -1858,25 +2392,80 @@ def ParsePolicy(data, definitions=None, optimize=True, base_dir='',
   Returns:
     policy object.
   """
-  try:
-    if definitions:
-      globals()['DEFINITIONS'] = definitions
-    else:
-      globals()['DEFINITIONS'] = naming.Naming(DEFAULT_DEFINITIONS)
-    if not optimize:
-      globals()['_OPTIMIZE'] = False
-    if shade_check:
-      globals()['_SHADE_CHECK'] = True
+  parser = PolicyParser(definitions, optimize, shade_check)
+  return parser.Parse(data, base_dir=base_dir)
 
-    lexer = lex.lex()
 
-    preprocessed_data = '\n'.join(_Preprocess(data, base_dir=base_dir))
-    p = yacc.yacc(write_tables=False, debug=0, errorlog=yacc.NullLogger())
+class PolicyParser(object):
+  """Parses blobs of policy text into policy objects.
 
-    return p.parse(preprocessed_data, lexer=lexer)
+  Everything the grammar actions need while parsing is kept on the
+  PolicyParser and reaches them through the ply parser, rather than through
+  module globals.  Independent policies can therefore be parsed concurrently
+  from several threads, sharing a single naming.Naming object.
 
-  except IndexError:
-    return False
+  Args:
+    definitions: optional naming library definitions object.
+    optimize: bool - whether to summarize networks and services.
+    shade_check: bool - whether to raise an exception when a term is shaded.
+  """
+
+  def __init__(self, definitions=None, optimize=True, shade_check=False):
+    if not definitions:
+      definitions = naming.Naming(DEFAULT_DEFINITIONS)
+    self.definitions = definitions
+    self.optimize = optimize
+    self.shade_check = shade_check
+
+  def Parse(self, data, base_dir=''):
+    """Parse the policy in 'data'.
+
+    Args:
+      data: a string blob of policy data to parse.
+      base_dir: base path string to look for policies or include files.
+
+    Returns:
+      policy object.
+    """
+    try:
+      preprocessed_data = '\n'.join(_Preprocess(data, base_dir=base_dir))
+
+      # the module lexer and parser keep their state between tokens on the
+      # object itself, so every parse works on its own copy of them.  the
+      # parser tables are shared, a shallow copy is all that's needed.
+      lexer = _LEXER.clone()
+      parser = copy.copy(_PARSER)
+      parser.policy_parser = self
+
+      return parser.parse(preprocessed_data, lexer=lexer)
+
+    except IndexError:
+      return False
+
+
+def _BuildParser():
+  """Build the lexer and parser used by every call to ParsePolicy.
+
+  Generating the LALR tables is by far the most expensive part of setting up
+  the parser, so ply pickles them to _PARSETAB.  On later runs the pickled
+  tables are only reused if their signature, a hash of the grammar rule
+  docstrings and tokens, still matches the grammar defined in this module.
+
+  Returns:
+    tuple of (lexer, parser)
+  """
+  lexer = lex.lex()
+  try:
+    parser = yacc.yacc(debug=0, picklefile=_PARSETAB,
+                       errorlog=yacc.NullLogger())
+  except (IOError, OSError):
+    # the table cache can't be written, eg. a read-only install.
+    parser = yacc.yacc(write_tables=False, debug=0,
+                       errorlog=yacc.NullLogger())
+  return lexer, parser
+
+
+_LEXER, _PARSER = _BuildParser()
 
 
 # If you call this from the command line, you can specify a policy file for it
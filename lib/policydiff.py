@@ -0,0 +1,501 @@
+#!/usr/bin/python
+#
+# Copyright 2011 Google Inc. All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Find the packets two versions of a capirca policy treat differently."""
+
+import bisect
+import datetime
+import nacaddr
+import policy
+from third_party import ipaddr
+
+
+class Error(Exception):
+  """Base error class."""
+
+
+class BadPolicy(Error):
+  """Source or destination policy is not a policy.Policy object."""
+
+
+# the dimensions of a region of packets: source address, destination address,
+# source port, destination port and protocol.
+_SRC, _DST, _SPORT, _DPORT, _PROTO = range(5)
+
+# addresses are integers offset like policy.Term address ranges, IPv6 ones by
+# 2**128, so one range matches addresses of both families.
+_ADDRESS_ANY = ((0, 2 * policy._IPV6_OFFSET - 1),)
+_PORT_ANY = ((0, 65535),)
+_IPV4_SPACE = (0, (1 << 32) - 1)
+_IPV6_SPACE = (policy._IPV6_OFFSET, 2 * policy._IPV6_OFFSET - 1)
+
+# target options setting the address family of a filter, and the address
+# spaces of its packets.  Filters with none of them are IPv4 ones.
+_FAMILIES = {'inet': (_IPV4_SPACE,),
+             'inet6': (_IPV6_SPACE,),
+             'ipv6': (_IPV6_SPACE,),
+             'mixed': (_IPV4_SPACE, _IPV6_SPACE)}
+
+# platforms whose first target option is the address family rather than the
+# filter name.
+_UNNAMED_FILTERS = ('nsxv',)
+
+# larger than the last value of any range.
+_MAX_RANGE_END = 1 << 130
+
+# Term attributes restricting the packets a term matches which a region
+# doesn't describe.  Terms with any of them match only some of the packets
+# of their region, the others go on to the next terms.
+_QUALIFIERS = ('option', 'icmp_type', 'source_prefix', 'destination_prefix',
+               'ether_type', 'traffic_type', 'packet_length',
+               'fragment_offset', 'precedence', 'principals', 'source_tag',
+               'destination_tag', 'source_interface', 'destination_interface')
+
+# the outcome of the packets no term matches.
+_DEFAULT = 'default'
+
+
+class PolicyDiff(object):
+  """The packets whose outcome changed between two versions of a policy.
+
+  Each filter of the policies, by target platform and filter name, is
+  compared to the filter of the same name in the other version, a filter
+  only one version has is compared to an empty one.  Only the packets of
+  the address families of a filter, set by the inet, inet6 or mixed
+  options of its target, are compared.  A packet's outcome
+  in a filter is the action of the first term matching it, after the terms
+  with action next, or default when no term does.
+
+  Terms are compared by their addresses less excludes, ports and
+  protocols, so reordering, renaming or regrouping terms without changing
+  which packets they match makes no difference.  A term which also has
+  options, icmp types or any other condition of _QUALIFIERS only matches
+  some of the packets of its region, the others go on to the next terms:
+  the outcome of its packets is the qualified action of the term followed
+  by the outcome of the terms after it.  Terms excluded from the platform
+  of a filter and expired terms, which the generators don't render, are
+  left out.
+
+  The packet space is split along the bounds of the terms' ranges as
+  needed, starting with the whole of it: a region where both versions have
+  the same terms left to match is not split any further, so the work done
+  depends on the size of the changes rather than of the filters.
+
+  Args:
+    old: policy.Policy object, the previous version.
+    new: policy.Policy object, the next version.
+
+  Raises:
+    BadPolicy: old or new is not a policy.Policy object.
+  """
+
+  def __init__(self, old, new):
+    for pol in (old, new):
+      if type(pol) is not policy.Policy:
+        raise BadPolicy('Policy object is not valid.')
+    self._protocols = _Protocols(old, new)
+    # content of a term -> id, shared by both versions.
+    self._term_ids = {}
+    old_filters = self._Filters(old)
+    new_filters = self._Filters(new)
+    self.filters = []
+    for name in _Unique(old_filters.names + new_filters.names):
+      old_entries, old_spaces = old_filters.get(name, ([], ()))
+      new_entries, new_spaces = new_filters.get(name, ([], ()))
+      changes = _Diff(old_entries, old_spaces, new_entries, new_spaces,
+                      self._protocols.any[0])
+      if changes:
+        self.filters.append((name, [Change(x, self._protocols)
+                                    for x in changes]))
+
+  def _Filters(self, pol):
+    """Return the entries and address spaces of each filter of a policy."""
+    rval = _OrderedFilters()
+    today = datetime.date.today()
+    for header, terms in pol.filters:
+      for target in header.target:
+        name = target.platform
+        if target.options:
+          name += ' ' + target.options[0]
+        entries = []
+        for term in terms:
+          if term.platform and target.platform not in term.platform:
+            continue
+          if (term.platform_exclude and
+              target.platform in term.platform_exclude):
+            continue
+          if term.expiration and term.expiration <= today:
+            continue
+          entries.extend(self._Entries(term, target.platform))
+        rval.Add(name, (entries, _Spaces(target)))
+    return rval
+
+  def _Entries(self, term, platform):
+    """Return the _Entry objects matching the packets of a term."""
+    action = ' '.join(term.action)
+    if action == 'next':
+      # counted or logged, but it doesn't change the outcome.
+      return []
+    qualifiers = ['%s %s' % (x.replace('_', '-'), _Text(getattr(term, x)))
+                  for x in _QUALIFIERS if getattr(term, x)]
+    if qualifiers:
+      action += ' if ' + ', '.join(qualifiers)
+    final = not qualifiers
+    if term.verbatim:
+      if platform not in [x.value[0] for x in term.verbatim]:
+        return []
+      # whatever the text of the platform matches.
+      action = 'verbatim %s' % term.name
+      final = False
+
+    sources = _Ranges(term, 'source_address', _ADDRESS_ANY)
+    destinations = _Ranges(term, 'destination_address', _ADDRESS_ANY)
+    source_ports = _Ranges(term, 'source_port', _PORT_ANY)
+    destination_ports = _Ranges(term, 'destination_port', _PORT_ANY)
+    # address and port match either way, a region for each.
+    addresses = [(sources, destinations)]
+    if term.address:
+      addresses = [(_Intersect(sources, term.address_ranges), destinations),
+                   (sources, _Intersect(destinations, term.address_ranges))]
+    ports = [(source_ports, destination_ports)]
+    if term.port:
+      ports = [(_Intersect(source_ports, term.port_ranges), destination_ports),
+               (source_ports, _Intersect(destination_ports, term.port_ranges))]
+    protocols = self._protocols.Ranges(term.protocol, term.protocol_except)
+
+    regions = []
+    for src, dst in addresses:
+      for sport, dport in ports:
+        region = (src, dst, sport, dport, protocols)
+        if all(region) and region not in regions:
+          regions.append(region)
+    verbatim = tuple(str(x) for x in term.verbatim)
+    term_id = self._term_ids.setdefault(
+        (tuple(regions), action, final, verbatim), len(self._term_ids))
+    return [_Entry(x, action, final, term_id, index)
+            for index, x in enumerate(regions)]
+
+  def __str__(self):
+    lines = []
+    for name, changes in self.filters:
+      lines.append('filter %s:' % name)
+      lines.extend('  %s' % x for x in changes)
+    return '\n'.join(lines)
+
+
+class Change(object):
+  """A region of packets whose outcome in a filter changed.
+
+  Attributes:
+    source, destination: lists of CIDR strings.
+    source_port, destination_port: lists of 'first' or 'first-last'
+      strings, or ['any'].
+    protocol: list of protocol names, 'other' for any other protocol, or
+      ['any'].
+    old, new: the outcome of the packets in each version.
+  """
+
+  def __init__(self, change, protocols):
+    region, old, new = change
+    self.source = _Prefixes(region[_SRC])
+    self.destination = _Prefixes(region[_DST])
+    self.source_port = _Ports(region[_SPORT])
+    self.destination_port = _Ports(region[_DPORT])
+    self.protocol = protocols.Names(region[_PROTO])
+    self.old = old
+    self.new = new
+
+  def __str__(self):
+    return 'src %s dst %s sport %s dport %s proto %s: %s -> %s' % (
+        ' '.join(self.source), ' '.join(self.destination),
+        ' '.join(self.source_port), ' '.join(self.destination_port),
+        ' '.join(self.protocol), self.old, self.new)
+
+
+class _OrderedFilters(dict):
+  """Filter name -> (entries, address spaces), keeping the order of names."""
+
+  def __init__(self):
+    dict.__init__(self)
+    self.names = []
+
+  def Add(self, name, value):
+    count = 1
+    unique = name
+    while unique in self:
+      count += 1
+      unique = '%s #%d' % (name, count)
+    self[unique] = value
+    self.names.append(unique)
+
+
+class _Protocols(object):
+  """Numbers the protocols of two policies, for protocol ranges.
+
+  Any protocol neither policy names gets the number after the last one.
+  """
+
+  def __init__(self, *policies):
+    names = set()
+    for pol in policies:
+      for _, terms in pol.filters:
+        for term in terms:
+          names.update(term.protocol)
+          names.update(term.protocol_except)
+    self.names = sorted(names)
+    self.ids = dict((x, i) for i, x in enumerate(self.names))
+    self.any = ((0, len(self.names)),)
+
+  def Ranges(self, protocols, protocol_except):
+    ids = set(self.ids[x] for x in protocols)
+    if not protocols:
+      ids = set(xrange(len(self.names) + 1))
+    ids.difference_update(self.ids[x] for x in protocol_except)
+    return policy._MergeRanges((x, x) for x in ids)
+
+  def Names(self, ranges):
+    if ranges == self.any:
+      return ['any']
+    names = self.names + ['other']
+    return [x for first, last in ranges for x in names[first:last + 1]]
+
+
+class _Entry(object):
+  """A region of packets matched by a term.
+
+  A term matching addresses or ports either way has one for each way.
+  Entries of identical terms have the same key in both versions.
+  """
+
+  __slots__ = ('ranges', 'action', 'final', 'term_id', 'key')
+
+  def __init__(self, ranges, action, final, term_id, index):
+    self.ranges = ranges
+    self.action = action
+    self.final = final
+    self.term_id = term_id
+    self.key = (term_id, index)
+
+  def Overlaps(self, box):
+    for ranges, (first, last) in zip(self.ranges, box):
+      index = bisect.bisect_right(ranges, (last, _MAX_RANGE_END)) - 1
+      if index < 0 or ranges[index][1] < first:
+        return False
+    return True
+
+  def Uncovered(self, box):
+    """Return the first dimension in which the entry doesn't cover box."""
+    for dimension, (ranges, (first, last)) in enumerate(zip(self.ranges,
+                                                             box)):
+      index = bisect.bisect_right(ranges, (first, _MAX_RANGE_END)) - 1
+      if index < 0 or ranges[index][1] < last:
+        return dimension
+    return None
+
+  def Cuts(self, dimension, first, last):
+    """Return the bounds of the entry's ranges inside (first, last]."""
+    rval = []
+    for start, end in self.ranges[dimension]:
+      if start > last:
+        break
+      if first < start:
+        rval.append(start)
+      if first < end + 1 <= last:
+        rval.append(end + 1)
+    return rval
+
+
+def _Diff(old, old_spaces, new, new_spaces, protocols):
+  """Return the (box, old outcome, new outcome) regions of two filters.
+
+  Args:
+    old, new: lists of _Entry objects of each version of a filter.
+    old_spaces, new_spaces: address spaces of the packets each version of
+      the filter sees, the other packets get the default outcome.
+    protocols: (first, last) interval of the protocol ids.
+
+  Returns:
+    list of (box, old outcome, new outcome) tuples, where box is a tuple of
+    the (first, last) integer interval of each dimension.
+  """
+  changes = []
+  pending = []
+  for space in (_IPV4_SPACE, _IPV6_SPACE):
+    if space not in old_spaces and space not in new_spaces:
+      continue
+    box = (space, space, _PORT_ANY[0], _PORT_ANY[0], protocols)
+    pending.append((box, space in old_spaces and old or [], (),
+                    space in new_spaces and new or [], ()))
+  while pending:
+    box, old, old_passed, new, new_passed = pending.pop()
+    old, old_passed, old_outcome = _Advance(box, old, old_passed)
+    new, new_passed, new_outcome = _Advance(box, new, new_passed)
+    if old_outcome and new_outcome:
+      old_outcome = _Outcome(old_passed, old_outcome)
+      new_outcome = _Outcome(new_passed, new_outcome)
+      if old_outcome != new_outcome:
+        changes.append((box, old_outcome, new_outcome))
+      continue
+    if (old_passed == new_passed and
+        [x.key for x in old] == [x.key for x in new]):
+      # whatever the remaining terms do, they do it in both versions.
+      continue
+    # split the box in two along a bound of the first term left to match,
+    # at the median of the bounds of all of them so that the splits stay
+    # balanced.
+    dimension = (old_outcome and new or old)[0].Uncovered(box)
+    first, last = box[dimension]
+    cuts = set()
+    for entry in old + new:
+      cuts.update(entry.Cuts(dimension, first, last))
+    cuts = sorted(cuts)
+    cut = cuts[len(cuts) / 2]
+    for interval in ((first, cut - 1), (cut, last)):
+      half = box[:dimension] + (interval,) + box[dimension + 1:]
+      pending.append((half, old, old_passed, new, new_passed))
+  return _MergeBoxes(changes)
+
+
+def _Spaces(target):
+  """Return the address spaces of the packets of a filter of a target."""
+  options = target.options or []
+  if target.platform not in _UNNAMED_FILTERS:
+    options = options[1:]
+  for option in options:
+    if option in _FAMILIES:
+      return _FAMILIES[option]
+  return (_IPV4_SPACE,)
+
+
+def _Advance(box, entries, passed):
+  """Pass the entries covering the whole box.
+
+  Args:
+    box: tuple of (first, last) intervals.
+    entries: list of _Entry objects left to match.
+    passed: tuple of the (term id, action) of qualified terms passed.
+
+  Returns:
+    (entries, passed, outcome) tuple: the entries left, those overlapping
+    the box from the first one which doesn't cover it or just the one
+    deciding it, the qualified terms passed, and the action of the box if
+    it is decided, else None.
+  """
+  entries = [x for x in entries if x.Overlaps(box)]
+  for index, entry in enumerate(entries):
+    if entry.Uncovered(box) is not None:
+      return entries[index:], passed, None
+    if entry.final:
+      # it decides the outcome of every part of the box too.
+      return [entry], passed, entry.action
+    if entry.term_id not in [x for x, _ in passed]:
+      passed += ((entry.term_id, entry.action),)
+  return [], passed, _DEFAULT
+
+
+def _Outcome(passed, action):
+  return ', else '.join([x for _, x in passed] + [action])
+
+
+def _MergeBoxes(changes):
+  """Merge the boxes of the same change which only differ in one dimension.
+
+  Args:
+    changes: list of (box, old outcome, new outcome) tuples.
+
+  Returns:
+    sorted list of (region, old outcome, new outcome) tuples, where region
+    is a tuple of the merged (first, last) ranges of each dimension.
+  """
+  changes = [(tuple((x,) for x in box), old, new)
+             for box, old, new in changes]
+  merged = True
+  while merged:
+    merged = False
+    for dimension in xrange(_PROTO + 1):
+      groups = {}
+      for region, old, new in changes:
+        rest = region[:dimension] + region[dimension + 1:]
+        groups.setdefault((rest, old, new), []).extend(region[dimension])
+      if len(groups) == len(changes):
+        continue
+      merged = True
+      changes = [(rest[:dimension] + (policy._MergeRanges(ranges),) +
+                  rest[dimension:], old, new)
+                 for (rest, old, new), ranges in groups.iteritems()]
+  changes.sort()
+  return changes
+
+
+def _Ranges(term, field, any_value):
+  """Return the ranges of a field of a term, any_value if it has none."""
+  if not getattr(term, field):
+    return any_value
+  return tuple(getattr(term, field + '_ranges'))
+
+
+def _Intersect(first, second):
+  """Return the intersection of two sorted lists of merged ranges."""
+  rval = []
+  i = j = 0
+  while i < len(first) and j < len(second):
+    start = max(first[i][0], second[j][0])
+    end = min(first[i][1], second[j][1])
+    if start <= end:
+      rval.append((start, end))
+    if first[i][1] < second[j][1]:
+      i += 1
+    else:
+      j += 1
+  return tuple(rval)
+
+
+def _Unique(values):
+  seen = set()
+  return [x for x in values if not (x in seen or seen.add(x))]
+
+
+def _Text(value):
+  if isinstance(value, list):
+    return ' '.join(str(x) for x in value)
+  return str(value)
+
+
+def _Prefixes(ranges):
+  """Return the CIDR blocks of address ranges as strings."""
+  rval = []
+  for first, last in ranges:
+    if first >= policy._IPV6_OFFSET:
+      bits = 128
+      first -= policy._IPV6_OFFSET
+      last -= policy._IPV6_OFFSET
+      address = ipaddr.IPv6Address
+    else:
+      bits = 32
+      address = ipaddr.IPv4Address
+    rval.extend('%s/%d' % (address(network), prefixlen)
+                for network, prefixlen in
+                nacaddr._RangeToPrefixes(first, last, bits))
+  return rval
+
+
+def _Ports(ranges):
+  """Return port ranges as 'first' or 'first-last' strings, or ['any']."""
+  if ranges == _PORT_ANY:
+    return ['any']
+  return [first == last and str(first) or '%d-%d' % (first, last)
+          for first, last in ranges]
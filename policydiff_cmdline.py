@@ -0,0 +1,47 @@
+#!/usr/bin/python
+#
+# Copyright 2011 Google Inc. All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Command line interface to policydiff library."""
+
+from optparse import OptionParser
+import sys
+from lib import naming
+from lib import policy
+from lib import policydiff
+
+
+def main():
+  usage = 'usage: %prog [options] old_policy new_policy'
+  _parser = OptionParser(usage)
+  _parser.add_option('--definitions-directory', dest='definitions',
+                     help='definitions directory', default='./def')
+  _parser.add_option('--snapshot', dest='snapshot',
+                     help='load the definitions from this snapshot, written '
+                     'when missing or older than the definitions')
+  (FLAGS, args) = _parser.parse_args()
+  if len(args) != 2:
+    _parser.error('an old and a new policy file are required')
+
+  defs = naming.Naming(FLAGS.definitions, snapshot=FLAGS.snapshot)
+  old, new = [policy.ParseFile(x, defs) for x in args]
+  diff = policydiff.PolicyDiff(old, new)
+  if diff.filters:
+    print str(diff)
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
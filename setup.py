@@ -39,8 +39,9 @@ setup(name='capirca',
                   'lib.ciscoxr','lib.gce','lib.ipset',
                   'lib.iptables', 'lib.juniper', 'lib.junipersrx',
                   'lib.nacaddr', 'lib.policy', 'lib.policyreader',
-                  'lib.naming', 'lib.nsxv','lib.aclcheck',
+                  'lib.naming', 'lib.nsxv','lib.aclcheck', 'lib.aclcheckserver',
+                  'lib.policydiff',
                   'lib.aclgenerator', 'lib.port', 'lib.demo', 'lib.speedway',
-                  'lib.ipset', 'lib.packetfilter', 'lib.gce',
+                  'lib.ipset', 'lib.packetfilter', 'lib.gce', 'lib.manifest',
                   'third_party.ipaddr', 'third_party.ply.lex',
                   'third_party.ply.yacc'])
@@ -0,0 +1,145 @@
+import random
+import unittest
+
+from lib import aclcheck
+from lib import naming
+from lib import policy
+
+POLICIES = ['policies/sample_multitarget.pol', 'policies/sample_srx.pol',
+            'policies/sample_speedway.pol']
+ADDRESSES = ['any', '10.1.1.1', '10.0.0.0/8', '172.16.5.5', '200.1.1.1',
+             '200.1.1.4', '200.1.1.3', '8.8.8.8', '0.0.0.1', '224.1.1.1',
+             '127.0.0.1', '2001:db8::1', '::1', 'fe80::1']
+PORTS = ['any', '22', '25', '53', '80', '123', '443', '1025', '65535', '0']
+PROTOCOLS = ['any', 'tcp', 'udp', 'icmp', 'icmpv6', 'esp', 'gre', '50']
+HOSTS = [x for x in ADDRESSES if x != 'any' and '/' not in x]
+CLASSIFY_POLICY = """
+header {
+  target:: juniper test-filter
+}
+term count-mail {
+  destination-address:: MAIL_SERVERS
+  action:: next
+}
+term allow-mail {
+  destination-address:: MAIL_SERVERS
+  destination-port:: SMTP
+  protocol:: tcp
+  action:: accept
+}
+term allow-internal {
+  source-address:: INTERNAL
+  source-exclude:: RFC1918
+  action:: accept
+}
+term deny-tcp {
+  protocol:: tcp
+  action:: deny
+}
+term never-hit {
+  protocol:: tcp
+  action:: deny
+}
+"""
+
+
+def Describe(matches):
+  return [(x.filter, x.term, x.possibles, x.action) for x in matches]
+
+
+def Flows(rand, count):
+  return [(rand.choice(HOSTS), rand.choice(HOSTS),
+           rand.choice(PORTS[1:]), rand.choice(PORTS[1:]),
+           rand.choice(PROTOCOLS[1:])) for _ in xrange(count)]
+
+
+class Test_AclCheck(unittest.TestCase):
+
+  def setUp(self):
+    self.defs = naming.Naming('./def')
+
+  def test_index_finds_the_same_matches(self):
+    rand = random.Random(5)
+    for filename in POLICIES:
+      pol = policy.ParseFile(filename, self.defs, optimize=True)
+      index = aclcheck.AclIndex(pol)
+      for _ in xrange(500):
+        query = dict(src=rand.choice(ADDRESSES), dst=rand.choice(ADDRESSES),
+                     sport=rand.choice(PORTS), dport=rand.choice(PORTS),
+                     proto=rand.choice(PROTOCOLS))
+        expected = aclcheck.AclCheck(pol, **query)
+        check = aclcheck.AclCheck(pol, index=index, **query)
+        self.assertEqual(Describe(expected.Matches()),
+                         Describe(check.Matches()))
+        self.assertEqual(Describe(expected.ExactMatches()),
+                         Describe(check.ExactMatches()))
+        self.assertEqual(str(expected), str(check))
+
+  def test_evaluate_many_matches_one_check_per_flow(self):
+    rand = random.Random(7)
+    pol = policy.ParseFile(POLICIES[0], self.defs, optimize=True)
+    flows = [(rand.choice(ADDRESSES), rand.choice(ADDRESSES),
+              rand.choice(PORTS), rand.choice(PORTS), rand.choice(PROTOCOLS))
+             for _ in xrange(300)]
+    expected = []
+    for flow in flows:
+      check = aclcheck.AclCheck(pol, *flow)
+      exact = check.ExactMatches()[:1]
+      expected.append((flow, Describe(exact),
+                       Describe([x for x in check.Matches() if x.possibles])))
+
+    for jobs in (1, 3):
+      results = aclcheck.AclCheck.EvaluateMany(pol, iter(flows), jobs=jobs,
+                                               chunk_size=40)
+      self.assertEqual(expected, [(flow, Describe([exact] if exact else []),
+                                   Describe(possibles))
+                                  for flow, exact, possibles in results])
+
+  def test_evaluate_many_rejects_bad_flows(self):
+    pol = policy.ParseFile(POLICIES[0], self.defs, optimize=True)
+    results = aclcheck.AclCheck.EvaluateMany(
+        pol, [('10.1.1.1', 'any', '80', '22', 'tcp'),
+              ('10.1.1.1', 'bad', '80', '22', 'tcp')])
+    self.assertRaises(aclcheck.AddressError, list, results)
+
+  def test_classifier_backends_agree(self):
+    rand = random.Random(11)
+    flows = Flows(rand, 3000)
+    for filename in POLICIES:
+      pol = policy.ParseFile(filename, self.defs, optimize=True)
+      expected = aclcheck.FlowClassifier(pol, use_numpy=False)
+      self.assertEqual(len(pol.filters), len(expected.Classify(flows)))
+      if aclcheck.numpy is None:
+        continue
+      classifier = aclcheck.FlowClassifier(pol, use_numpy=True)
+      self.assertEqual(expected.Classify(flows), classifier.Classify(flows))
+      self.assertEqual(expected.HitCounts(flows), classifier.HitCounts(flows))
+
+  def test_classifier_counts_hits(self):
+    pol = policy.ParsePolicy(CLASSIFY_POLICY, self.defs)
+    flows = [('8.8.8.8', '200.1.1.4', '1025', '25', 'tcp'),
+             ('8.8.8.8', '200.1.1.4', '1025', '80', 'tcp'),
+             ('10.1.1.1', '8.8.8.8', '1025', '53', 'udp'),
+             ('8.8.8.8', '200.1.1.4', '1025', '53', 'udp')]
+    for use_numpy in (False, True):
+      if use_numpy and aclcheck.numpy is None:
+        continue
+      classifier = aclcheck.FlowClassifier(pol, use_numpy=use_numpy)
+      self.assertEqual([[1, 3, -1, -1]], classifier.Classify(flows))
+      self.assertEqual([('test-filter', 'count-mail', 3),
+                        ('test-filter', 'allow-mail', 1),
+                        ('test-filter', 'allow-internal', 0),
+                        ('test-filter', 'deny-tcp', 1),
+                        ('test-filter', 'never-hit', 0)],
+                       classifier.HitCounts(flows))
+
+  def test_index_rejects_other_objects(self):
+    self.assertRaises(aclcheck.BadPolicy, aclcheck.AclIndex, None)
+    self.assertRaises(aclcheck.BadPolicy, aclcheck.FlowClassifier, None)
+
+
+def main():
+  unittest.main()
+
+if __name__ == '__main__':
+  main()
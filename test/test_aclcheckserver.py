@@ -0,0 +1,204 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import urllib2
+
+from lib import aclcheck
+from lib import aclcheckserver
+from lib import naming
+from lib import policy
+
+POLICY = """
+header {
+  target:: juniper %(name)s
+}
+term allow-%(name)s {
+  destination-address:: %(network)s
+  destination-port:: SMTP
+  protocol:: tcp
+  action:: accept
+}
+term deny-all {
+  action:: deny
+}
+"""
+QUERY = {'src': '10.1.1.1', 'dst': '200.1.1.4', 'sport': '1025',
+         'dport': '25', 'proto': 'tcp'}
+
+
+class Test_AclCheckServer(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.def_dir = os.path.join(self.tmp, 'def')
+    self.pol_dir = os.path.join(self.tmp, 'policies')
+    shutil.copytree('./def', self.def_dir)
+    os.makedirs(os.path.join(self.pol_dir, 'sub'))
+    self.Write('mail.pol', POLICY % {'name': 'mail',
+                                     'network': 'MAIL_SERVERS'})
+    self.Write('sub/web.pol', POLICY % {'name': 'web',
+                                        'network': 'WEB_SERVERS'})
+    self.store = aclcheckserver.PolicyStore(self.def_dir, self.pol_dir)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def Write(self, name, text, directory=None):
+    filename = os.path.join(directory or self.pol_dir, name)
+    mtime = None
+    if os.path.exists(filename):
+      mtime = os.stat(filename).st_mtime
+    open(filename, 'w').write(text)
+    if mtime is not None:
+      # changes within the resolution of mtimes must still be seen.
+      os.utime(filename, (mtime + 10, mtime + 10))
+
+  def Actions(self, checks):
+    return dict((name, [(x.term, x.action) for x in check.ExactMatches()])
+                for name, check in checks.iteritems())
+
+  def test_checks_match_aclcheck(self):
+    checks = self.store.Check(**QUERY)
+
+    self.assertEqual(['mail.pol', 'sub/web.pol'], sorted(checks))
+    for name, check in checks.iteritems():
+      defs = naming.Naming(self.def_dir)
+      pol = policy.ParseFile(os.path.join(self.pol_dir, name), defs)
+      self.assertEqual(str(aclcheck.AclCheck(pol, **QUERY)), str(check))
+    self.assertEqual(['sub/web.pol'],
+                     list(self.store.Check('policies/sub/web.pol', **QUERY)))
+    self.assertRaises(aclcheckserver.UnknownPolicyError, self.store.Check,
+                      'web.pol', **QUERY)
+
+  def test_refresh_reloads_only_what_changed(self):
+    self.assertEqual([], self.store.Refresh())
+    mail = self.store.policies['mail.pol']
+
+    self.Write('sub/web.pol', POLICY % {'name': 'web',
+                                        'network': 'MAIL_SERVERS'})
+    self.Write('new.pol', POLICY % {'name': 'new', 'network': 'NTP_SERVERS'})
+    self.assertEqual(['new.pol', 'sub/web.pol'], self.store.Refresh())
+    self.assertTrue(self.store.policies['mail.pol'] is mail)
+    self.assertEqual({'mail.pol': [('allow-mail', 'accept')],
+                      'new.pol': [('deny-all', 'deny')],
+                      'sub/web.pol': [('allow-web', 'accept')]},
+                     self.Actions(self.store.Check(**QUERY)))
+
+    # only the policy using NTP_SERVERS depends on the edited definition.
+    networks = open(os.path.join(self.def_dir, 'NETWORK.net')).read()
+    self.Write('NETWORK.net', networks.replace(
+        'NTP_SERVERS = 10.0.0.1/32', 'NTP_SERVERS = 200.1.1.4/32'),
+               self.def_dir)
+    self.assertEqual(['new.pol'], self.store.Refresh())
+    self.assertEqual([('allow-new', 'accept')],
+                     self.Actions(self.store.Check(**QUERY))['new.pol'])
+
+    os.remove(os.path.join(self.pol_dir, 'new.pol'))
+    self.assertEqual([], self.store.Refresh())
+    self.assertEqual(['mail.pol', 'sub/web.pol'], sorted(self.store.policies))
+
+  def test_policies_failing_to_load_keep_the_previous_version(self):
+    mail = self.store.policies['mail.pol']
+    self.Write('mail.pol', POLICY % {'name': 'mail', 'network': 'NO_SUCH'})
+    self.Write('broken.pol', POLICY[:-2] % {'name': 'broken',
+                                            'network': 'MAIL_SERVERS'})
+    services = open(os.path.join(self.def_dir, 'SERVICES.svc')).read()
+    self.Write('SERVICES.svc', services + 'BROKEN = NO_SUCH\n', self.def_dir)
+    loads = []
+    parse_file = policy.ParseFile
+    definitions = naming.Naming
+
+    def CountingParseFile(filename, *args, **kwargs):
+      loads.append(os.path.basename(filename))
+      return parse_file(filename, *args, **kwargs)
+
+    def CountingNaming(*args, **kwargs):
+      loads.append('definitions')
+      return definitions(*args, **kwargs)
+
+    policy.ParseFile = CountingParseFile
+    naming.Naming = CountingNaming
+    try:
+      self.assertEqual([], self.store.Refresh())
+      self.assertEqual(['definitions', 'broken.pol', 'mail.pol'], loads)
+      self.assertTrue(self.store.policies['mail.pol'] is mail)
+      self.assertEqual(sorted(['broken.pol', 'mail.pol', self.def_dir]),
+                       sorted(self.store.errors))
+
+      # nothing changed, so nothing is loaded again.
+      errors = self.store.errors
+      self.assertEqual([], self.store.Refresh())
+      self.assertEqual(3, len(loads))
+      self.assertEqual(errors, self.store.errors)
+
+      # defining the token fixes both mail.pol and the definitions.
+      networks = open(os.path.join(self.def_dir, 'NETWORK.net')).read()
+      self.Write('NETWORK.net', networks + 'NO_SUCH = 200.1.1.4/32\n',
+                 self.def_dir)
+      self.Write('SERVICES.svc', services + 'BROKEN = SMTP\n', self.def_dir)
+      self.assertEqual(['mail.pol'], self.store.Refresh())
+      self.assertEqual(['broken.pol'], list(self.store.errors))
+    finally:
+      policy.ParseFile = parse_file
+      naming.Naming = definitions
+
+  def test_server_answers_concurrent_clients(self):
+    server = aclcheckserver.Server(self.store, ('localhost', 0),
+                                   interval=0.05)
+    thread = threading.Thread(target=server.ServeForever)
+    thread.daemon = True
+    thread.start()
+    url = 'http://localhost:%d' % server.server_address[1]
+    expected = aclcheckserver.CheckReply(self.store.Check(**QUERY))
+    self.assertEqual([('allow-mail', True)],
+                     [(x['term'], x['exact'])
+                      for x in expected['mail.pol']['matches']])
+    self.assertEqual([('deny-all', True)],
+                     [(x['term'], x['exact'])
+                      for x in expected['sub/web.pol']['matches']])
+    replies = []
+
+    def Query():
+      for _ in xrange(5):
+        replies.append(json.load(urllib2.urlopen(
+            url + '/check?src=10.1.1.1&dst=200.1.1.4&sport=1025&dport=25'
+            '&proto=tcp')))
+
+    try:
+      clients = [threading.Thread(target=Query) for _ in xrange(4)]
+      for client in clients:
+        client.start()
+      for client in clients:
+        client.join()
+      self.assertEqual([expected] * 20, replies)
+
+      try:
+        urllib2.urlopen(url + '/check?src=bad')
+        self.fail('bad address accepted')
+      except urllib2.HTTPError as e:
+        self.assertEqual(400, e.code)
+        self.assertEqual({'error': 'bad source address: bad'}, json.load(e))
+
+      # the watcher reloads changed policies.
+      self.Write('mail.pol', POLICY % {'name': 'mail',
+                                       'network': 'WEB_SERVERS'})
+      deadline = time.time() + 10
+      while (self.store.policies['mail.pol'].policy.filters[0][1][0]
+             .destination_address[0].token != 'WEB_SERVERS'):
+        self.assertTrue(time.time() < deadline)
+        time.sleep(0.05)
+      status = json.load(urllib2.urlopen(url + '/status'))
+      self.assertEqual(['mail.pol', 'sub/web.pol'], status['policies'])
+    finally:
+      server.Shutdown()
+
+
+def main():
+  unittest.main()
+
+if __name__ == '__main__':
+  main()
@@ -1,3 +1,6 @@
+import logging
+import shutil
+import tempfile
 import unittest
 import sys
 import os
@@ -15,11 +18,148 @@ class Test_AclGen(unittest.TestCase):
   def tearDown(self):
     sys.stdout = sys.__stdout__
     sys.stderr = sys.__stderr__
+    # logging binds to the captured stderr of whichever test logs first.
+    logging.getLogger().handlers = []
 
   def test_smoke_test_generates_successfully_with_no_args(self):
     aclgen.main([])
 
+    self.assertEquals(SMOKE_TEST_OUTPUT, self.iobuff.getvalue())
+
+  def test_parallel_jobs_match_serial_output(self):
+    aclgen.main(['--jobs', '3'])
+
+    self.assertEquals(SMOKE_TEST_OUTPUT, self.iobuff.getvalue())
+
+  def test_generate_single_policy(self):
+    aclgen.main(['-p', 'policies/sample_cisco_lab.pol'])
+
     expected_output = """writing ./filters/sample_cisco_lab.acl
+1 filters rendered
+"""
+    self.assertEquals(expected_output, self.iobuff.getvalue())
+
+  def test_revision_tags_are_replaced_across_writes(self):
+    output = StringIO()
+    writer = aclgen.RevisionTagWriter(output, 'filters/x.acl')
+    for text in ('remark $I', 'd:$\n', '# $Date', ':$\nexit', '\n$Id:$'):
+      writer.write(text)
+    writer.flush()
+
+    lines = output.getvalue().split('\n')
+    self.assertEqual('remark $Id: filters/x.acl $', lines[0])
+    self.assertRegexpMatches(lines[1], r'^# \$Date: \d{4}/\d\d/\d\d \$$')
+    self.assertEqual(['exit', '$Id: filters/x.acl $'], lines[2:])
+
+  def test_failed_render_keeps_the_previous_filter(self):
+    class FailingGenerator(object):
+      def Render(self, stream):
+        stream.write('partial\n')
+        raise ValueError('bad term')
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+      filter_file = os.path.join(tmp_dir, 'x.acl')
+      open(filter_file, 'w').write('previous\n')
+
+      self.assertRaises(ValueError, aclgen.write_filter, FailingGenerator(),
+                        filter_file)
+      self.assertEqual('previous\n', open(filter_file).read())
+      self.assertEqual(['x.acl'], os.listdir(tmp_dir))
+    finally:
+      shutil.rmtree(tmp_dir)
+
+  def test_parallel_errors_keep_what_was_rendered_before(self):
+    data = """
+header {
+  target:: cisco good-filter
+}
+term expired {
+  expiration:: 2001-01-01
+  action:: accept
+}
+header {
+  target:: juniper bad-filter
+}
+term bad {
+  protocol:: udp tcp
+  option:: tcp-established
+  action:: accept
+}
+"""
+    tmp_dir = tempfile.mkdtemp()
+    try:
+      policy_file = os.path.join(tmp_dir, 'mixed.pol')
+      open(policy_file, 'w').write(data)
+      defs = aclgen.naming.Naming('./def')
+      outputs = []
+      for jobs in (1, 2):
+        output_dir = os.path.join(tmp_dir, 'filters-%d' % jobs)
+        self.iobuff.truncate(0)
+        self.assertRaises(aclgen.juniper.TcpEstablishedWithNonTcp,
+                          aclgen.render_policies, [policy_file], defs, False,
+                          2, output_dir, jobs)
+        outputs.append(self.iobuff.getvalue().replace(output_dir, ''))
+        self.assertTrue('expired' in outputs[-1])
+        self.assertTrue('mixed.acl' in outputs[-1])
+      self.assertEqual(outputs[0], outputs[1])
+    finally:
+      shutil.rmtree(tmp_dir)
+
+  def test_incremental_only_renders_changed_policies(self):
+    tmp_dir = tempfile.mkdtemp()
+    try:
+      def_dir = os.path.join(tmp_dir, 'def')
+      output_dir = os.path.join(tmp_dir, 'filters')
+      shutil.copytree('./def', def_dir)
+      args = ['--incremental', '-d', def_dir, '-o', output_dir]
+
+      aclgen.main(args)
+      self.assertTrue('22 filters rendered' in self.iobuff.getvalue())
+
+      self.iobuff.truncate(0)
+      aclgen.main(args)
+      self.assertTrue(self.iobuff.getvalue().endswith(
+          '9 policies up to date\n0 filters rendered\n'))
+
+      # HTTP is used by sample_gce.pol, and by sample_multitarget.pol through
+      # WEB_SERVICES.
+      services = os.path.join(def_dir, 'SERVICES.svc')
+      data = open(services).read().replace('HTTP = 80/tcp', 'HTTP = 8080/tcp')
+      open(services, 'w').write(data)
+      self.iobuff.truncate(0)
+      aclgen.main(args)
+      output = self.iobuff.getvalue()
+      self.assertTrue(output.startswith('7 policies up to date\n'))
+      self.assertTrue('sample_gce.gce' in output)
+      self.assertTrue('sample_multitarget.jcl' in output)
+      self.assertFalse('sample_cisco_lab.acl' in output)
+    finally:
+      shutil.rmtree(tmp_dir)
+
+  def test_incremental_tracks_policies_without_filters(self):
+    tmp_dir = tempfile.mkdtemp()
+    try:
+      policy_file = os.path.join(tmp_dir, 'unsupported.pol')
+      open(policy_file, 'w').write(
+          'header {\n  target:: no-such-platform\n}\n'
+          'term accept-web {\n  protocol:: tcp\n'
+          '  destination-port:: HTTP\n  action:: accept\n}\n')
+      args = ['--incremental', '-p', policy_file,
+              '-o', os.path.join(tmp_dir, 'filters')]
+
+      aclgen.main(args)
+      self.assertTrue(self.iobuff.getvalue().endswith('0 filters rendered\n'))
+
+      self.iobuff.truncate(0)
+      aclgen.main(args)
+      self.assertEqual('1 policies up to date\n0 filters rendered\n',
+                       self.iobuff.getvalue())
+    finally:
+      shutil.rmtree(tmp_dir)
+
+
+SMOKE_TEST_OUTPUT = """writing ./filters/sample_cisco_lab.acl
 writing ./filters/sample_gce.gce
 writing ./filters/sample_ipset
 WARNING:root:WARNING: Term accept-traceroute in policy LOOPBACK is expired and will not be rendered.
@@ -47,17 +187,6 @@ writing ./filters/sample_srx.srx
 22 filters rendered
 """
 
-    self.assertEquals(expected_output, self.iobuff.getvalue())
-
-  def test_generate_single_policy(self):
-    aclgen.main(['-p', 'policies/sample_cisco_lab.pol'])
-
-    expected_output = """writing ./filters/sample_cisco_lab.acl
-1 filters rendered
-"""
-    self.assertEquals(expected_output, self.iobuff.getvalue())
-
-
 
 def main():
     unittest.main()
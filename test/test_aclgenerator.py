@@ -0,0 +1,49 @@
+import cStringIO
+import unittest
+
+from lib import aclgenerator
+from lib import naming
+from lib import policy
+
+POLICY = """
+header {
+  target:: fake test-filter
+}
+term allow-all {
+  action:: accept
+}
+"""
+
+
+class Fake(aclgenerator.ACLGenerator):
+  _PLATFORM = 'fake'
+
+  def _TranslatePolicy(self, pol, exp_info):
+    self.terms = pol.filters[0][1]
+
+
+class FakeStr(Fake):
+
+  def __str__(self):
+    return 'term %s\n' % self.terms[0].name
+
+
+class Test_AclGenerator(unittest.TestCase):
+
+  def setUp(self):
+    self.pol = policy.ParsePolicy(POLICY, naming.Naming('./def'))
+
+  def test_generators_without_render_or_str_fail(self):
+    self.assertRaises(aclgenerator.Error, str, Fake(self.pol, 2))
+
+  def test_render_writes_what_str_returns(self):
+    stream = cStringIO.StringIO()
+    FakeStr(self.pol, 2).Render(stream)
+    self.assertEqual('term allow-all\n', stream.getvalue())
+
+
+def main():
+  unittest.main()
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,110 @@
+import unittest
+
+from lib import ipset
+from lib import naming
+from lib import policy
+
+POLICY = """
+header {
+  target:: ipset OUTPUT DROP %s
+}
+term deny-to-reserved {
+  destination-address:: RESERVED
+  action:: deny
+}
+"""
+
+
+def Restore(sets, config):
+  """Apply an 'ipset restore' batch to a dict of set name -> members."""
+  for line in config:
+    words = line.split()
+    if words[0] == 'create':
+      sets.setdefault(words[1], set())
+    elif words[0] == 'flush':
+      sets[words[1]].clear()
+    elif words[0] == 'add':
+      sets[words[1]].add(words[2])
+    elif words[0] == 'swap':
+      sets[words[1]], sets[words[2]] = sets[words[2]], sets[words[1]]
+    elif words[0] == 'destroy':
+      del sets[words[1]]
+
+
+class Test_Ipset(unittest.TestCase):
+
+  def setUp(self):
+    self.defs = naming.Naming('./def')
+
+  def SetConfig(self, options='', token='RESERVED'):
+    pol = policy.ParsePolicy(
+        POLICY.replace('RESERVED', token) % options, self.defs)
+    output = str(ipset.Ipset(pol, 2)).split('\n')
+    return output[1:output.index(ipset.Ipset._MARKER_END)]
+
+  def test_sets_are_created_and_filled_unless_they_exist(self):
+    config = self.SetConfig()
+
+    self.assertEqual('create deny-to-reserved-dst hash:net family inet '
+                     'hashsize 64 maxelem 65536 -exist', config[0])
+    self.assertEqual('flush deny-to-reserved-dst', config[1])
+    self.assertEqual(['add deny-to-reserved-dst 0.0.0.0/8 -exist',
+                      'add deny-to-reserved-dst 10.0.0.0/8 -exist'],
+                     config[2:4])
+    self.assertEqual(8, len(config[2:]))
+
+  def test_swap_replaces_sets_in_one_operation(self):
+    config = self.SetConfig('swap')
+
+    create = 'create %s hash:net family inet hashsize 64 maxelem 65536 -exist'
+    self.assertEqual([create % 'deny-to-reserved-dst',
+                      create % 'deny-to-reserved-dst.tmp',
+                      'flush deny-to-reserved-dst.tmp'], config[:3])
+    self.assertTrue(all(x.startswith('add deny-to-reserved-dst.tmp ')
+                        for x in config[3:-2]))
+    self.assertEqual(['swap deny-to-reserved-dst.tmp deny-to-reserved-dst',
+                      'destroy deny-to-reserved-dst.tmp'], config[-2:])
+
+  def test_reloads_drop_addresses_removed_from_the_policy(self):
+    for options in ('', 'swap'):
+      sets = {}
+      for config in (self.SetConfig(options),
+                     self.SetConfig(options, 'RFC1918')):
+        Restore(sets, config)
+      self.assertEqual({'deny-to-reserved-dst': set([
+          '10.0.0.0/8', '172.16.0.0/12', '192.168.0.0/16'])}, sets, options)
+
+  def test_set_size_follows_member_count(self):
+    generator = ipset.Ipset(policy.ParsePolicy(POLICY % '', self.defs), 2)
+
+    self.assertEqual((64, 65536), generator._SetSize(3))
+    self.assertEqual((32768, 65536), generator._SetSize(20000))
+    self.assertEqual((131072, 131072), generator._SetSize(100000))
+
+  def test_identical_sets_are_configured_once(self):
+    data = []
+    for filter_name in ('INPUT', 'OUTPUT'):
+      data.append('header {\n  target:: ipset %s DROP\n}\n' % filter_name)
+      for index, token in enumerate(('RESERVED', 'RESERVED', 'BOGON')):
+        data.append('term %s-%d {\n  destination-address:: %s\n'
+                    '  action:: deny\n}\n' % (filter_name[0], index, token))
+      data.append('term same {\n  destination-address:: %s\n'
+                  '  action:: deny\n}\n' % (
+                      'WEB_SERVERS' if filter_name == 'INPUT' else 'RFC1918'))
+    output = str(ipset.Ipset(policy.ParsePolicy(''.join(data), self.defs), 2))
+
+    created = [x.split()[1] for x in output.split('\n')
+               if x.startswith('create ')]
+    self.assertEqual(['I-0-dst', 'I-2-dst', 'same-dst'], created[:3])
+    self.assertEqual(4, len(created))
+    self.assertRegexpMatches(created[3], r'^same-dst-[0-9a-f]{8}$')
+    self.assertEqual(4, output.count('--match-set I-0-dst dst'))
+    self.assertEqual(2, output.count('--match-set I-2-dst dst'))
+    self.assertEqual(1, output.count('--match-set %s dst' % created[3]))
+
+
+def main():
+  unittest.main()
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,143 @@
+import unittest
+
+from lib import iptables
+from lib import naming
+from lib import policy
+from lib import speedway
+
+HEADER = """
+header {
+  target:: iptables INPUT ACCEPT
+}
+"""
+TERM = """
+term web-to-mail {
+  source-address:: WEB_SERVERS PUBLIC_NAT
+  destination-address:: MAIL_SERVERS NTP_SERVERS
+  protocol:: tcp udp
+  action:: %s
+}
+"""
+
+RESTORE_POLICY = """
+header {
+  target:: %(platform)s INPUT DROP restore
+}
+term web-to-mail {
+  source-address:: WEB_SERVERS PUBLIC_NAT
+  destination-address:: MAIL_SERVERS NTP_SERVERS
+  protocol:: tcp
+  action:: accept
+}
+header {
+  target:: %(platform)s OUTPUT restore
+}
+term allow-dns {
+  protocol:: udp
+  destination-port:: DNS
+  action:: accept
+}
+header {
+  target:: %(platform)s custom-chain restore
+}
+term deny-all {
+  action:: deny
+}
+"""
+
+
+def CheckRestorePayload(test, payload):
+  """Check the structure iptables-restore expects of a payload."""
+  lines = [x for x in payload.split('\n') if x and not x.startswith('#')]
+  test.assertEqual('*filter', lines[0])
+  test.assertEqual('COMMIT', lines[-1])
+  declared = [x.split()[0][1:] for x in lines[1:-1] if x.startswith(':')]
+  rules = lines[1 + len(declared):-1]
+  test.assertEqual(len(declared), len(set(declared)))
+  for line in lines[1:1 + len(declared)]:
+    test.assertRegexpMatches(line, r'^:\S+ (ACCEPT|DROP|-) \[0:0\]$')
+  for rule in rules:
+    words = rule.split()
+    test.assertEqual('-A', words[0])
+    test.assertTrue(words[1] in declared + iptables.Iptables._GOOD_FILTERS)
+    jump = words[words.index('-j') + 1]
+    test.assertTrue(jump.isupper() or jump in declared, rule)
+  return declared, rules
+
+
+class FakeStream(object):
+  """Keeps each string written to it."""
+
+  def __init__(self, writes):
+    self.write = writes.append
+
+
+class Test_Iptables(unittest.TestCase):
+
+  def setUp(self):
+    self.defs = naming.Naming('./def')
+
+  def Render(self, action):
+    pol = policy.ParsePolicy(HEADER + TERM % action, self.defs)
+    return [x for x in str(iptables.Iptables(pol, 2)).split('\n')
+            if x[:2] in ('-A', '-N')]
+
+  def test_sources_jump_to_a_chain_matching_destinations(self):
+    rules = self.Render('accept')
+
+    self.assertEqual(['-N I_web-to-mail', '-A INPUT -j I_web-to-mail',
+                      '-N Id_web-to-mail',
+                      '-A I_web-to-mail -s 200.1.1.1/32 -j Id_web-to-mail',
+                      '-A I_web-to-mail -s 200.1.1.2/31 -j Id_web-to-mail'],
+                     rules[:5])
+    self.assertEqual(6, len(rules[5:]))
+    for rule in rules[5:]:
+      self.assertTrue(rule.startswith('-A Id_web-to-mail -p '))
+      self.assertFalse(' -s ' in rule)
+
+  def test_next_terms_keep_the_cartesian_product(self):
+    rules = self.Render('next')
+
+    self.assertEqual(14, len(rules))
+    self.assertFalse([x for x in rules if 'Id_web-to-mail' in x])
+
+  def test_render_writes_each_term_as_it_is_rendered(self):
+    pol = policy.ParsePolicy(HEADER + TERM % 'accept' +
+                             TERM.replace('web-to-mail', 'mail-to-web') %
+                             'accept', self.defs)
+    writes = []
+    generator = iptables.Iptables(pol, 2)
+    generator.Render(FakeStream(writes))
+
+    self.assertEqual(str(generator), ''.join(writes))
+    self.assertEqual(1, len([x for x in writes if '-N I_web-to-mail' in x]))
+    self.assertEqual(1, len([x for x in writes if '-N I_mail-to-web' in x]))
+    self.assertFalse([x for x in writes
+                      if 'web-to-mail' in x and 'mail-to-web' in x])
+
+  def test_restore_payload(self):
+    for platform, generator in (('iptables', iptables.Iptables),
+                                ('speedway', speedway.Speedway)):
+      pol = policy.ParsePolicy(RESTORE_POLICY % {'platform': platform},
+                               self.defs)
+
+      declared, rules = CheckRestorePayload(self, str(generator(pol, 2)))
+      self.assertEqual(['INPUT', 'I_web-to-mail', 'Id_web-to-mail', 'OUTPUT',
+                        'O_allow-dns', 'custom-chain', 'c_deny-all'],
+                       declared)
+      self.assertEqual(2, len([x for x in rules if '-j Id_web-to-mail' in x]))
+
+  def test_restore_payload_holds_one_address_family(self):
+    pol = policy.ParsePolicy(
+        RESTORE_POLICY.replace('OUTPUT restore', 'OUTPUT inet6 restore') % {
+            'platform': 'iptables'}, self.defs)
+
+    self.assertRaises(iptables.UnsupportedFilterError, iptables.Iptables,
+                      pol, 2)
+
+
+def main():
+  unittest.main()
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,150 @@
+import random
+import re
+import unittest
+
+from lib import juniper
+from lib import naming
+from lib import policy
+from test import test_nacaddr
+
+
+PREFIX_LIST_POLICY = """
+header {
+  target:: juniper edge-filter %s
+}
+term deny-bogons {
+  source-address:: BOGON
+  action:: deny
+}
+term allow-internal {
+  source-address:: RFC1918
+  source-exclude:: NTP_SERVERS
+  destination-address:: PUBLIC_NAT
+  action:: accept
+}
+term deny-bogons-again {
+  destination-address:: BOGON
+  destination-prefix:: configured-neighbors-only
+  action:: deny
+}
+"""
+
+
+def ScanMinimizePrefixes(include, exclude):
+  """What _MinimizePrefixes did before it used a prefix trie."""
+  exclude_set = set(exclude)
+  include_result = [ip for ip in include if ip not in exclude_set]
+  exclude_result = []
+  for exclude_prefix in exclude:
+    for include_prefix in include_result:
+      if exclude_prefix in include_prefix:
+        exclude_result.append(exclude_prefix)
+        break
+  return include_result, exclude_result
+
+
+class Test_Juniper(unittest.TestCase):
+
+  def setUp(self):
+    self.defs = naming.Naming('./def')
+
+  def Render(self, options):
+    pol = policy.ParsePolicy(PREFIX_LIST_POLICY % options, self.defs)
+    return str(juniper.Juniper(pol, 2))
+
+  def test_prefix_lists_hold_the_addresses_of_terms(self):
+    output = self.Render('inet prefix-lists')
+    policy_options, firewall = output.split('firewall {', 1)
+
+    self.assertEqual(['BOGON', 'RFC1918', 'NTP_SERVERS'],
+                     [x.split()[1] for x in policy_options.split('\n')
+                      if x.strip().startswith('prefix-list ')])
+    self.assertEqual(3, policy_options.count('replace:'))
+    self.assertIn('10.0.0.1/32; /* Example NTP server */', policy_options)
+    self.assertIn('source-prefix-list {\n'
+                  '                        BOGON;\n'
+                  '                    }', firewall)
+    self.assertIn('source-prefix-list {\n'
+                  '                        RFC1918;\n'
+                  '                        NTP_SERVERS except;\n'
+                  '                    }', firewall)
+    # a single address is cheaper inline.
+    self.assertIn('destination-address {\n'
+                  '                        200.1.1.3/32;', firewall)
+    # addresses next to prefix lists of the term have to stay inline.
+    self.assertIn('destination-address {\n'
+                  '                        0.0.0.0/8;', firewall)
+
+  def test_addresses_are_inline_without_prefix_lists(self):
+    output = self.Render('inet')
+
+    self.assertTrue(output.startswith('firewall {'))
+    self.assertNotIn('source-prefix-list', output)
+
+  def test_identical_prefix_lists_are_configured_once(self):
+    data = []
+    for filter_name, af, token in (('first', 'inet', 'RESERVED'),
+                                   ('second', 'inet', 'RFC1918'),
+                                   ('third', 'inet6', 'LOOPBACK')):
+      data.append('header {\n  target:: juniper %s %s prefix-lists\n}\n' %
+                  (filter_name, af))
+      data.append('term deny-bogons {\n  source-address:: BOGON\n'
+                  '  action:: deny\n}\n')
+      data.append('term deny-reserved {\n  source-address:: %s\n'
+                  '  action:: deny\n}\n' % token)
+    output = str(juniper.Juniper(policy.ParsePolicy(''.join(data), self.defs),
+                                 2))
+
+    lists = [x.split()[1] for x in output.split('\n')
+             if x.strip().startswith('prefix-list ')]
+    self.assertEqual(['BOGON', 'RESERVED', 'RFC1918', 'BOGON-v6'], lists)
+    self.assertEqual(2, output.count('    BOGON;'))
+
+  def test_partial_tokens_never_take_the_name_of_the_token(self):
+    self.defs.ParseNetworkList(['TEN = 10.0.0.0/8',
+                                'LAB = 192.168.0.0/16'])
+    lists = {}
+    for filter_name, exclude in (('first', 'TEN'), ('second', 'LAB'),
+                                 ('third', None)):
+      data = ('header {\n  target:: juniper %s inet prefix-lists\n}\n'
+              'term allow-internal {\n  source-address:: RFC1918\n' %
+              filter_name)
+      if exclude:
+        data += '  source-exclude:: %s\n' % exclude
+      data += '  action:: accept\n}\n'
+      output = str(juniper.Juniper(policy.ParsePolicy(data, self.defs), 2))
+      # each policy is a file of its own, loaded on the same router.
+      for config in output.split('replace:')[1:]:
+        name = config.split()[1]
+        addresses = re.findall(r'([\d.]+/\d+);', config.split('}')[0])
+        self.assertEqual(lists.setdefault(name, addresses), addresses, name)
+
+    self.assertEqual(['10.0.0.0/8', '172.16.0.0/12', '192.168.0.0/16'],
+                     lists['RFC1918'])
+    self.assertEqual(2, len([x for x in lists
+                             if x.startswith('allow-internal-src-')]))
+
+  def test_prefix_lists_are_not_supported_for_bridge_filters(self):
+    self.assertRaises(juniper.UnsupportedFilterError, self.Render,
+                      'bridge prefix-lists')
+
+  def test_minimize_prefixes_matches_scan(self):
+    # _MinimizePrefixes does not use the term it belongs to.
+    term = juniper.Term.__new__(juniper.Term)
+    rand = random.Random(11)
+    for _ in xrange(200):
+      include = test_nacaddr.Build(
+          test_nacaddr.RandomAddresses(rand, rand.randint(0, 40)))
+      exclude = test_nacaddr.Build(
+          test_nacaddr.RandomAddresses(rand, rand.randint(0, 40)))
+      exclude.extend(rand.sample(include, len(include) / 4))
+
+      expected = ScanMinimizePrefixes(include, exclude)
+      self.assertEqual(expected, term._MinimizePrefixes(include, exclude))
+
+
+def main():
+  unittest.main()
+
+if __name__ == '__main__':
+  main()
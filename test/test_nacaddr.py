@@ -0,0 +1,139 @@
+import random
+import unittest
+
+from lib import nacaddr
+from third_party import ipaddr
+
+COMMENTS = ['', 'a', 'b', 'c', 'd']
+TOKENS = ['FOO', 'BAR', 'BAZ']
+
+
+def RecursiveCollapse(addresses):
+  """The recursive collapse CollapseAddrList used to be, as a reference."""
+  ret_array = []
+  optimized = False
+
+  for cur_addr in addresses:
+    if not ret_array:
+      ret_array.append(cur_addr)
+      continue
+    if ret_array[-1].Contains(cur_addr):
+      ret_array[-1].AddComment(cur_addr.text)
+      optimized = True
+    elif cur_addr == ret_array[-1].Supernet().Subnet()[1]:
+      ret_array.append(ret_array.pop().Supernet())
+      ret_array[-1].AddComment(cur_addr.text)
+      optimized = True
+    else:
+      ret_array.append(cur_addr)
+
+  if optimized:
+    return RecursiveCollapse(ret_array)
+  return ret_array
+
+
+def RemoveEachExclude(superset, excludes):
+  """The exclude AddressListExclude used to do, as a reference."""
+  superset = nacaddr.CollapseAddrList(superset)
+  for ex in nacaddr.CollapseAddrList(excludes):
+    superset = nacaddr.RemoveAddressFromList(superset, ex)
+  return nacaddr.CollapseAddrList(superset)
+
+
+def RandomAddresses(rand, count):
+  """Return a list of (address, comment, token, parent_token) tuples.
+
+  Addresses are crowded into a few small ranges so that plenty of them
+  overlap, contain one another or are adjacent.
+  """
+  rval = []
+  for _ in xrange(count):
+    if rand.random() < 0.8:
+      prefixlen = rand.randint(22, 30)
+      network = (10 << 24) + rand.randint(0, 4095) * 4
+      address = '%s/%d' % (ipaddr.IPv4Address(network), prefixlen)
+    else:
+      prefixlen = rand.randint(118, 126)
+      address = '2001:db8::%x/%d' % (rand.randint(0, 4095) * 4, prefixlen)
+    rval.append((address, rand.choice(COMMENTS), rand.choice(TOKENS),
+                 rand.choice(TOKENS)))
+  return rval
+
+
+def Build(spec):
+  rval = []
+  for address, comment, token, parent_token in spec:
+    addr = nacaddr.IP(address, comment, token)
+    addr.parent_token = parent_token
+    rval.append(addr)
+  return rval
+
+
+def Fragments(text):
+  """Return the distinct comments of a merged comment, in order."""
+  rval = []
+  for fragment in text.split(', '):
+    if fragment and fragment not in rval:
+      rval.append(fragment)
+  return rval
+
+
+class Test_NacAddr(unittest.TestCase):
+
+  def test_collapse_adjacent_and_contained(self):
+    addresses = [nacaddr.IP('10.0.1.0/24', 'b', 'FOO'),
+                 nacaddr.IP('10.0.0.0/24', 'a', 'BAR'),
+                 nacaddr.IP('10.0.0.128/25', 'c', 'BAZ'),
+                 nacaddr.IP('10.0.3.0/24', 'd', 'FOO')]
+
+    collapsed = nacaddr.CollapseAddrList(addresses)
+
+    self.assertEqual(['10.0.0.0/23', '10.0.3.0/24'], map(str, collapsed))
+    self.assertEqual('a, c, b', collapsed[0].text)
+    self.assertEqual('BAR', collapsed[0].token)
+    self.assertTrue(collapsed[1] is addresses[3])
+    # the addresses collapsed are left alone.
+    self.assertEqual('a', addresses[1].text)
+
+  def test_collapse_matches_recursive_collapse(self):
+    rand = random.Random(5)
+    for _ in xrange(200):
+      spec = RandomAddresses(rand, rand.randint(1, 60))
+      expected = RecursiveCollapse(nacaddr.SortAddrList(Build(spec)))
+      collapsed = nacaddr.CollapseAddrList(Build(spec))
+
+      self.assertEqual(map(str, expected), map(str, collapsed))
+      for want, got in zip(expected, collapsed):
+        self.assertEqual(want.token, got.token)
+        self.assertEqual(want.parent_token, got.parent_token)
+        self.assertEqual(Fragments(want.text), Fragments(got.text))
+
+  def test_exclude_matches_removing_each_exclude(self):
+    rand = random.Random(7)
+    for _ in xrange(200):
+      superset = RandomAddresses(rand, rand.randint(1, 40))
+      excludes = RandomAddresses(rand, rand.randint(0, 20))
+      expected = RemoveEachExclude(Build(superset), Build(excludes))
+      remaining = nacaddr.AddressListExclude(Build(superset), Build(excludes))
+
+      self.assertEqual(map(str, expected), map(str, remaining))
+      self.assertEqual([(x.text, x.token) for x in expected],
+                       [(x.text, x.token) for x in remaining])
+
+  def test_trie_containing_matches_scan(self):
+    rand = random.Random(9)
+    prefixes = Build(RandomAddresses(rand, 300))
+    trie = nacaddr.PrefixTrie()
+    for index, addr in enumerate(prefixes):
+      trie.Insert(addr, index)
+
+    for query in Build(RandomAddresses(rand, 300)) + prefixes:
+      expected = [i for i, x in enumerate(prefixes) if x.Contains(query)]
+      self.assertEqual(expected, sorted(trie.Containing(query)))
+
+
+def main():
+  unittest.main()
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,98 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from lib import naming
+
+
+class Test_Naming(unittest.TestCase):
+
+  def setUp(self):
+    self.defs = naming.Naming('./def')
+
+  def test_ip_parents_include_nesting_tokens(self):
+    self.assertEqual(['ANY', 'INTERNAL', 'RESERVED', 'RFC1918'],
+                     self.defs.GetIpParents('10.1.1.1'))
+    self.assertEqual(['GOOGLE_DNS', 'GOOGLE_PUBLIC_DNS_ANYCAST'],
+                     self.defs.GetIpParents('2001:4860:4860::8888'))
+    self.assertEqual(['INTERNAL', 'RESERVED'],
+                     self.defs.GetIpParents('RFC1918'))
+
+  def test_ip_parents_see_added_networks(self):
+    self.assertEqual(['ANY'], self.defs.GetIpParents('100.1.1.1'))
+    self.defs.ParseNetworkList(['LAB = 100.1.0.0/16',
+                                'LABS = LAB  # every lab'])
+    self.assertEqual(['ANY', 'LAB', 'LABS'],
+                     self.defs.GetIpParents('100.1.1.1'))
+
+  def test_get_net_returns_copies(self):
+    first = self.defs.GetNet('GOOGLE_DNS')
+    first[0].text = 'changed'
+    first.pop()
+
+    second = self.defs.GetNet('GOOGLE_DNS')
+    self.assertEqual(4, len(second))
+    self.assertEqual('IPv4 Anycast', second[0].text)
+    self.assertEqual('GOOGLE_PUBLIC_DNS_ANYCAST', second[0].token)
+    self.assertEqual('GOOGLE_DNS', second[0].parent_token)
+    self.assertFalse(first[0] is second[0])
+
+  def test_added_definitions_reset_resolved_tokens(self):
+    self.defs.ParseNetworkList(['LAB = 100.1.0.0/16'])
+    self.assertEqual(['100.1.0.0/16'], map(str, self.defs.GetNet('LAB')))
+    # continues the definition of LAB.
+    self.defs.ParseNetworkList(['      100.2.0.0/16'])
+    self.assertEqual(['100.1.0.0/16', '100.2.0.0/16'],
+                     map(str, self.defs.GetNet('LAB')))
+
+    self.defs.ParseServiceList(['LAB_SVC = 8080/tcp'])
+    self.assertEqual(['8080/tcp'], self.defs.GetService('LAB_SVC'))
+    self.defs.ParseServiceList(['          8443/tcp'])
+    self.assertEqual(['8080/tcp', '8443/tcp'],
+                     self.defs.GetService('LAB_SVC'))
+
+  def test_cycles_are_detected(self):
+    self.defs.ParseNetworkList(['LOOP_A = 10.0.0.0/8 LOOP_B',
+                                'LOOP_B = LOOP_A'])
+    self.defs.ParseServiceList(['LOOP_SVC = 53/udp LOOP_SVC'])
+    self.assertRaises(naming.DefinitionCycleError, self.defs.GetNet, 'LOOP_A')
+    self.assertRaises(naming.DefinitionCycleError,
+                      self.defs.GetService, 'LOOP_SVC')
+
+  def test_snapshot_is_reloaded_until_definitions_change(self):
+    tmp_dir = tempfile.mkdtemp()
+    try:
+      def_dir = os.path.join(tmp_dir, 'def')
+      snapshot = os.path.join(tmp_dir, 'def.snapshot')
+      shutil.copytree('./def', def_dir)
+
+      compiled = naming.Naming(def_dir, snapshot=snapshot)
+      loaded = naming.Naming()
+      self.assertTrue(loaded.LoadSnapshot(snapshot, def_dir))
+      for token in compiled.networks:
+        self.assertEqual(
+            [(str(x), x.text, x.token) for x in compiled.GetNet(token)],
+            [(str(x), x.text, x.token) for x in loaded.GetNet(token)])
+      self.assertEqual(compiled.GetService('WEB_SERVICES'),
+                       loaded.GetService('WEB_SERVICES'))
+
+      # touched but unchanged files don't invalidate the snapshot.
+      services = os.path.join(def_dir, 'SERVICES.svc')
+      os.utime(services, (0, 0))
+      self.assertTrue(naming.Naming().LoadSnapshot(snapshot, def_dir))
+
+      open(services, 'a').write('LAB_SVC = 8080/tcp\n')
+      self.assertFalse(naming.Naming().LoadSnapshot(snapshot, def_dir))
+      self.assertEqual(['8080/tcp'], naming.Naming(
+          def_dir, snapshot=snapshot).GetService('LAB_SVC'))
+      self.assertTrue(naming.Naming().LoadSnapshot(snapshot, def_dir))
+    finally:
+      shutil.rmtree(tmp_dir)
+
+
+def main():
+  unittest.main()
+
+if __name__ == '__main__':
+  main()
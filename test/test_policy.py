@@ -0,0 +1,222 @@
+import random
+import threading
+import unittest
+
+from lib import naming
+from lib import policy
+
+HEADER = """
+header {
+  target:: juniper test-filter
+}
+"""
+TERM_1 = """
+term good-term-1 {
+  protocol:: tcp
+  destination-address:: PUBLIC_NAT
+  destination-port:: SSH
+  action:: accept
+}
+"""
+TERM_2 = """
+term good-term-2 {
+  protocol:: udp
+  source-address:: RFC1918
+  destination-port:: DNS
+  action:: deny
+}
+"""
+
+NETWORKS = ['RFC1918', 'INTERNAL', 'LOOPBACK', 'ANY', 'GOOGLE_DNS',
+            'WEB_SERVERS', 'MAIL_SERVERS', 'PUBLIC_NAT', 'NTP_SERVERS']
+SERVICES = ['SSH', 'DNS', 'HTTP', 'WEB_SERVICES', 'HIGH_PORTS']
+
+
+def RandomTerms(rand, count):
+  """Return the text of count random terms, many of which shade others."""
+  data = []
+  for index in xrange(count):
+    lines = ['term term-%d {' % index]
+    if rand.random() < 0.8:
+      lines.append('  protocol:: %s' % ' '.join(
+          rand.sample(['tcp', 'udp'], rand.randint(1, 2))))
+      if rand.random() < 0.6:
+        lines[-1] = '  protocol:: tcp'
+        lines.append('  destination-port:: %s' % rand.choice(SERVICES))
+    for field in ('source-address', 'destination-address'):
+      if rand.random() < 0.5:
+        lines.append('  %s:: %s' % (field, rand.choice(NETWORKS)))
+    if rand.random() < 0.1:
+      lines.append('  source-exclude:: RFC1918')
+    lines.append('  action:: %s' % rand.choice(['accept', 'deny', 'next']))
+    lines.append('}')
+    data.extend(lines)
+  return '\n'.join(data)
+
+
+def PairwiseShading(terms):
+  """The comparison of every pair of terms _DetectShading used to do."""
+  shading_errors = []
+  for index, term in enumerate(terms):
+    for prior_index in xrange(index):
+      if (term in terms[prior_index]
+          and 'next' not in terms[prior_index].action):
+        shading_errors.append(
+            '  %s is shaded by %s.' % (term.name, terms[prior_index].name))
+  return '\n'.join(shading_errors)
+
+
+class Test_Policy(unittest.TestCase):
+
+  def setUp(self):
+    self.defs = naming.Naming('./def')
+
+  def test_parser_tables_are_reused(self):
+    parser = policy._PARSER
+    policy.ParsePolicy(HEADER + TERM_1, self.defs)
+    policy.ParsePolicy(HEADER + TERM_2, self.defs)
+    self.assertTrue(parser is policy._PARSER)
+
+  def test_consecutive_parses_are_independent(self):
+    first = policy.ParsePolicy(HEADER + TERM_1 + TERM_2, self.defs)
+    second = policy.ParsePolicy(HEADER + TERM_2, self.defs)
+    third = policy.ParsePolicy(HEADER + TERM_1 + TERM_2, self.defs)
+
+    _, terms = second.filters[0]
+    self.assertEqual(['good-term-2'], [x.name for x in terms])
+    self.assertEqual(first.filters[0][1], third.filters[0][1])
+
+  def test_parse_error_reports_next_token(self):
+    self.assertRaisesRegexp(policy.ParseError, 'line 5',
+                            policy.ParsePolicy, HEADER + 'term {', self.defs)
+
+  def test_copy_shares_addresses_only(self):
+    pol = policy.ParsePolicy(HEADER + TERM_1, self.defs)
+    header, terms = pol.filters[0]
+    original = str(terms[0])
+
+    copied = pol.Copy()
+    copy_header, copy_terms = copied.filters[0]
+    copy_header.FilterOptions('juniper').remove('test-filter')
+    copy_terms[0].name = 'renamed-term'
+    copy_terms[0].comment.append('Owner: nobody')
+    copy_terms[0].destination_port.append((1024, 65535))
+
+    self.assertEqual(['test-filter'], header.FilterOptions('juniper'))
+    self.assertEqual(original, str(terms[0]))
+    self.assertEqual([], terms[0].comment)
+    self.assertTrue(copy_terms[0].destination_address is
+                    terms[0].destination_address)
+
+  def test_contains_compares_addresses_less_excludes(self):
+    self.defs.ParseNetworkList(['TEST_NET = 10.0.0.0/8',
+                                'TEST_EXCLUDE = 10.1.0.0/16',
+                                'TEST_INSIDE = 10.2.0.0/16',
+                                'TEST_DST = 192.168.0.0/16',
+                                'TEST_OTHER_DST = 172.16.0.0/12'])
+    terms = []
+    for source, destination in (('TEST_NET', 'TEST_DST'),
+                                ('TEST_EXCLUDE', 'TEST_DST'),
+                                ('TEST_INSIDE', 'TEST_DST'),
+                                ('TEST_INSIDE', 'TEST_OTHER_DST')):
+      terms.append('\n'.join(['term %s-%s {' % (source, destination),
+                               '  source-address:: %s' % source,
+                               '  destination-address:: %s' % destination,
+                               '  action:: accept', '}']))
+    terms[0] = terms[0].replace('action::', 'source-exclude:: TEST_EXCLUDE\n'
+                                '  action::')
+    _, terms = policy.ParsePolicy(HEADER + ''.join(terms),
+                                  self.defs).filters[0]
+
+    self.assertEqual(((10 << 24, (10 << 24) + (1 << 16) - 1),
+                      ((10 << 24) + (2 << 16), (11 << 24) - 1)),
+                     terms[0].source_address_ranges)
+    self.assertFalse(terms[1] in terms[0])
+    self.assertTrue(terms[2] in terms[0])
+    self.assertFalse(terms[3] in terms[0])
+
+  def test_merge_terms(self):
+    terms = {
+        'web': ['destination-address:: WEB_SERVERS'],
+        'mail': ['destination-address:: MAIL_SERVERS'],
+        'counted': ['destination-address:: WEB_SERVERS', 'counter:: web'],
+        'next-1': ['destination-address:: WEB_SERVERS', 'action:: next'],
+        'next-2': ['destination-address:: MAIL_SERVERS', 'action:: next'],
+        'redundant': ['destination-address:: WEB_SERVERS'],
+        'shaded': ['destination-address:: WEB_SERVERS', 'action:: deny'],
+    }
+    data = [HEADER]
+    for name in ['web', 'mail', 'counted', 'next-1', 'next-2', 'redundant',
+                 'shaded']:
+      lines = ['term %s {' % name, '  protocol:: tcp',
+               '  destination-port:: HTTP'] + terms[name]
+      if not [x for x in lines if 'action::' in x]:
+        lines.append('  action:: accept')
+      data.extend(lines + ['}'])
+    pol = policy.ParsePolicy('\n'.join(data), self.defs)
+
+    savings = pol.MergeTerms()
+
+    _, merged = pol.filters[0]
+    self.assertEqual(['web', 'counted', 'next-1', 'next-2', 'shaded'],
+                     [x.name for x in merged])
+    self.assertEqual(['200.1.1.1/32', '200.1.1.2/32', '200.1.1.4/31'],
+                     [str(x) for x in merged[0].destination_address])
+    header, terms, merged_terms, rules, merged_rules = savings[0]
+    self.assertTrue(header is pol.headers[0])
+    self.assertEqual((7, 5, 12, 10),
+                     (terms, merged_terms, rules, merged_rules))
+
+  def test_shading_matches_pairwise_comparison(self):
+    rand = random.Random(3)
+    for _ in xrange(50):
+      data = HEADER + RandomTerms(rand, rand.randint(2, 40))
+      _, terms = policy.ParsePolicy(data, self.defs).filters[0]
+      expected = PairwiseShading(terms)
+      try:
+        policy.ParsePolicy(data, self.defs, shade_check=True)
+        report = ''
+      except policy.ShadingError as e:
+        report = str(e)
+      self.assertEqual(expected, report)
+
+  def test_identical_verbatim_terms_shade(self):
+    data = HEADER
+    for name in ('v1', 'v2'):
+      data += ('term %s {\n  verbatim:: juniper "permit"\n}\n' % name)
+    try:
+      policy.ParsePolicy(data, self.defs, shade_check=True)
+      report = ''
+    except policy.ShadingError as e:
+      report = str(e)
+    self.assertTrue('v2 is shaded by v1' in report, report)
+
+  def test_concurrent_parsers_share_definitions(self):
+    optimized = policy.PolicyParser(self.defs)
+    unoptimized = policy.PolicyParser(self.defs, optimize=False)
+    expected = [optimized.Parse(HEADER + TERM_1 + TERM_2),
+                unoptimized.Parse(HEADER + TERM_2)]
+    results = {}
+
+    def Worker(index):
+      parser = (optimized, unoptimized)[index % 2]
+      data = (HEADER + TERM_1 + TERM_2, HEADER + TERM_2)[index % 2]
+      for _ in range(10):
+        results.setdefault(index, []).append(parser.Parse(data))
+
+    threads = [threading.Thread(target=Worker, args=(i,)) for i in range(8)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    for index, pols in results.items():
+      for pol in pols:
+        self.assertEqual(expected[index % 2].filters[0][1], pol.filters[0][1])
+
+
+def main():
+  unittest.main()
+
+if __name__ == '__main__':
+  main()
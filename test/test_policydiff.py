@@ -0,0 +1,193 @@
+import itertools
+import random
+import unittest
+
+from lib import aclcheck
+from lib import nacaddr
+from lib import naming
+from lib import policy
+from lib import policydiff
+
+HEADER = """
+header {
+  target:: %s
+}
+"""
+TERMS = [
+    """
+term count-mail {
+  destination-address:: MAIL_SERVERS
+  action:: next
+}""",
+    """
+term deny-loopback {
+  address:: LOOPBACK
+  action:: deny
+}""",
+    """
+term allow-mail {
+  destination-address:: MAIL_SERVERS
+  destination-port:: SMTP
+  protocol:: tcp
+  action:: accept
+}""",
+    """
+term allow-internal {
+  source-address:: INTERNAL
+  source-exclude:: NTP_SERVERS
+  protocol-except:: gre
+  action:: accept
+}""",
+    """
+term allow-dns {
+  port:: DNS
+  protocol:: udp
+  action:: accept
+}""",
+    """
+term deny-tcp {
+  protocol:: tcp
+  action:: reject
+}""",
+    """
+term deny-all {
+  action:: deny
+}""",
+]
+HOSTS = ['200.1.1.4', '200.1.1.5', '200.1.1.1', '10.0.0.1', '10.0.0.2',
+         '10.1.1.1', '172.16.5.5', '192.168.1.1', '127.0.0.1', '8.8.8.8',
+         '::1', '2001:db8::1']
+PORTS = ['25', '53', '1024']
+PROTOCOLS = ['tcp', 'udp', 'gre', 'icmp']
+ADDRESSES = dict((x, nacaddr.IP(x)) for x in HOSTS)
+
+
+def Region(change):
+  """Return a function checking if a (src, dst, sport, dport, proto) flow is
+  in the region of a change."""
+  sources = [nacaddr.IP(x) for x in change.source]
+  destinations = [nacaddr.IP(x) for x in change.destination]
+
+  def InPorts(ports, value):
+    for text in ports:
+      if text == 'any':
+        return True
+      first, _, last = text.partition('-')
+      if int(first) <= int(value) <= int(last or first):
+        return True
+    return False
+
+  def Contains(flow):
+    src, dst, sport, dport, proto = flow
+    return (('any' in change.protocol or proto in change.protocol or
+             ('other' in change.protocol and proto not in PROTOCOLS[:3])) and
+            InPorts(change.source_port, sport) and
+            InPorts(change.destination_port, dport) and
+            any(ADDRESSES[src] in x for x in sources) and
+            any(ADDRESSES[dst] in x for x in destinations))
+
+  return Contains
+
+
+class Test_PolicyDiff(unittest.TestCase):
+
+  def setUp(self):
+    self.defs = naming.Naming('./def')
+
+  def Parse(self, terms, target='juniper test-filter'):
+    return policy.ParsePolicy(HEADER % target + ''.join(terms), self.defs,
+                              optimize=False)
+
+  def Outcomes(self, pol, flows):
+    terms = pol.filters[0][1]
+    hits = aclcheck.FlowClassifier(pol, use_numpy=False).Classify(flows)[0]
+    return [x >= 0 and terms[x].action[0] or 'default' for x in hits]
+
+  def test_identical_and_reordered_policies_have_no_changes(self):
+    old = self.Parse(TERMS)
+    renamed = [x.replace('deny-tcp', 'reject-tcp') for x in TERMS]
+    # a next term doesn't change the outcome of any packet.
+    reordered = [TERMS[1], TERMS[0]] + TERMS[2:]
+    for terms in (TERMS, renamed, reordered):
+      diff = policydiff.PolicyDiff(old, self.Parse(terms))
+      self.assertEqual([], diff.filters)
+      self.assertEqual('', str(diff))
+
+  def test_changes_match_the_packets_treated_differently(self):
+    # packets don't mix address families.
+    flows = [x for x in itertools.product(HOSTS, HOSTS, PORTS[:2], PORTS,
+                                          PROTOCOLS)
+             if (':' in x[0]) == (':' in x[1])]
+    rand = random.Random(3)
+    versions = [TERMS[:2] + TERMS[3:], TERMS[1:], TERMS[:-1],
+                [TERMS[0], TERMS[5]] + TERMS[1:5] + TERMS[6:],
+                [x.replace('reject', 'accept') for x in TERMS]]
+    for _ in xrange(3):
+      versions.append(rand.sample(TERMS, rand.randint(1, len(TERMS))))
+    # an inet filter never sees IPv6 packets.
+    for target, ipv6 in (('juniper test-filter', False),
+                         ('cisco test-filter mixed', True)):
+      old = self.Parse(TERMS, target)
+      old_outcomes = self.Outcomes(old, flows)
+      for terms in versions:
+        new = self.Parse(terms, target)
+        diff = policydiff.PolicyDiff(old, new)
+        changes = dict(diff.filters).get(' '.join(target.split()[:2]), [])
+        regions = [(Region(x), x.old, x.new) for x in changes]
+        for flow, before, after in zip(flows, old_outcomes,
+                                       self.Outcomes(new, flows)):
+          found = [(x, y) for region, x, y in regions if region(flow)]
+          if before == after or (':' in flow[0] and not ipv6):
+            self.assertEqual([], found, (flow, terms))
+          else:
+            self.assertEqual([(before, after)], found, (flow, terms))
+
+  def test_qualified_terms_pass_the_other_packets_on(self):
+    old = self.Parse(TERMS[-2:])
+    new = self.Parse([TERMS[-2].replace('protocol:: tcp',
+                                        'protocol:: tcp\n  option:: '
+                                        'tcp-established')] + TERMS[-1:])
+    diff = policydiff.PolicyDiff(old, new)
+
+    self.assertEqual(1, len(diff.filters))
+    self.assertEqual(['src 0.0.0.0/0 dst 0.0.0.0/0 sport any dport any proto '
+                      'tcp: reject -> reject if option tcp-established, else '
+                      'deny'],
+                     [str(x) for x in diff.filters[0][1]])
+
+  def test_filters_of_one_version_are_compared_to_empty_ones(self):
+    old = self.Parse(TERMS[-1:])
+    new = self.Parse(TERMS[-1:], 'cisco test-filter inet6')
+    diff = policydiff.PolicyDiff(old, new)
+
+    self.assertEqual(['juniper test-filter', 'cisco test-filter'],
+                     [x for x, _ in diff.filters])
+    self.assertEqual([(['0.0.0.0/0'], 'deny', 'default')],
+                     [(x.source, x.old, x.new) for x in diff.filters[0][1]])
+    self.assertEqual([(['::/0'], 'default', 'deny')],
+                     [(x.source, x.old, x.new) for x in diff.filters[1][1]])
+
+  def test_terms_of_other_address_families_are_left_out(self):
+    ipv6_only = TERMS[-1].replace('term deny-all {',
+                                  'term deny-v6 {\n  address:: LINKLOCAL')
+    # the address matches either way, a change for each.
+    for target, count in (('juniper test-filter', 0),
+                          ('juniper test-filter inet6', 2),
+                          ('nsxv inet6 1009', 2),
+                          ('iptables INPUT ACCEPT inet6', 2),
+                          ('cisco test-filter mixed', 2)):
+      old = self.Parse(TERMS[:1], target)
+      new = self.Parse([ipv6_only] + TERMS[:1], target)
+      changes = policydiff.PolicyDiff(old, new).filters
+      self.assertEqual(count, len(changes and changes[0][1]), target)
+
+  def test_rejects_other_objects(self):
+    self.assertRaises(policydiff.BadPolicy, policydiff.PolicyDiff, None,
+                      self.Parse(TERMS))
+
+
+def main():
+  unittest.main()
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,716 @@
+#!/usr/bin/python
+#
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Micro benchmarks for the policy compiler.
+
+Run from the top of the source tree, eg:
+  $ python tools/benchmark.py            # run every benchmark
+  $ python tools/benchmark.py parse      # run only the named benchmarks
+"""
+
+from cStringIO import StringIO
+import copy
+from optparse import OptionParser
+import os
+import random
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+import aclgen
+from lib import aclcheck
+from lib import aclcheckserver
+from lib import cisco
+from lib import iptables
+from lib import juniper
+from lib import nacaddr
+from lib import naming
+from lib import policy
+from lib import policydiff
+from lib import speedway
+from third_party import ipaddr
+from third_party.ply import lex
+from third_party.ply import yacc
+
+
+BENCHMARKS = []
+
+
+def Benchmark(func):
+  """Register a benchmark function under its own name."""
+  BENCHMARKS.append(func)
+  return func
+
+
+def Time(func, iterations):
+  """Return the best wall clock time of iterations calls to func, in seconds."""
+  best = None
+  for _ in xrange(iterations):
+    start = time.time()
+    func()
+    elapsed = time.time() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return best
+
+
+def Report(name, seconds, count=1):
+  """Print a single result line, per item when count is given."""
+  print '  %-40s %10.3f ms' % (name, seconds * 1000 / count)
+
+
+def Measure(setup, func):
+  """Time func(setup()) in a child process and measure its peak RSS.
+
+  Running in a fresh child keeps the peak RSS of one measurement from
+  hiding the next one.
+
+  Returns:
+    (seconds, megabytes) tuple.
+  """
+  read_fd, write_fd = os.pipe()
+  pid = os.fork()
+  if not pid:
+    status = 1
+    try:
+      os.close(read_fd)
+      arg = setup()
+      start = time.time()
+      func(arg)
+      elapsed = time.time() - start
+      rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+      os.write(write_fd, '%f %d' % (elapsed, rss))
+      status = 0
+    finally:
+      os._exit(status)
+  os.close(write_fd)
+  result = os.read(read_fd, 1024)
+  os.close(read_fd)
+  _, status = os.waitpid(pid, 0)
+  if status:
+    raise RuntimeError('benchmark child process failed')
+  seconds, rss = result.split()
+  # ru_maxrss is in kilobytes on linux.
+  return float(seconds), int(rss) / 1024.0
+
+
+def MultiTargetPolicy(defs, num_terms, num_addresses):
+  """Add networks to defs and return a policy using them for four targets.
+
+  Every term matches its own network of num_addresses non adjacent /24s, so
+  the addresses can't be collapsed.
+  """
+  lines = []
+  for term in xrange(num_terms):
+    lines.append('BENCH_NET_%d =' % term)
+    for index in xrange(num_addresses):
+      index += term * num_addresses
+      lines.append('  10.%d.%d.0/24' % (index / 128 % 256, index % 128 * 2))
+  defs.ParseNetworkList(lines)
+
+  data = ['header {',
+          '  target:: juniper bench-filter',
+          '  target:: cisco bench-filter',
+          '  target:: iptables INPUT ACCEPT',
+          '  target:: speedway INPUT ACCEPT',
+          '}']
+  for term in xrange(num_terms):
+    data.extend(['term bench-term-%d {' % term,
+                 '  source-address:: BENCH_NET_%d' % term,
+                 '  protocol:: tcp',
+                 '  destination-port:: SSH',
+                 '  action:: accept',
+                 '}'])
+  return '\n'.join(data)
+
+
+def ShadingPolicy(defs, num_terms):
+  """Add networks to defs and return a policy of num_terms terms.
+
+  Terms match a source /24 of their own, a destination /16 and a service,
+  one in fifty matches a whole /16 of sources, and shades the terms after
+  it which match its /16.
+  """
+  lines = []
+  for term in xrange(num_terms):
+    lines.append('SHADE_SRC_%d = 10.%d.%d.0/%d' % (
+        term, term / 256 % 256, term % 256, 16 if term % 50 == 7 else 24))
+  for net in xrange(16):
+    lines.append('SHADE_DST_%d = 172.%d.0.0/16' % (net, net + 16))
+  defs.ParseNetworkList(lines)
+
+  services = ['SSH', 'HTTP', 'SMTP', 'DNS', 'HIGH_PORTS']
+  data = ['header {', '  target:: juniper shade-filter', '}']
+  for term in xrange(num_terms):
+    data.extend(['term shade-term-%d {' % term,
+                 '  source-address:: SHADE_SRC_%d' % term,
+                 '  destination-address:: SHADE_DST_%d' % (term % 16),
+                 '  protocol:: tcp',
+                 '  destination-port:: %s' % services[term % len(services)],
+                 '  action:: accept',
+                 '}'])
+  return '\n'.join(data)
+
+
+def PairwiseShading(terms):
+  """policy.Policy._DetectShading before it indexed the terms."""
+  shading_errors = []
+  for index, term in enumerate(terms):
+    for prior_index in xrange(index):
+      if (term in terms[prior_index]
+          and 'next' not in terms[prior_index].action):
+        shading_errors.append(
+            '  %s is shaded by %s.' % (
+                term.name, terms[prior_index].name))
+  return '\n'.join(shading_errors)
+
+
+def RecursiveCollapse(addresses):
+  """nacaddr.CollapseAddrList before it worked on integer ranges."""
+  ret_array = []
+  optimized = False
+  for cur_addr in addresses:
+    if not ret_array:
+      ret_array.append(cur_addr)
+      continue
+    if ret_array[-1].Contains(cur_addr):
+      ret_array[-1].AddComment(cur_addr.text)
+      optimized = True
+    elif cur_addr == ret_array[-1].Supernet().Subnet()[1]:
+      ret_array.append(ret_array.pop().Supernet())
+      ret_array[-1].AddComment(cur_addr.text)
+      optimized = True
+    else:
+      ret_array.append(cur_addr)
+  if optimized:
+    return RecursiveCollapse(ret_array)
+  return ret_array
+
+
+def RandomPrefixes(count, seed=0):
+  """Return count IPv4 prefixes like a large token expansion.
+
+  Mostly runs of adjacent /24s with gaps, like cloud provider or country
+  ranges, plus some random overlapping prefixes.
+  """
+  rand = random.Random(seed)
+  rval = []
+  network = 10 << 24
+  while len(rval) < count:
+    if rand.random() < 0.9:
+      network += 256 * rand.choice((1, 1, 1, 2))
+      prefix = '%s/24' % ipaddr.IPv4Address(network)
+    else:
+      prefix = '%s/%d' % (ipaddr.IPv4Address(
+          rand.randint(10 << 24, network)), rand.randint(16, 32))
+    rval.append(nacaddr.IP(prefix, 'comment %d' % rand.randint(0, 9)))
+  return rval
+
+
+def ScanIpParents(defs, query):
+  """naming.Naming.GetIpParents before it used a prefix trie."""
+  base_parents = []
+  recursive_parents = []
+  if not isinstance(query, (nacaddr.IPv4, nacaddr.IPv6)):
+    if query[:1].isdigit():
+      query = nacaddr.IP(query)
+  if isinstance(query, (nacaddr.IPv4, nacaddr.IPv6)):
+    for token in defs.networks:
+      for item in defs.networks[token].items:
+        item = item.split('#')[0].strip()
+        if item[:1].isdigit() and nacaddr.IP(item).Contains(query):
+          base_parents.append(token)
+  else:
+    for token in defs.networks:
+      for item in defs.networks[token].items:
+        item = item.split('#')[0].strip()
+        if item[:1].isalpha() and item == query:
+          base_parents.append(token)
+  for bp in base_parents:
+    done = False
+    for token in defs.networks:
+      if bp in defs.networks[token].items:
+        if bp[:1].isalpha():
+          if bp not in recursive_parents:
+            recursive_parents.append(bp)
+            recursive_parents.extend(ScanIpParents(defs, bp))
+          done = True
+    if not done:
+      if bp[:1].isalpha() and bp not in recursive_parents:
+        recursive_parents.append(bp)
+  return sorted(list(set(recursive_parents)))
+
+
+def NetworkDefinitionLines(num_lines):
+  """Return num_lines lines of network definitions.
+
+  Tokens of 50 addresses each, every ten of them included in a group token
+  and every ten groups in a region token.
+  """
+  lines = []
+  for token in xrange(num_lines / 50):
+    name = 'NET_%d =' % token
+    for index in xrange(token * 50, token * 50 + 50):
+      lines.append('%s 10.%d.%d.%d/32  # host %d' % (
+          name, index / 65536 % 256, index / 256 % 256, index % 256, index))
+      name = ''
+    if token % 10 == 0:
+      lines.append('GROUP_%d = %s' % (token / 10, ' '.join(
+          'NET_%d' % x for x in xrange(token, token + 10))))
+    if token % 100 == 0:
+      lines.append('REGION_%d = %s' % (token / 100, ' '.join(
+          'GROUP_%d' % x for x in xrange(token / 10, token / 10 + 10))))
+  return lines
+
+
+def LargeNetworkDefinitions(num_lines):
+  """Return a Naming object with num_lines lines of network definitions."""
+  defs = naming.Naming()
+  defs.ParseNetworkList(NetworkDefinitionLines(num_lines))
+  return defs
+
+
+def PolicyFiles(base_dir):
+  """Return the .pol files found under base_dir."""
+  rval = []
+  for dirpath, _, filenames in os.walk(base_dir):
+    for filename in sorted(filenames):
+      if filename.endswith('.pol'):
+        rval.append(os.path.join(dirpath, filename))
+  return sorted(rval)
+
+
+@Benchmark
+def parse(flags):
+  """Per policy file parser setup and parse time."""
+  defs = naming.Naming(flags.definitions)
+  data = [open(x).read() for x in PolicyFiles(flags.policy_directory)]
+
+  def Rebuild():
+    # what ParsePolicy used to do for every file.
+    lex.lex(module=policy)
+    yacc.yacc(module=policy, write_tables=False, debug=0,
+              errorlog=yacc.NullLogger())
+
+  def Clone():
+    policy._LEXER.clone()
+
+  def ParseAll():
+    for pol in data:
+      policy.ParsePolicy(pol, defs)
+
+  Report('setup, tables rebuilt (before)', Time(Rebuild, flags.iterations))
+  Report('setup, cached tables (after)', Time(Clone, flags.iterations))
+  Report('parse per file', Time(ParseAll, flags.iterations), len(data))
+
+
+@Benchmark
+def jobs(flags):
+  """aclgen rendering time of the policy directory by number of jobs."""
+  defs = naming.Naming(flags.definitions)
+  output_dir = tempfile.mkdtemp()
+  stdout = sys.stdout
+
+  def Render(num_jobs):
+    policy.CacheParseFile.cache.clear()
+    sys.stdout = StringIO()
+    try:
+      aclgen.load_and_render(flags.policy_directory, defs, False, 2,
+                             output_dir, num_jobs)
+    finally:
+      sys.stdout = stdout
+
+  try:
+    for num_jobs in [int(x) for x in flags.jobs.split(',')]:
+      Report('--jobs %d' % num_jobs,
+             Time(lambda: Render(num_jobs), flags.iterations))
+  finally:
+    shutil.rmtree(output_dir)
+
+
+@Benchmark
+def collapse(flags):
+  """nacaddr.CollapseAddrList of a large token expansion."""
+  prefixes = RandomPrefixes(flags.prefixes)
+  # the recursive collapse modifies the comments of the prefixes, and is
+  # slow enough to only run once.
+  copies = [nacaddr.IP(x, x.text) for x in prefixes]
+  Report('%d prefixes, recursive (before)' % len(prefixes),
+         Time(lambda: RecursiveCollapse(nacaddr.SortAddrList(copies)), 1))
+  Report('%d prefixes, ranges (after)' % len(prefixes),
+         Time(lambda: nacaddr.CollapseAddrList(prefixes), flags.iterations))
+
+
+@Benchmark
+def exclude(flags):
+  """nacaddr.AddressListExclude of large include and exclude lists."""
+  superset = RandomPrefixes(flags.excludes * 5, seed=1)
+  excludes = RandomPrefixes(flags.excludes, seed=2)
+
+  def RemoveEachExclude():
+    # what AddressListExclude used to do.
+    remaining = nacaddr.CollapseAddrList(superset)
+    for ex in nacaddr.CollapseAddrList(excludes):
+      remaining = nacaddr.RemoveAddressFromList(remaining, ex)
+    return nacaddr.CollapseAddrList(remaining)
+
+  name = '%d-%d prefixes' % (len(superset), len(excludes))
+  Report(name + ', each exclude (before)', Time(RemoveEachExclude, 1))
+  Report(name + ', sweep (after)',
+         Time(lambda: nacaddr.AddressListExclude(superset, excludes),
+              flags.iterations))
+
+
+@Benchmark
+def minimize(flags):
+  """juniper.Term._MinimizePrefixes of large include and exclude lists."""
+  include = RandomPrefixes(flags.minimize, seed=3)
+  exclude = RandomPrefixes(flags.minimize, seed=4)
+  # _MinimizePrefixes does not use the term it belongs to.
+  term = juniper.Term.__new__(juniper.Term)
+
+  def Scan(excludes):
+    # what _MinimizePrefixes used to do, after dropping exact matches.
+    exclude_set = set(exclude)
+    include_result = [ip for ip in include if ip not in exclude_set]
+    exclude_result = []
+    for exclude_prefix in excludes:
+      for include_prefix in include_result:
+        if exclude_prefix in include_prefix:
+          exclude_result.append(exclude_prefix)
+          break
+    return exclude_result
+
+  # the scan takes minutes on the full lists, time a slice of the excludes.
+  sample = exclude[:flags.minimize / 20]
+  name = '%d-%d prefixes' % (len(include), len(exclude))
+  Report(name + ', scan (before) per exclude', Time(lambda: Scan(sample), 1),
+         len(sample))
+  seconds = Time(lambda: term._MinimizePrefixes(include, exclude),
+                 flags.iterations)
+  Report(name + ', trie (after) per exclude', seconds, len(exclude))
+  Report(name + ', trie (after)', seconds)
+
+
+@Benchmark
+def parents(flags):
+  """naming.Naming.GetIpParents latency on large network definitions."""
+  defs = LargeNetworkDefinitions(flags.lines)
+  rand = random.Random(0)
+  queries = ['10.%d.%d.%d' % (rand.randint(0, 10), rand.randint(0, 255),
+                              rand.randint(0, 255)) for _ in xrange(1000)]
+
+  Report('%d lines, scan (before)' % flags.lines,
+         Time(lambda: ScanIpParents(defs, queries[0]), 1))
+
+  def BuildIndex():
+    defs._network_index = None
+    defs._NetworkIndex()
+
+  Report('%d lines, trie build' % flags.lines, Time(BuildIndex, 1))
+
+  def Query():
+    for query in queries:
+      defs.GetIpParents(query)
+
+  Report('%d lines, trie (after)' % flags.lines,
+         Time(Query, flags.iterations), len(queries))
+
+
+@Benchmark
+def shading(flags):
+  """Shade checking of a large filter."""
+  defs = naming.Naming(flags.definitions)
+  data = ShadingPolicy(defs, flags.shade_terms)
+  pol = policy.ParsePolicy(data, defs)
+  _, terms = pol.filters[0]
+  reports = {}
+
+  def Indexed():
+    try:
+      pol._DetectShading(terms)
+      reports['after'] = ''
+    except policy.ShadingError as e:
+      reports['after'] = str(e)
+
+  def Pairwise():
+    reports['before'] = PairwiseShading(terms)
+
+  name = '%d terms' % len(terms)
+  Report(name + ', pairwise (before)', Time(Pairwise, 1))
+  Report(name + ', indexed (after)', Time(Indexed, flags.iterations))
+  if reports['before'] != reports['after']:
+    raise RuntimeError('shading reports differ')
+  print '  %-40s %10d' % ('terms shaded', reports['after'].count('\n') + 1)
+
+
+@Benchmark
+def check(flags):
+  """aclcheck queries against a large filter."""
+  defs = naming.Naming(flags.definitions)
+  pol = policy.ParsePolicy(ShadingPolicy(defs, flags.shade_terms), defs)
+  rand = random.Random(0)
+  queries = [dict(src='10.%d.%d.%d' % (rand.randint(0, 20),
+                                       rand.randint(0, 255),
+                                       rand.randint(0, 255)),
+                  dst='172.%d.1.1' % rand.randint(16, 40),
+                  sport='1025', dport=str(rand.choice((22, 25, 53, 80, 443))),
+                  proto=rand.choice(('tcp', 'udp')))
+             for _ in xrange(1000)]
+  indexes = []
+
+  def Scan():
+    for query in queries[:50]:
+      aclcheck.AclCheck(pol, **query)
+
+  def Build():
+    indexes[:] = [aclcheck.AclIndex(pol)]
+
+  def Indexed():
+    for query in queries:
+      aclcheck.AclCheck(pol, index=indexes[0], **query)
+
+  name = '%d terms' % flags.shade_terms
+  seconds = Time(Scan, 1)
+  Report(name + ', scan (before) per query', seconds, 50)
+  print '  %-40s %10d' % (name + ', scan (before) queries/s', 50 / seconds)
+  Report(name + ', index build', Time(Build, 1))
+  seconds = Time(Indexed, flags.iterations)
+  Report(name + ', index (after) per query', seconds, len(queries))
+  print '  %-40s %10d' % (name + ', index (after) queries/s',
+                          len(queries) / seconds)
+
+
+def FlowLog(num_flows, seed=0):
+  """Return num_flows flows like a flow log, for the ShadingPolicy filter.
+
+  Flows come from a few thousand hosts to a few hundred, so hosts and whole
+  flows repeat, as they do in real logs.
+  """
+  rand = random.Random(seed)
+  sources = ['10.%d.%d.%d' % (rand.randint(0, 20), rand.randint(0, 255),
+                              rand.randint(0, 255)) for _ in xrange(5000)]
+  destinations = ['172.%d.%d.%d' % (rand.randint(16, 40),
+                                    rand.randint(0, 255),
+                                    rand.randint(0, 255)) for _ in xrange(300)]
+  rval = []
+  for _ in xrange(num_flows):
+    rval.append((rand.choice(sources), rand.choice(destinations),
+                 str(rand.randint(1024, 65535)),
+                 rand.choice(('22', '25', '53', '80', '443')),
+                 rand.choice(('tcp', 'tcp', 'tcp', 'udp'))))
+  return rval
+
+
+@Benchmark
+def evaluate(flags):
+  """aclcheck flow log replay against a large filter."""
+  defs = naming.Naming(flags.definitions)
+  pol = policy.ParsePolicy(ShadingPolicy(defs, flags.shade_terms), defs)
+  index = aclcheck.AclIndex(pol)
+  flows = FlowLog(flags.flows)
+
+  def OnePerFlow(count, **kwargs):
+    for flow in flows[:count]:
+      aclcheck.AclCheck(pol, *flow, **kwargs)
+
+  seconds = Time(lambda: OnePerFlow(20), 1)
+  print '  %-40s %10d' % ('AclCheck scan (before) flows/min',
+                          20 * 60 / seconds)
+  seconds = Time(lambda: OnePerFlow(1000, index=index), 1)
+  print '  %-40s %10d' % ('AclCheck with index flows/min',
+                          1000 * 60 / seconds)
+  for jobs in [int(x) for x in flags.jobs.split(',')]:
+    seconds = Time(lambda: list(aclcheck.AclCheck.EvaluateMany(
+        pol, flows, index=index, jobs=jobs)), 1)
+    print '  %-40s %10d' % ('EvaluateMany, %d jobs flows/min' % jobs,
+                            len(flows) * 60 / seconds)
+
+
+@Benchmark
+def classify(flags):
+  """Per-term hit counts of a flow log, with NumPy and without."""
+  defs = naming.Naming(flags.definitions)
+  pol = policy.ParsePolicy(ShadingPolicy(defs, flags.shade_terms), defs)
+  flows = FlowLog(flags.flows)
+  # the pure Python classifier checks every term of each flow, give it fewer.
+  backends = [('Python', False, flows[:2000])]
+  if aclcheck.numpy is not None:
+    backends.append(('NumPy', True, flows))
+  for name, use_numpy, some_flows in backends:
+    classifier = aclcheck.FlowClassifier(pol, use_numpy=use_numpy)
+    seconds = Time(lambda: classifier.HitCounts(some_flows), 1)
+    print '  %-40s %10d' % ('%s flows/min' % name,
+                            len(some_flows) * 60 / seconds)
+
+
+@Benchmark
+def diff(flags):
+  """Semantic diff of a large filter against edited versions of it."""
+  defs = naming.Naming(flags.definitions)
+  data = ShadingPolicy(defs, flags.shade_terms)
+  pol = policy.ParsePolicy(data, defs)
+  middle = flags.shade_terms / 2
+  edits = [('unchanged', data),
+           ('one action changed', re.sub(
+               r'(term shade-term-%d {[^}]*)accept' % middle, r'\1deny',
+               data)),
+           ('one /16 term removed', data.replace(
+               '  source-address:: SHADE_SRC_7\n',
+               '  source-address:: SHADE_SRC_7\n  platform:: cisco\n')),
+           ('deny all inserted', data.replace(
+               'term shade-term-10 {',
+               'term deny-all {\n  action:: deny\n}\nterm shade-term-10 {'))]
+  for name, edited in edits:
+    new = policy.ParsePolicy(edited, defs)
+    changes = {}
+
+    def Diff():
+      changes['count'] = sum(len(x) for _, x in policydiff.PolicyDiff(
+          pol, new).filters)
+
+    Report('%d terms, %s' % (flags.shade_terms, name), Time(Diff, 1))
+    print '  %-40s %10d' % ('changes', changes['count'])
+
+
+@Benchmark
+def serve(flags):
+  """aclcheck queries of every policy, parsed per query or kept loaded."""
+  query = {'src': '10.1.1.1', 'dst': '200.1.1.1', 'sport': '1025',
+           'dport': '80', 'proto': 'tcp'}
+
+  def ParseEach():
+    defs = naming.Naming(flags.definitions)
+    for filename in PolicyFiles(flags.policy_directory):
+      aclcheck.AclCheck(policy.ParseFile(filename, defs), **query)
+
+  store = aclcheckserver.PolicyStore(flags.definitions, flags.policy_directory)
+  Report('parse per query (before)', Time(ParseEach, 1))
+  Report('loaded store, per query (after)',
+         Time(lambda: store.Check(**query), flags.iterations))
+  Report('refresh, nothing changed', Time(store.Refresh, flags.iterations))
+
+
+@Benchmark
+def startup(flags):
+  """Loading large definitions, parsed from source or from a snapshot."""
+  def_dir = tempfile.mkdtemp()
+  snapshot = os.path.join(def_dir, 'snapshot')
+  try:
+    shutil.copy(os.path.join(flags.definitions, 'SERVICES.svc'), def_dir)
+    output = open(os.path.join(def_dir, 'NETWORK.net'), 'w')
+    output.write('\n'.join(NetworkDefinitionLines(flags.lines)) + '\n')
+    output.close()
+    naming.Naming(def_dir, snapshot=snapshot)
+
+    def Load(use_snapshot):
+      defs = naming.Naming(def_dir, snapshot=use_snapshot and snapshot)
+      # what aclcheck does next, expanding a large token.
+      defs.GetNet('REGION_0')
+
+    Report('%d lines, parsed (before)' % flags.lines,
+           Time(lambda: Load(False), flags.iterations))
+    Report('%d lines, snapshot (after)' % flags.lines,
+           Time(lambda: Load(True), flags.iterations))
+  finally:
+    shutil.rmtree(def_dir)
+
+
+@Benchmark
+def render(flags):
+  """Multi-target render time and peak RSS, by policy copy per target."""
+  defs = naming.Naming(flags.definitions)
+  data = MultiTargetPolicy(defs, flags.terms, flags.addresses)
+  renderers = [juniper.Juniper, cisco.Cisco, iptables.Iptables,
+               speedway.Speedway]
+
+  def Parse():
+    return policy.ParsePolicy(data, defs)
+
+  def Render(pol, copy_policy):
+    for renderer in renderers:
+      str(renderer(copy_policy(pol), 2))
+
+  for name, copy_policy in (('copy.deepcopy (before)', copy.deepcopy),
+                            ('Policy.Copy (after)', lambda x: x.Copy())):
+    results = [Measure(Parse, lambda pol: Render(pol, copy_policy))
+               for _ in xrange(flags.iterations)]
+    Report(name, min(x[0] for x in results))
+    print '  %-40s %10.1f MB' % (name + ' peak RSS',
+                                 max(x[1] for x in results))
+
+
+def main(argv):
+  parser = OptionParser('usage: %prog [options] [benchmark ...]')
+  parser.add_option('-d', '--def', dest='definitions',
+                    help='definitions directory', default='./def')
+  parser.add_option('--poldir', dest='policy_directory',
+                    help='policy directory', default='./policies')
+  parser.add_option('-n', '--iterations', dest='iterations', type='int',
+                    help='iterations per benchmark, best time is reported',
+                    default=5)
+  parser.add_option('-j', '--jobs', dest='jobs',
+                    help='comma separated job counts for the jobs and '
+                    'evaluate benchmarks',
+                    default='1,2,4')
+  parser.add_option('--terms', dest='terms', type='int',
+                    help='terms in the render benchmark policy', default=20)
+  parser.add_option('--addresses', dest='addresses', type='int',
+                    help='addresses per term in the render benchmark policy',
+                    default=250)
+  parser.add_option('--prefixes', dest='prefixes', type='int',
+                    help='prefixes in the collapse benchmark', default=100000)
+  parser.add_option('--excludes', dest='excludes', type='int',
+                    help='excludes in the exclude benchmark, from five times '
+                    'as many prefixes', default=2000)
+  parser.add_option('--minimize', dest='minimize', type='int',
+                    help='includes and excludes in the minimize benchmark',
+                    default=10000)
+  parser.add_option('--shade_terms', dest='shade_terms', type='int',
+                    help='terms in the shading, check, classify and diff '
+                    'benchmark filter',
+                    default=5000)
+  parser.add_option('--flows', dest='flows', type='int',
+                    help='flows in the evaluate and classify benchmarks',
+                    default=200000)
+  parser.add_option('--lines', dest='lines', type='int',
+                    help='network definition lines in the parents and startup '
+                    'benchmarks',
+                    default=50000)
+  flags, args = parser.parse_args(argv)
+
+  names = [x.__name__ for x in BENCHMARKS]
+  for name in args:
+    if name not in names:
+      parser.error('unknown benchmark %s, choose from %s' % (
+          name, ', '.join(names)))
+
+  for bench in BENCHMARKS:
+    if args and bench.__name__ not in args:
+      continue
+    print '%s: %s' % (bench.__name__, bench.__doc__)
+    bench(flags)
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -36,9 +36,13 @@ def main(argv):
   parser.add_option("-c", "--cmp", dest="cmp", action="store_true",
                     help="Compare two network definition tokens")
 
+  parser.add_option("--snapshot", dest="snapshot", action="store",
+                    help="Load the definitions from this snapshot, written "
+                         "when missing or older than the definitions")
+
   (options, args) = parser.parse_args()
 
-  db = naming.Naming(options.defs)
+  db = naming.Naming(options.defs, snapshot=options.snapshot)
 
   if options.ip is not None and options.token is None:
     for arg in sys.argv[2:]: